@@ -1,8 +1,10 @@
-import pandas as pd
-from utils.utils import send_telegram_message
-from utils.config import NUM_PLAYERS, NUM_PICKS, ALL_EVENTS
-import utils.api as fb_api
-from numpy import random
+import random
+from utils.utils import validate_pick, PickValidation, get_current_time
+from utils.config import NUM_PLAYERS, NUM_PICKS, ALL_EVENTS, LIVE_GAME_HOURS, SQUAD_SYNC_MAX_AGE_SECONDS
+from utils.bulk_load import bulk_load, get_rows
+from utils.cache import get_reference_data, invalidate_reference_data, bump_data_version, expire_data_versions
+from utils.notifications import queue_notification
+from datetime import datetime, timedelta
 
 
 def create_user(conn, name, password_hash, salt, hash_algo, iterations):
@@ -15,9 +17,13 @@ def create_user(conn, name, password_hash, salt, hash_algo, iterations):
         cursor.connection.commit()
 
 
+# Hot queries are also EXPLAINed by `python -m utils.migrations --explain`, to check they use indexes
+USER_QUERY = "SELECT user_id, name, password_hash, salt, hash_algo, iterations FROM users WHERE name = %s"
+
+
 def get_user(conn, name):
     with conn.cursor() as cursor:
-        cursor.execute(f"SELECT user_id, name, password_hash, salt, hash_algo, iterations FROM users WHERE name = %s", (name,))
+        cursor.execute(USER_QUERY, (name,))
         ret = cursor.fetchone()
 
     if ret is None:
@@ -42,73 +48,70 @@ def get_all_user_ids(conn):
 
 
 def get_player_info(conn, name):
-    with conn.cursor() as cursor:
-        cursor.execute(f"SELECT * FROM players WHERE name = %s", (name,))
-        record = cursor.fetchone()
-
-    return {
-        "player_id": record[0], 
-        "name": record[1], 
-        "position": record[2], 
-        "headshot": record[3], 
-        "team_id": record[4]
-    }
+    """Get the player with the given name, or None if there isn't one"""
+    return get_reference_data(conn).players_by_name.get(name)
 
 
 def get_all_players(conn):
-    with conn.cursor() as cursor:
-        cursor.execute("SELECT * FROM players")
-        players = cursor.fetchall()
-
-    return sorted([player[1] for player in players])
+    """Get the names of all players, sorted"""
+    return get_reference_data(conn).player_names
 
 
 def get_draft_order(conn):
-    with conn.cursor() as cursor:
-        cursor.execute(f"""
-            SELECT 
-                u.name, 
-                d.draft_id 
-            FROM users u 
-                inner join draft d on u.user_id = d.user_id
-        """
-        )
-        draft_data = cursor.fetchall()
+    """Get the names of all users in the order they pick in the first round"""
+    return get_reference_data(conn).draft_order
 
-        draft_order = []
-        for item in draft_data:
-            draft_order.append({'Name': item[0], 'Order': item[1]})
 
-    draft_order_df = pd.DataFrame(draft_order, columns=["Name", "Order"]).sort_values('Order')
+def get_pick_owner(draft_order, pick_number):
+    """Get who owns the given (zero-based) pick of a snake draft, or None if the draft is complete"""
+    num_users = len(draft_order)
+    if num_users == 0 or pick_number >= num_users * NUM_PICKS:
+        return None
 
-    full_draft_order = []
-    for idx in range(1, NUM_PICKS + 1, 1):
-        if idx % 2 == 0:
-            full_draft_order.append(draft_order_df.sort_values("Order", ascending=False))
-        else:
-            full_draft_order.append(draft_order_df.sort_values("Order", ascending=True))
+    draft_round, position = divmod(pick_number, num_users)
 
-    full_draft_order = pd.concat(full_draft_order).reset_index(drop=True)
+    # Every other round the order is reversed
+    if draft_round % 2 == 1:
+        position = num_users - 1 - position
 
-    return full_draft_order
+    return draft_order[position]
 
 
-def remove_pick(conn, name, pick):
+def get_pick_number(conn):
+    """Get the number of draft picks that have been made so far"""
     with conn.cursor() as cursor:
+        cursor.execute("SELECT pick_number FROM draft_state WHERE draft_state_id = 1")
+        record = cursor.fetchone()
 
-        cursor.execute(f"SELECT user_id FROM users where name = %s;", (name,))
-        user = cursor.fetchone()
+    return record[0] if record else 0
 
-        cursor.execute(f"SELECT player_id FROM players where name = %s;", (pick,))
-        player = cursor.fetchone()
 
-        cursor.execute(f"DELETE FROM picks WHERE user_id=%s AND player_id=%s", (user['user_id'], player['player_id']))
+def remove_pick(conn, name, pick):
+    player = get_player_info(conn, pick)
+    if player is None:
+        return
 
-    conn.commit()
+    with conn.cursor() as cursor:
 
+        cursor.execute(f"""
+            DELETE pi FROM picks pi
+                INNER JOIN users u ON u.user_id = pi.user_id
+            WHERE u.name = %s
+            AND pi.player_id = %s
+        """,
+            (name, player["player_id"])
+        )
+
+        # Hand the pick back to the draft
+        if cursor.rowcount > 0:
+            cursor.execute("UPDATE draft_state SET pick_number = GREATEST(pick_number - 1, 0) WHERE draft_state_id = 1")
+            bump_data_version(cursor, "picks")
+
+    conn.commit()
+    expire_data_versions()
 
 
-def calculate_next_gameweek(date: pd.Timestamp) -> str:
+def calculate_next_gameweek(date: datetime) -> str:
     """
     Calculate the next gameweek from a given date.
 
@@ -118,60 +121,140 @@ def calculate_next_gameweek(date: pd.Timestamp) -> str:
     return date.strftime("%Y-%m-%d %H:%M:%S") if date else None
 
 
-def add_draft_pick(conn, name, pick):
+def add_draft_pick(conn, user_id, name, player_info, pick_number):
+    """Add the given (zero-based) pick of the draft, the caller must hold the lock on the draft state"""
+    gameweek_ids = get_reference_data(conn).gameweek_ids
+
     with conn.cursor() as cursor:
 
-        cursor.execute(f"SELECT user_id FROM users where name = %s;", (name,))
-        user = cursor.fetchone()
+        # For draft picks, the user owns the player for all gameweeks
+        cursor.execute(
+            "INSERT INTO picks (user_id, player_id, from_gameweek_id, to_gameweek_id) VALUES (%s, %s, %s, %s)",
+            (user_id, player_info["player_id"], min(gameweek_ids), max(gameweek_ids))
+        )
+
+        pick_number += 1
+        cursor.execute("UPDATE draft_state SET pick_number = %s WHERE draft_state_id = 1", (pick_number,))
 
-        cursor.execute(f"SELECT player_id FROM players where name = %s;", (pick,))
-        player = cursor.fetchone()
+        pick = player_info["name"]
 
-        # For draft picks, insert the player into all gameweeks
-        cursor.execute(f"SELECT gameweek_id FROM gameweeks")
-        gameweeks = cursor.fetchall()
-        for gameweek in gameweeks:
-            cursor.execute(f"INSERT INTO picks (user_id, player_id, gameweek_id) VALUES(%s, %s, %s)", (user, player, gameweek))
+        # Sent by the notification worker once the pick is committed
+        queue_notification(cursor, f"`{name}` has picked `{pick}`")
+
+        next_to_pick = get_pick_owner(get_draft_order(conn), pick_number)
+        if next_to_pick is not None:
+            queue_notification(cursor, f"Waiting for `{next_to_pick}` to pick...")
+        else:
+            queue_notification(cursor, "The draft is complete. Good luck!")
+
+        # Standings show every team's picks
+        bump_data_version(cursor, "picks")
 
     conn.commit()
+    expire_data_versions()
 
-    send_telegram_message(f"`{name}` has picked `{pick}`")
 
+def claim_draft_pick(conn, user_id, name, player_info):
+    """
+    Atomically check it's the given user's turn, validate the pick and add it.
+    The draft state row is locked until the pick is committed, so simultaneous picks are serialized.
+    Anything not yet committed on the connection is rolled back first.
+    """
+    # Reads made earlier in the request (e.g. the reference data check) would have fixed this transaction's snapshot
+    # before we waited for the lock, so the checks below wouldn't see a pick committed while we were waiting. A new
+    # transaction takes its snapshot at its first plain read, which is after the lock is ours
+    conn.rollback()
 
-def make_transfer(conn, name, player_in, player_out, gameweek_id):
     with conn.cursor() as cursor:
+        cursor.execute("SELECT pick_number FROM draft_state WHERE draft_state_id = 1 FOR UPDATE")
+        record = cursor.fetchone()
 
-        cursor.execute(f"SELECT user_id FROM users where name = %s;", (name,))
-        user = cursor.fetchone()
+    pick_number = record[0] if record else 0
+    next_to_pick = get_pick_owner(get_draft_order(conn), pick_number)
 
-        cursor.execute(f"SELECT player_id FROM players where name = %s;", (player_in,))
-        player_in_id = cursor.fetchone()
+    if next_to_pick is None:
+        conn.rollback()
+        return PickValidation(False, "The draft is complete!")
 
-        cursor.execute(f"SELECT player_id FROM players where name = %s;", (player_out,))
-        player_out_id = cursor.fetchone()
+    if next_to_pick != name:
+        conn.rollback()
+        return PickValidation(False, f"It's not your pick, wait for `{next_to_pick}` to pick")
 
-        # For draft picks, insert the player into all gameweeks
-        cursor.execute(f"UPDATE picks SET player_id = %s WHERE user_id = %s AND gameweek_id = %s AND player_id = %s", (player_in_id, user, gameweek_id, player_out_id))
+    # Check to see if we are allowed to pick this player (use gameweek 1 since this is the draft)
+    position_counts = get_position_counts(conn, user_id, 1)
+    already_picked = is_player_picked(conn, player_info["player_id"], 1)
+    validation = validate_pick(player_info, position_counts, already_picked)
 
-    conn.commit()
+    if not validation.valid:
+        conn.rollback()
+        return validation
+
+    # This commits, releasing the lock
+    add_draft_pick(conn, user_id, name, player_info, pick_number)
 
-    send_telegram_message(f"{name}: {player_out} out; {player_in} in")
+    return validation
 
 
-def get_user_gameweek_picks(conn, name, gameweek_id):
+def make_transfer(conn, user_id, name, player_in_info, player_out_info, gameweek_id):
+    player_in = player_in_info["name"]
+    player_out = player_out_info["name"]
+
     with conn.cursor() as cursor:
+
+        # Open a range for the player coming in, from this gameweek to the end of the player going out's range
         cursor.execute(f"""
+            INSERT INTO picks (user_id, player_id, from_gameweek_id, to_gameweek_id)
             SELECT 
-                pl.* 
-            FROM users u
-                INNER JOIN picks pi ON u.user_id = pi.user_id
-                INNER JOIN players pl ON pi.player_id = pl.player_id
-            WHERE u.name = %s
-            AND pi.gameweek_id = %s;
-        """, 
-            (name, gameweek_id)
+                pi.user_id, 
+                %s, 
+                %s, 
+                pi.to_gameweek_id
+            FROM picks pi
+            WHERE pi.user_id = %s
+            AND pi.player_id = %s
+            AND %s BETWEEN pi.from_gameweek_id AND pi.to_gameweek_id
+        """,
+            (player_in_info["player_id"], gameweek_id, user_id, player_out_info["player_id"], gameweek_id)
         )
 
+        # Then close the range of the player going out at the gameweek before
+        cursor.execute(f"""
+            UPDATE picks pi
+            SET pi.to_gameweek_id = %s - 1
+            WHERE pi.user_id = %s
+            AND pi.player_id = %s
+            AND %s BETWEEN pi.from_gameweek_id AND pi.to_gameweek_id
+        """,
+            (gameweek_id, user_id, player_out_info["player_id"], gameweek_id)
+        )
+
+        # If the player going out was only transferred in for this gameweek their range is now empty
+        cursor.execute(
+            "DELETE FROM picks WHERE user_id = %s AND to_gameweek_id < from_gameweek_id",
+            (user_id,)
+        )
+
+        queue_notification(cursor, f"{name}: {player_out} out; {player_in} in")
+        bump_data_version(cursor, "picks")
+
+    conn.commit()
+    expire_data_versions()
+
+
+USER_GAMEWEEK_PICKS_QUERY = """
+    SELECT 
+        pl.* 
+    FROM picks pi
+        INNER JOIN players pl ON pi.player_id = pl.player_id
+    WHERE pi.user_id = %s
+    AND %s BETWEEN pi.from_gameweek_id AND pi.to_gameweek_id
+"""
+
+
+def get_user_gameweek_picks(conn, user_id, gameweek_id):
+    with conn.cursor() as cursor:
+        cursor.execute(USER_GAMEWEEK_PICKS_QUERY, (user_id, gameweek_id))
+
         picks = cursor.fetchall()
 
     return picks
@@ -185,7 +268,7 @@ def get_all_gameweek_picks(conn, gameweek_id):
             FROM users u
                 INNER JOIN picks pi ON u.user_id = pi.user_id
                 INNER JOIN players pl ON pi.player_id = pl.player_id
-            WHERE pi.gameweek_id = %s;
+            WHERE %s BETWEEN pi.from_gameweek_id AND pi.to_gameweek_id;
         """, 
             (gameweek_id,)
         )
@@ -195,29 +278,48 @@ def get_all_gameweek_picks(conn, gameweek_id):
     return picks
 
 
-def get_next_to_pick(conn, draft_order):
+IS_PLAYER_PICKED_QUERY = """
+    SELECT 1 
+    FROM picks 
+    WHERE player_id = %s 
+    AND %s BETWEEN from_gameweek_id AND to_gameweek_id
+    LIMIT 1
+"""
+
+
+def is_player_picked(conn, player_id, gameweek_id):
+    """Check if any user owns the given player in the given gameweek"""
     with conn.cursor() as cursor:
-        cursor.execute(f"""
-            SELECT 
-                u.name,
-                pl.name as player_name 
-            FROM users u
-                INNER JOIN picks pi ON u.user_id = pi.user_id
-                INNER JOIN players pl ON pi.player_id = pl.player_id
-        """
-        )
-        picks = cursor.fetchall()
+        cursor.execute(IS_PLAYER_PICKED_QUERY, (player_id, gameweek_id))
+        record = cursor.fetchone()
 
-        all_picks = []
-        for item in picks:
-            all_picks.append({'Name': item[0], 'Player': item[1]})
+    return record is not None
 
-    if len(all_picks) in draft_order.index:
-        next_to_pick = draft_order.loc[len(all_picks)].Name
-    else:
-        next_to_pick = None
 
-    return next_to_pick
+POSITION_COUNTS_QUERY = """
+    SELECT 
+        pl.position,
+        COUNT(*)
+    FROM picks pi
+        INNER JOIN players pl ON pl.player_id = pi.player_id
+    WHERE pi.user_id = %s
+    AND %s BETWEEN pi.from_gameweek_id AND pi.to_gameweek_id
+    GROUP BY pl.position
+"""
+
+
+def get_position_counts(conn, user_id, gameweek_id):
+    """Get how many players the given user owns in each position in the given gameweek"""
+    with conn.cursor() as cursor:
+        cursor.execute(POSITION_COUNTS_QUERY, (user_id, gameweek_id))
+        counts = cursor.fetchall()
+
+    return {position: count for position, count in counts}
+
+
+def get_next_to_pick(conn):
+    """Get the name of the user who picks next, or None if the draft is complete"""
+    return get_pick_owner(get_draft_order(conn), get_pick_number(conn))
 
 
 def get_all_player_points(conn):
@@ -229,11 +331,10 @@ def get_all_player_points(conn):
                 pl.headshot,
                 pl.position,
                 t.name as team_name,
-                SUM(value) as total_points
+                SUM(pgp.points) as total_points
             FROM players pl
                 INNER JOIN teams t on t.team_id = pl.team_id
-                LEFT JOIN points po ON pl.player_id = po.player_id
-                LEFT JOIN events e ON e.event_id = po.event_id
+                LEFT JOIN player_gameweek_points pgp ON pl.player_id = pgp.player_id
             GROUP BY pl.name, pl.headshot, pl.position, t.name
         """
         )
@@ -246,13 +347,10 @@ def get_all_player_points(conn):
                 'Headshot': item[1], 
                 'Position': item[2], 
                 'TeamName': item[3], 
-                'TotalPoints': item[4] if item[4] is not None else 0
+                'TotalPoints': int(item[4]) if item[4] is not None else 0
             })
 
-    return pd.DataFrame(
-        points, 
-        columns=["Name", "Position", "TeamName", "TotalPoints"]
-    ).sort_values('TotalPoints', ascending=False)
+    return sorted(points, key=lambda item: item['TotalPoints'], reverse=True)
 
 
 def set_draft_order(conn):
@@ -268,115 +366,319 @@ def set_draft_order(conn):
             return f"Number of users is not equal to {NUM_PLAYERS}!"
         
         # generate a random draft order
-        order = random.permutation(NUM_PLAYERS) + 1
+        order = random.sample(range(1, NUM_PLAYERS + 1), NUM_PLAYERS)
         order = {order[i]: user_ids[i] for i in range(len(order))}
 
         # Now add the new order
         draft_str = [f"({ord}, {user})" for ord, user in order.items()]
         cursor.execute("INSERT INTO draft (draft_id, user_id) VALUES " + ",".join(draft_str))
 
+        # A new draft order starts a new draft
+        cursor.execute("INSERT INTO draft_state (draft_state_id, pick_number) VALUES (1, 0) ON DUPLICATE KEY UPDATE pick_number = 0")
+
+        # The draft order is cached with the rest of the reference data
+        bump_data_version(cursor, "reference")
+
         conn.commit()
 
+    invalidate_reference_data()
+    expire_data_versions()
+
     return "Draft order set successfully!"
 
-def get_standings(conn):
-    """Get the current standings"""
+STANDINGS_QUERY = """
+    SELECT 
+        u.name,
+        pl.name as player_name,
+        pl.position,
+        pl.headshot,
+        IFNULL(pgp.points, 0) as points
+    FROM picks pi
+        INNER JOIN users u ON u.user_id = pi.user_id
+        INNER JOIN players pl on pl.player_id = pi.player_id
+        LEFT JOIN player_gameweek_points pgp 
+            on pgp.gameweek_id = %s AND pgp.player_id = pi.player_id
+    WHERE %s BETWEEN pi.from_gameweek_id AND pi.to_gameweek_id
+"""
+
+
+def get_standings(conn, gameweek_id):
+    """Get the standings for the given gameweek"""
     with conn.cursor() as cursor:
-        cursor.execute(
-            f"""
-                SELECT 
-                    u.name,
-                    gw.gameweek_id,
-                    pl.name as player_name,
-                    pl.position,
-                    pl.headshot,
-                    IFNULL(sum(e.value), 0) as points
-                FROM users u
-                    INNER JOIN picks pi ON pi.user_id = u.user_id
-                    INNER JOIN gameweeks gw on gw.gameweek_id = pi.gameweek_id
-                    INNER JOIN players pl on pl.player_id = pi.player_id
-                    LEFT JOIN points po on po.player_id = pl.player_id
-                    LEFT JOIN events e on e.event_id = po.event_id
-                GROUP BY u.name, player_name, gw.gameweek_id, position, headshot
-            """
-        )
+        cursor.execute(STANDINGS_QUERY, (gameweek_id, gameweek_id))
         data = cursor.fetchall()
 
         standings = []
         for item in data:
             standings.append({
                 'Name': item[0], 
-                'Gameweek': item[1], 
-                'Player': item[2], 
-                'Position': item[3], 
-                'Headshot': item[4], 
-                'Points': item[5]
+                'Gameweek': gameweek_id, 
+                'Player': item[1], 
+                'Position': item[2], 
+                'Headshot': item[3], 
+                'Points': item[4]
             })
 
-    return pd.DataFrame(standings).sort_values(['Gameweek', 'Points'], ascending=[True, False])
+    return sorted(standings, key=lambda item: item['Points'], reverse=True)
+
+GAMEWEEK_TOTALS_QUERY = """
+    SELECT 
+        u.name,
+        gw.gameweek_id,
+        IFNULL(SUM(pgp.points), 0) as points
+    FROM picks pi
+        INNER JOIN users u ON u.user_id = pi.user_id
+        INNER JOIN gameweeks gw 
+            on gw.gameweek_id BETWEEN pi.from_gameweek_id AND pi.to_gameweek_id
+        LEFT JOIN player_gameweek_points pgp 
+            on pgp.gameweek_id = gw.gameweek_id AND pgp.player_id = pi.player_id
+    {where}
+    GROUP BY u.name, gw.gameweek_id
+"""
+
+
+def get_gameweek_totals(conn, gameweek_id=None):
+    """Get the total points for each user in each gameweek, optionally only for the given gameweek"""
+    where = "WHERE gw.gameweek_id = %s" if gameweek_id is not None else ""
+    params = (gameweek_id,) if gameweek_id is not None else ()
+
+    with conn.cursor() as cursor:
+        cursor.execute(GAMEWEEK_TOTALS_QUERY.format(where=where), params)
+        data = cursor.fetchall()
+
+    return [{'Name': item[0], 'Gameweek': item[1], 'Points': int(item[2])} for item in data]
+
+
+def rebuild_player_gameweek_points(conn):
+    """Rebuild the gameweek points of every player from the points table"""
+    with conn.cursor() as cursor:
+        cursor.execute("DELETE FROM player_gameweek_points")
+        cursor.execute(f"""
+            INSERT INTO player_gameweek_points (gameweek_id, player_id, points)
+            SELECT 
+                g.gameweek_id,
+                po.player_id,
+                SUM(e.value)
+            FROM points po
+                INNER JOIN games g ON g.game_id = po.fixture_id
+                INNER JOIN events e ON e.event_id = po.event_id
+            GROUP BY g.gameweek_id, po.player_id
+        """
+        )
+        bump_data_version(cursor, "points")
+
+    conn.commit()
+    expire_data_versions()
+
+
+def get_live_events(conn, previous_state=None):
+    """
+    Get the events for the live draft board that have happened since `previous_state`.
+
+    :return: The new state, to pass in next time, and a list of (event, data) tuples. With no previous state the
+        current turn and points are returned, so new viewers start with a full board.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+                SELECT
+                    (SELECT pick_number FROM draft_state WHERE draft_state_id = 1),
+                    (SELECT version FROM data_versions WHERE name = 'points'),
+                    (SELECT MAX(pick_id) FROM picks)
+            """
+        )
+        pick_number, points_version, pick_id = cursor.fetchone()
+
+    state = {"pick_number": pick_number or 0, "points_version": points_version or 0, "pick_id": pick_id or 0}
+    previous_state = previous_state or {}
+    events = []
+
+    # Every player taken since last time, by draft picks or transfers, as several can land between checks
+    if "pick_id" in previous_state and state["pick_id"] > previous_state["pick_id"]:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                    SELECT u.name, pl.name FROM picks pi
+                        INNER JOIN users u ON u.user_id = pi.user_id
+                        INNER JOIN players pl ON pl.player_id = pi.player_id
+                    WHERE pi.pick_id > %s
+                    ORDER BY pi.pick_id
+                """,
+                (previous_state["pick_id"],)
+            )
+            new_picks = cursor.fetchall()
+
+        events.extend(("pick", {"name": name, "player": player}) for name, player in new_picks)
+
+    if state["pick_number"] != previous_state.get("pick_number"):
+        next_to_pick = get_pick_owner(get_draft_order(conn), state["pick_number"])
+        events.append(("turn", {"pick_number": state["pick_number"], "next_to_pick": next_to_pick}))
+
+    if state["points_version"] != previous_state.get("points_version"):
+        gameweek_id = get_reference_data(conn).get_gameweek_at(get_current_time())
+        if gameweek_id is not None:
+            events.append(("points", {"gameweek": gameweek_id, "totals": get_gameweek_totals(conn, gameweek_id)}))
+
+    return state, events
+
 
 def get_next_gameweek(conn):
     """Get the next gameweek"""
+    return get_reference_data(conn).get_next_gameweek(get_current_time())
+
+def get_games_between(conn, start_time: datetime, end_time: datetime):
+    """Get the (game_id, start_time) of all games kicking off between the given times"""
     with conn.cursor() as cursor:
-        cursor.execute(f"SELECT * FROM gameweeks")
-        all_gameweeks = cursor.fetchall()
+        cursor.execute(
+            "SELECT game_id, start_time FROM games WHERE start_time BETWEEN %s AND %s ORDER BY start_time", 
+            (start_time, end_time)
+        )
+        games = cursor.fetchall()
 
-        # Get the current gameweek
-        current_time = pd.Timestamp.now()
+    return [(game[0], game[1]) for game in games]
 
-        # Check to see if we're not in the first gameweek
-        if current_time < all_gameweeks[0][2]:
-            next_gameweek = all_gameweeks[0][0]
-        else:
-            next_gameweek = None
 
-        # Then loop over all gameweeks to find the current one and plus 1
-        for gameweek in all_gameweeks:
-            if gameweek[2] <= current_time <= gameweek[3]:
-                next_gameweek = gameweek[0] + 1
+def get_live_games(conn, current_time: datetime):
+    """Get the fixture ids of all games that could be in progress at the given time"""
+    games = get_games_between(conn, current_time - timedelta(hours=LIVE_GAME_HOURS), current_time)
+    return [game_id for game_id, _ in games]
+
+
+def update_player_gameweek_points(cursor, fixture_id, player_ids):
+    """Recalculate the gameweek points of the given players, in the gameweek of the given fixture"""
+    if not player_ids:
+        return
+
+    player_ids_str = ",".join(["%s"] * len(player_ids))
+
+    # Delete first, as players can be left without any points when events are removed
+    cursor.execute(f"""
+        DELETE FROM player_gameweek_points 
+        WHERE gameweek_id = (SELECT gameweek_id FROM games WHERE game_id = %s)
+        AND player_id IN ({player_ids_str})
+    """,
+        (fixture_id, *player_ids)
+    )
 
-    return next_gameweek
+    cursor.execute(f"""
+        INSERT INTO player_gameweek_points (gameweek_id, player_id, points)
+        SELECT 
+            g.gameweek_id,
+            po.player_id,
+            SUM(e.value)
+        FROM points po
+            INNER JOIN games g ON g.game_id = po.fixture_id
+            INNER JOIN events e ON e.event_id = po.event_id
+        WHERE g.gameweek_id = (SELECT gameweek_id FROM games WHERE game_id = %s)
+        AND po.player_id IN ({player_ids_str})
+        GROUP BY g.gameweek_id, po.player_id
+    """,
+        (fixture_id, *player_ids)
+    )
 
-def get_live_games(conn, current_time: pd.Timestamp):
+
+FIXTURE_EVENT_KEYS_QUERY = "SELECT event_key, player_id FROM points WHERE fixture_id = %s AND event_key IS NOT NULL"
+
+
+def update_points_for_fixture(conn, fixture_id, feed=None):
+    """
+    Check if there are new events for the given fixture and update database accordingly.
+    Events and lineups are fetched from the API unless another `feed` is given, e.g. a recording, which must have the
+    same `get_all_events_for_fixture` and `get_fixture_lineups` functions as `utils.api`.
+    Only events that have changed since the last update are written, events that have disappeared from the feed 
+    (e.g. goals cancelled by VAR, or clean sheets lost) are deleted. Returns the number of (new, deleted) events.
+    """
+    # Scoring needs pandas, which the website doesn't load unless it's needed
+    from utils.scoring import (
+        events_to_dataframe, 
+        lineups_to_dataframe, 
+        derive_scoring_events, 
+        normalize_scoring_events, 
+        get_match_minute
+    )
+
+    if feed is None:
+        import utils.api as feed
+
+    # Checked before spending any API calls on the fixture
     with conn.cursor() as cursor:
-        max_time_str = current_time.strftime("%Y-%m-%dT%H:%M:%S")
-        min_time_str = (current_time - pd.Timedelta(hours=3)).strftime("%Y-%m-%dT%H:%M:%S")
-        cursor.execute(f"SELECT fixture_id FROM games where {min_time_str - pd.Timedelta(hours=3)} <= start_time <= {max_time_str}")
-        all_games = cursor.fetchall()
-        fixture_ids = [game['fixture_id'] for game in all_games]
+        cursor.execute("SELECT start_time FROM games WHERE game_id = %s", (fixture_id,))
+        game = cursor.fetchone()
 
-    return fixture_ids
+    # End the read, so the diff below sees the points as they are after the API calls rather than before them
+    conn.rollback()
 
+    if game is None:
+        raise ValueError(f"Fixture {fixture_id} isn't in the games table")
+    kick_off = game[0]
+
+    events = feed.get_all_events_for_fixture(fixture_id)
+    lineups = feed.get_fixture_lineups(fixture_id)
+    reference = get_reference_data(conn)
 
-def update_points_for_fixture(conn, fixture_id):
-    """Check if there are new events for the given fixture and update database accordingly"""
-    events = fb_api.get_all_events_for_fixture(fixture_id)
     with conn.cursor() as cursor:
-        cursor.execute(f"SELECT MAX(event_time) FROM points WHERE fixture_id = %s", (fixture_id,))
-        latest_event = cursor.fetchall()
+        # Derive all the scoring events, including assists, clean sheets and penalty saves
+        scoring_events = derive_scoring_events(
+            events_to_dataframe(events, reference),
+            lineups_to_dataframe(lineups, reference),
+            reference,
+            {fixture_id: get_match_minute(kick_off, get_current_time())}
+        )
+        rows = normalize_scoring_events(scoring_events, reference, {fixture_id: kick_off})
 
-        # Then this is the first update, add all events
-        if not latest_event:
-            cursor.execute("INSERT INTO points (fixture_id, player_id, event_id, event_time) VALUES (%s, %s, %s, %s)", events)
-            conn.commit()
-        else:
-            new_events = events[events['event_time'] > latest_event[0]['event_time']]
-            cursor.execute("INSERT INTO points (fixture_id, player_id, event_id, event_time) VALUES (%s, %s, %s, %s)", new_events)
-            conn.commit()
+        cursor.execute(FIXTURE_EVENT_KEYS_QUERY, (fixture_id,))
+        existing = {event_key: player_id for event_key, player_id in cursor.fetchall()}
+
+        new_keys = [event_key for event_key in rows if event_key not in existing]
+        deleted_keys = [event_key for event_key in existing if event_key not in rows]
+
+        # Nothing has changed since the last time we polled this fixture
+        if not new_keys and not deleted_keys:
+            conn.rollback()
+            return 0, 0
 
-    return len(events) == 0
+        if deleted_keys:
+            cursor.execute(
+                f"DELETE FROM points WHERE fixture_id = %s AND event_key IN ({','.join(['%s'] * len(deleted_keys))})",
+                (fixture_id, *deleted_keys)
+            )
 
+        if new_keys:
+            cursor.executemany(
+                "INSERT INTO points (fixture_id, player_id, event_id, event_time, event_key) VALUES (%s, %s, %s, %s, %s)",
+                [rows[event_key] for event_key in new_keys]
+            )
 
-def refresh_data(conn):
-    """Refresh events data"""
-    fixture_ids = get_live_games(conn, pd.Timestamp.now())
+        # Only the players with changed events can have changed, so only refresh their gameweek totals
+        player_ids = sorted({rows[event_key][1] for event_key in new_keys} | {existing[event_key] for event_key in deleted_keys})
+        update_player_gameweek_points(cursor, fixture_id, player_ids)
+
+        # Tells the live draft board to push the new totals
+        bump_data_version(cursor, "points")
+
+        conn.commit()
+
+    expire_data_versions()
+
+    return len(new_keys), len(deleted_keys)
+
+
+def refresh_data(conn, feed=None):
+    """Refresh events data for all live games, returns the fixture ids updated"""
+    fixture_ids = get_live_games(conn, get_current_time())
 
     for fixture_id in fixture_ids:
-        update_points_for_fixture(conn, fixture_id)
+        update_points_for_fixture(conn, fixture_id, feed)
+
+    return fixture_ids
 
 
 def initialize_tables(conn, league_id, year, refresh=False):
     """Create all tables if they do not exist, needs to be run before Draft can start and will likely max out API calls"""
+    # Only needed for setup, so the website doesn't load them on start up
+    import pandas as pd
+    import utils.api as fb_api
+
     with conn.cursor() as cursor:
 
         # First check if the tables already exist
@@ -420,32 +722,107 @@ def initialize_tables(conn, league_id, year, refresh=False):
         
         all_teams_df = all_teams_df[['team_id', 'name', 'logo']]
 
-        all_fixtures = [str(tuple(x)) for x in all_fixtures_df.to_numpy()]
-        all_gameweeks = [str(tuple(x)) for x in all_gameweeks_df.to_numpy()]
-        all_teams = [str(tuple(x)) for x in all_teams_df.to_numpy()]
-        all_players = [str(tuple(x)) for x in all_players_df.to_numpy()]
-        
-        cursor.execute("TRUNCATE TABLE games;")
-        cursor.execute("INSERT INTO games (game_id, home_team_id, away_team_id, start_time, gameweek_id) VALUES " + ",".join(all_fixtures))
-        print("Updated games table")
+        # Load everything into shadow tables and swap them in at once, so the site never sees half loaded tables
+        bulk_load(conn, {
+            "games": (["game_id", "home_team_id", "away_team_id", "start_time", "gameweek_id"], get_rows(all_fixtures_df)),
+            "gameweeks": (["gameweek_id", "name", "start_time", "end_time"], get_rows(all_gameweeks_df)),
+            "teams": (["team_id", "name", "logo"], get_rows(all_teams_df)),
+            "players": (["player_id", "name", "position", "headshot", "team_id"], get_rows(all_players_df)),
+            "events": (["name", "position", "value"], list(ALL_EVENTS)),
+        })
+        print("Swapped in new tables")
+
+        # Make every process reload its cached reference data
+        bump_data_version(cursor, "reference")
+
+        conn.commit()
+
+    invalidate_reference_data()
+    expire_data_versions()
+
+    return "Tables created successfully!"
+
+
+
+def sync_reference_data(conn, league_id, year, team_ids=None, max_age=SQUAD_SYNC_MAX_AGE_SECONDS):
+    """
+    Incrementally sync teams and squads with the API, e.g. for mid season transfers, without touching picks or points.
+
+    :param conn: Database connection.
+    :param league_id: League to sync the teams of.
+    :param year: Season to sync the teams of.
+    :param team_ids: Only refetch the squads of these teams, defaults to every team in the league.
+    :param max_age: Squads fetched more recently than this many seconds are reused from the API cache.
+    :return: Message summarising the changes.
+    """
+    import utils.api as fb_api
 
-        cursor.execute("TRUNCATE TABLE gameweeks;")
-        cursor.execute("INSERT INTO gameweeks (gameweek_id, name, start_time, end_time) VALUES " + ",".join(all_gameweeks))
-        print("Updated games table")
+    all_teams_df = fb_api.get_all_teams(league_id, year)
+    teams = {team[0]: team for team in get_rows(all_teams_df[['team_id', 'name', 'logo']])}
 
-        cursor.execute("TRUNCATE TABLE teams;")
-        cursor.execute("INSERT INTO teams (team_id, name, logo) VALUES " + ",".join(all_teams))
-        print("Updated teams table")
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT team_id, name, logo FROM teams")
+        existing_teams = {team[0]: tuple(team) for team in cursor.fetchall()}
 
-        cursor.execute("TRUNCATE TABLE players;")
-        cursor.execute("INSERT INTO players (player_id, name, position, headshot, team_id) VALUES " + ",".join(all_players))
-        print("Updated players table")
+    # Teams we don't know about yet always need their squad fetching
+    new_team_ids = [team_id for team_id in teams if team_id not in existing_teams]
+    changed_teams = [team for team_id, team in teams.items() if existing_teams.get(team_id) != team]
 
-        cursor.execute("TRUNCATE TABLE events;")
-        cursor.execute("INSERT INTO events (name, position, value) VALUES " + ",".join([str(event) for event in ALL_EVENTS]))
-        print("Updated events table")
+    team_ids = sorted(set(team_ids if team_ids is not None else teams) | set(new_team_ids))
+    players = {player[0]: player for player in get_rows(fb_api.get_all_players(team_ids, max_age))}
+
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """
+                SELECT pl.player_id, pl.name, pl.position, pl.headshot, pl.team_id,
+                    EXISTS(SELECT 1 FROM picks pi WHERE pi.player_id = pl.player_id)
+                    OR EXISTS(SELECT 1 FROM points po WHERE po.player_id = pl.player_id)
+                FROM players pl
+            """
+        )
+        existing_players = {player[0]: (tuple(player[:5]), player[5]) for player in cursor.fetchall()}
+
+        inserts = [player for player_id, player in players.items() if player_id not in existing_players]
+        updates = [
+            player for player_id, player in players.items()
+            if player_id in existing_players and existing_players[player_id][0] != player
+        ]
+
+        # Players who have left the squads we fetched, unless someone has picked them or they have points
+        deletes = [
+            (player_id,) for player_id, (player, used) in existing_players.items()
+            if player[4] in team_ids and player_id not in players and not used
+        ]
+
+        if changed_teams:
+            cursor.executemany(
+                "INSERT INTO teams (team_id, name, logo) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE name = VALUES(name), logo = VALUES(logo)",
+                changed_teams
+            )
+
+        if inserts:
+            cursor.executemany(
+                "INSERT INTO players (player_id, name, position, headshot, team_id) VALUES (%s, %s, %s, %s, %s)", inserts
+            )
+
+        if updates:
+            cursor.executemany(
+                "UPDATE players SET name = %s, position = %s, headshot = %s, team_id = %s WHERE player_id = %s",
+                [player[1:] + player[:1] for player in updates]
+            )
+
+        if deletes:
+            cursor.executemany("DELETE FROM players WHERE player_id = %s", deletes)
+
+        if changed_teams or inserts or updates or deletes:
+            bump_data_version(cursor, "reference")
 
         conn.commit()
 
-    return "Tables created successfully!"
+    invalidate_reference_data()
+    expire_data_versions()
 
+    return (
+        f"Synced {len(team_ids)} squads: {len(changed_teams)} teams changed, {len(inserts)} players added, "
+        f"{len(updates)} updated and {len(deletes)} removed."
+    )
@@ -0,0 +1,8 @@
+"""Gunicorn settings, loaded automatically when gunicorn is started from this directory"""
+
+
+def post_worker_init(worker):
+    """Warm up each worker before it accepts requests, for servers that don't send App Engine's warmup request"""
+    from main import warm_up
+
+    warm_up()
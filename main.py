@@ -1,15 +1,18 @@
 import hashlib
 import os
 import re
+import time
 from functools import wraps
-import pandas as pd
-from flask import Flask, render_template, request, redirect, url_for, session
-from flask_mysqldb import MySQL
+from flask import Flask, Response, render_template, request, redirect, url_for, session, g, make_response
 import db 
-
+from utils import metrics
+from utils.notifications import NotificationWorker
+from utils.live import LiveHub
+from utils.cache import get_cached_page, get_reference_data
+from utils.database import CLOUD_SQL_SECRETS, get_pool
+from utils.secrets import load_secrets
+from utils.config import LIVE_STREAMING, LIVE_POLL_SECONDS
 from utils.utils import (
-    send_telegram_message, 
-    get_cloud_secret, 
     create_secure_password, 
     create_path_to_image_html, 
     validate_pick
@@ -17,21 +20,82 @@ from utils.utils import (
 
 app = Flask(__name__)
 
-app.secret_key = get_cloud_secret("FOOTBALL_SECRET_KEY")
-
+# Fetch every secret we need at once, in parallel, they're cached for the life of the process
+secret_names = ["FOOTBALL_SECRET_KEY", "API_KEY"]
 if os.environ.get("GAE_ENV") == "standard":
-    app.config["MYSQL_UNIX_SOCKET"] = f"/cloudsql/{get_cloud_secret('CLOUD_SQL_CONNECTION_NAME')}"
-    app.config["MYSQL_USER"] = get_cloud_secret("CLOUD_SQL_USERNAME")
-    app.config["MYSQL_PASSWORD"] = get_cloud_secret("CLOUD_SQL_PASSWORD")
-    app.config["MYSQL_DB"] = get_cloud_secret("CLOUD_SQL_DATABASE_NAME")
-else:
-    app.config["MYSQL_HOST"] = "localhost"
-    app.config["MYSQL_USER"] = "root"
-    app.config["MYSQL_PASSWORD"] = "password"
-    app.config["MYSQL_DB"] = "draft"
-
-# Connect to SQL db
-mysql = MySQL(app)
+    secret_names += CLOUD_SQL_SECRETS
+secrets = load_secrets(secret_names)
+
+app.secret_key = secrets["FOOTBALL_SECRET_KEY"]
+
+# Time every db function and count its queries, before anything keeps a reference to them
+metrics.instrument_module(db)
+
+# Pool of connections to SQL db, each request borrows one connection for its lifetime. It's shared with the football
+# API cache, see utils/database.py
+pool = get_pool()
+
+# Sends the Telegram messages queued by picks and transfers, so requests never wait on Telegram. BACKGROUND_WORKERS=0
+# loads the pages without it, for utils.query_recorder and the tests, which mustn't send a seeded database's outbox
+notification_worker = NotificationWorker(pool)
+if os.environ.get("BACKGROUND_WORKERS", "1") == "1":
+    notification_worker.start()
+
+# Pushes picks, turns and points to everyone watching /stream, reading each change from the db once
+live_hub = LiveHub(pool, db.get_live_events)
+
+# Tells static/live.js whether to stream or poll the live board
+app.jinja_env.globals.update(live_streaming=LIVE_STREAMING, live_poll_seconds=LIVE_POLL_SECONDS)
+
+
+def get_db():
+    """Get this request's database connection, borrowing one from the pool on first use"""
+    if "db" not in g:
+        g.db = pool.get()
+
+    return g.db
+
+
+@app.teardown_appcontext
+def return_db(exception):
+    conn = g.pop("db", None)
+    if conn is not None:
+        pool.put(conn)
+
+
+@app.before_request
+def start_request_metrics():
+    metrics.start_request()
+
+
+@app.after_request
+def end_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.end_request(route, request.method, response.status_code)
+    return response
+
+
+@app.teardown_request
+def end_failed_request_metrics(exception):
+    # after_request isn't called if the request raised, otherwise this request has already been recorded
+    if exception is not None:
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.end_request(route, request.method, 500)
+
+
+def cached_page(key, data_names, render):
+    """
+    Respond with a page from the rendered page cache, or 304 Not Modified if the browser already has it.
+    The page must not depend on who is logged in.
+    """
+    body, etag = get_cached_page(get_db, key, data_names, render)
+
+    response = make_response(body)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+
+    return response.make_conditional(request)
+
 
 def logged_in(func):
     @wraps(func)
@@ -62,7 +126,7 @@ def register():
         password = request.form['password']
 
         # Check if account exists
-        user = db.get_user(mysql.connection, name)
+        user = db.get_user(get_db(), name)
 
         # If account exists show error and validation checks
         if user:
@@ -76,7 +140,7 @@ def register():
             salt, password_hash, hash_algo, iterations = create_secure_password(password, app.secret_key)
 
             # Account doesn't exist, and the form data is valid, so insert the new account into the accounts table
-            db.create_user(mysql.connection, name, password_hash, salt, hash_algo, iterations)
+            db.create_user(get_db(), name, password_hash, salt, hash_algo, iterations)
             return render_template('login.html', msg='You have successfully registered!')
 
     elif request.method == 'POST':
@@ -97,7 +161,7 @@ def login():
         password = request.form['password']
 
         # Check if user exists
-        user = db.get_user(mysql.connection, name)
+        user = db.get_user(get_db(), name)
 
         if not user:
             # Account doesn't exist
@@ -144,7 +208,8 @@ def unpick():
     if request.method == 'POST' and "name" in request.form and "pick" in request.form:
         name = request.form['name']
         player_pick = request.form['pick']
-        db.remove_pick(mysql.connection, name, player_pick)
+        db.remove_pick(get_db(), name, player_pick)
+        live_hub.wake()
         return redirect(url_for("leaderboard"))
     
     elif request.method == "POST":
@@ -160,36 +225,23 @@ def pick():
 
     if request.method == 'POST' and 'player' in request.form:
 
-        draft_order = db.get_draft_order(mysql.connection)
-
-        # Check to see if it's this users pick next
-        next_to_pick = db.get_next_to_pick(mysql.connection, draft_order)
+        player_info = db.get_player_info(get_db(), request.form['player'])
 
-        if next_to_pick != session["username"]:
-            msg = f"It's not your pick, wait for `{next_to_pick}` to pick"
+        if player_info is None:
+            msg = f"Can't find a player called `{request.form['player']}`"
 
         else:
-            # Check to see if we are allowed to pick this player (use gameweek 1 since this is the draft)
-            player_info = db.get_player_info(mysql.connection, request.form['player'])
-            player_existing_picks = db.get_user_gameweek_picks(mysql.connection, session["username"], 1)
-            all_existing_picks = db.get_all_gameweek_picks(mysql.connection, 1)
-            valid_pick, error_reason = validate_pick(player_info, player_existing_picks, all_existing_picks)
+            # Check it's this users pick next and that they are allowed this player, then add the pick
+            valid_pick, error_reason = db.claim_draft_pick(get_db(), session["user_id"], session["username"], player_info)
 
             if not valid_pick:
                 msg = error_reason
             else:
-                db.add_draft_pick(mysql.connection, session["username"], player_info["name"])
-
-                next_to_pick = db.get_next_to_pick(mysql.connection, draft_order)
-                if next_to_pick is not None:
-                    send_telegram_message(f"Waiting for `{next_to_pick}` to pick...")
-                else:
-                    send_telegram_message("The draft is complete. Good luck!")
-
-
+                notification_worker.wake()
+                live_hub.wake()
                 return redirect(url_for("standings"))
 
-    all_players = db.get_all_players(mysql.connection)
+    all_players = db.get_all_players(get_db())
 
     return render_template(
         template_name_or_list="pick.html",
@@ -203,16 +255,8 @@ def pick():
 def events():
     return render_template(
         template_name_or_list="events.html",
-        events=(
-            pd.DataFrame()
-            .to_html(
-                index=False,
-                escape=False,
-                classes='events',
-                table_id="events"
-            )
-            .replace('border="1"', 'border="0"')
-        )
+        events=[],
+        columns=[]
     )
 
 @app.route("/transfer", methods=['GET', 'POST'])
@@ -220,34 +264,38 @@ def events():
 def transfer():
 
     msg = ""
-    next_gameweek = db.get_next_gameweek(mysql.connection)
+    next_gameweek = db.get_next_gameweek(get_db())
 
     if request.method == 'POST':
         if 'player_in' in request.form and 'player_out' in request.form:
 
-            # Get the users team for the next gameweek
-            player_existing_picks = db.get_user_gameweek_picks(mysql.connection, session["username"], next_gameweek)
-
             # get info about the player we are transferring in and out
-            player_out_info = db.get_player_info(mysql.connection, request.form['player_out'])
-            player_in_info = db.get_player_info(mysql.connection, request.form['player_in'])
-
-            # Get all existing picks for all teams, and validate this transfer (after removing the player we are transferring out)
-            all_existing_picks = db.get_all_gameweek_picks(mysql.connection, next_gameweek)
-            player_existing_picks = [pick for pick in player_existing_picks if pick[1] != player_out_info["name"]]
-            valid_pick, error_reason = validate_pick(player_in_info, player_existing_picks, all_existing_picks)
+            player_out_info = db.get_player_info(get_db(), request.form['player_out'])
+            player_in_info = db.get_player_info(get_db(), request.form['player_in'])
 
-            if not valid_pick:
-                msg = error_reason
+            if player_out_info is None or player_in_info is None:
+                msg = "Can't find one of those players!"
             else:
-                db.make_transfer(mysql.connection, session["username"], player_in_info["name"], player_out_info["name"], next_gameweek)
-                return redirect(url_for("standings"))
+                # Get the users position counts for the next gameweek, after removing the player we are transferring out
+                position_counts = db.get_position_counts(get_db(), session["user_id"], next_gameweek)
+                position_counts[player_out_info["position"]] = position_counts.get(player_out_info["position"], 0) - 1
+
+                # Then validate this transfer against the picks of all teams
+                already_picked = db.is_player_picked(get_db(), player_in_info["player_id"], next_gameweek)
+                valid_pick, error_reason = validate_pick(player_in_info, position_counts, already_picked)
+
+                if not valid_pick:
+                    msg = error_reason
+                else:
+                    db.make_transfer(get_db(), session["user_id"], session["username"], player_in_info, player_out_info, next_gameweek)
+                    notification_worker.wake()
+                    return redirect(url_for("standings"))
         else:
             msg = "Please select a player to transfer in and out!"
 
-    user_players = db.get_user_gameweek_picks(mysql.connection, session["username"], next_gameweek)
+    user_players = db.get_user_gameweek_picks(get_db(), session["user_id"], next_gameweek)
     user_players = sorted([player[1] for player in user_players])
-    all_players = db.get_all_players(mysql.connection)
+    all_players = db.get_all_players(get_db())
     return render_template(template_name_or_list="transfer.html", user_players=user_players, players=all_players, msg=msg)
 
 
@@ -261,21 +309,14 @@ def rules():
 @logged_in
 def players():
     """Create players page"""
-    player_points = db.get_all_player_points(mysql.connection)
+    return cached_page(("players",), ["reference", "points"], render_players)
 
+
+def render_players():
     return render_template(
         template_name_or_list="players.html",
-        players=(
-            player_points
-            .to_html(
-                index=False,
-                escape=False,
-                classes='players',
-                table_id="players",
-                #formatters={"Player": create_path_to_image_html}
-            )
-            .replace('border="1"', 'border="0"')
-        )
+        players=db.get_all_player_points(get_db()),
+        columns=["Name", "Position", "TeamName", "TotalPoints"]
     )
 
 
@@ -284,14 +325,33 @@ def players():
 def standings():
     """Create standings page"""
     gameweek = int(request.args.get("gameweek", 1))
-    standings = db.get_standings(mysql.connection)
-    standings = standings[standings["Gameweek"] == gameweek]
 
-    # Group by name and aggregate player dicts
+    return cached_page(("standings", gameweek), ["reference", "picks", "points"], lambda: render_standings(gameweek))
+
+
+def render_standings(gameweek):
+    standings = db.get_standings(get_db(), gameweek)
+
+    # Season totals are summed by the database, grouped by user and gameweek
+    season_points = {}
+    for total in db.get_gameweek_totals(get_db()):
+        season_points[total["Name"]] = season_points.get(total["Name"], 0) + total["Points"]
+
+    # Group by name and aggregate player dicts, standings are already sorted by points
+    players_by_name = {}
+    for player in standings:
+        players_by_name.setdefault(player["Name"], []).append(player)
+
     gameweek_standings = []
-    for name, df in standings.groupby("Name"):
-        players = df[["Player", "Position", "Headshot", "Points"]].to_dict(orient="records")
-        gameweek_standings.append({"Name": name, "players": players, "TotalPoints": df["Points"].sum()})
+    for name, players in sorted(players_by_name.items()):
+        gameweek_standings.append({
+            "Name": name, 
+            "players": players, 
+            "TotalPoints": sum(player["Points"] for player in players), 
+            "SeasonPoints": season_points.get(name, 0)
+        })
+
+    gameweek_standings = sorted(gameweek_standings, key=lambda team: team["TotalPoints"], reverse=True)
 
     return render_template(
         template_name_or_list="standings.html",
@@ -305,7 +365,7 @@ def standings():
 def setup():
     """
     Setup data and create draft order.
-    USE CAREFULLY - THIS WILL DELETE ALL DATA IN TABLES AND REFRESH
+    USE CAREFULLY - THIS WILL DELETE ALL DATA IN TABLES AND REFRESH, unless the incremental sync mode is chosen
     """
     msg = ""
 
@@ -316,13 +376,124 @@ def setup():
         else:
             league_id = request.form['league_id']
             year = request.form['year']
-            msg = db.initialize_tables(mysql.connection, league_id, year, refresh=True)
-            msg += db.set_draft_order(mysql.connection)
+
+            # Sync only picks up squad changes, leaving the draft, picks and points as they are
+            if request.form.get('mode') == 'sync':
+                team_ids = [int(team_id) for team_id in request.form.get('team_ids', '').split(',') if team_id.strip()]
+                msg = db.sync_reference_data(get_db(), league_id, year, team_ids or None)
+            else:
+                msg = db.initialize_tables(get_db(), league_id, year, refresh=True)
+                msg += db.set_draft_order(get_db())
 
     return render_template(
         template_name_or_list="setup.html",
         msg=msg
     )
 
+@app.route("/stream")
+@logged_in
+def stream():
+    """Server-sent events of draft picks, whose turn it is and live points, see static/live.js"""
+    if not LIVE_STREAMING:
+        # No Content tells EventSource to stop reconnecting, the page polls /live instead
+        return "", 204
+
+    return Response(
+        live_hub.stream(live_hub.subscribe()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route("/live")
+@logged_in
+def live():
+    """
+    The live board events since the `since` cursor in the query string, for browsers polling instead of streaming.
+    Answered from the live hub's memory, so polling doesn't read the database, see LiveHub.poll
+    """
+    since, events = live_hub.poll(request.args.get("since"))
+
+    return {"since": since, "events": [[event, data] for event, data in events]}
+
+
+@app.route("/pool")
+@logged_in
+def pool_stats():
+    """Show database connection pool usage, to help size the pool"""
+    if session["username"] != "Tom":
+        return redirect(url_for("standings"))
+
+    return pool.stats()
+
+
+@app.route("/metrics")
+@logged_in
+def metrics_page():
+    """Request, query and external call metrics in the Prometheus text format"""
+    if session["username"] != "Tom":
+        return redirect(url_for("standings"))
+
+    gauges = {
+        f"draft_pool_{name}": (f"Database connection pool {name.replace('_', ' ')}", value)
+        for name, value in pool.stats().items()
+    }
+
+    return Response(metrics.render_prometheus(gauges), mimetype="text/plain; version=0.0.4")
+
+# Templates compiled by warm_up, so the first page loads don't have to
+WARMUP_TEMPLATES = ["layout.html", "table.html", "standings.html", "pick.html", "players.html", "transfer.html"]
+
+
+def warm_up():
+    """
+    Get a new instance ready before users hit it: load secrets, open db connections, load the reference data and
+    compile the templates. Returns the number of milliseconds each step took, and the errors of any that failed.
+    """
+    def open_connections():
+        pool.fill()
+
+    def load_reference_data():
+        conn = pool.get()
+        try:
+            get_reference_data(conn)
+        finally:
+            pool.put(conn)
+
+    def compile_templates():
+        for template in WARMUP_TEMPLATES:
+            app.jinja_env.get_template(template)
+
+    steps = [
+        ("secrets", lambda: load_secrets(secret_names)),
+        ("db_connections", open_connections),
+        ("reference_data", load_reference_data),
+        ("templates", compile_templates),
+    ]
+
+    timings, errors = {}, {}
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            errors[name] = str(e)
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    print(f"Warmed up in {sum(timings.values()):.0f} ms: {timings}" + (f", errors: {errors}" if errors else ""))
+
+    return timings, errors
+
+
+@app.route("/_ah/warmup")
+def warmup():
+    """Called by App Engine when it starts a new instance, before sending it any traffic"""
+    timings, errors = warm_up()
+
+    return {"timings_ms": timings, "errors": errors}, 500 if errors else 200
+
+
 if __name__ == "__main__":
+    # Local servers don't get warmup requests
+    warm_up()
     app.run(host="127.0.0.1", port=8080, debug=True)
@@ -0,0 +1,145 @@
+"""
+Live scoring worker, updates the points tables while games are in progress.
+
+It only wakes up around kick off times, and while games are live it spaces out its polls so the day's remaining API
+calls, counted in the ledger shared with the website, last until the last live game has finished.
+
+Usage:
+    python scoring_worker.py [--once] [--replay DIR]
+
+With --replay, events and lineups are read from recorded API responses in DIR instead of calling the API, one
+`<fixture_id>_events.json` and `<fixture_id>_lineups.json` file per fixture holding the `response` list of the
+`fixtures/events` and `fixtures/lineups` endpoints.
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+from datetime import datetime, timedelta
+import db
+from utils.api_cache import get_calls_today
+from utils.database import get_pool
+from utils.utils import get_current_time
+from utils.config import (
+    API_REQUESTS_PER_DAY,
+    API_CACHE_TTL_SECONDS,
+    LIVE_GAME_HOURS,
+    SCORING_MIN_POLL_SECONDS,
+    SCORING_MAX_SLEEP_SECONDS,
+    SCORING_QUOTA_RESERVE
+)
+
+
+def get_poll_interval(num_live_games, live_until: datetime, current_time: datetime, calls_remaining):
+    """
+    Get the number of seconds between polls so the remaining API calls last until the live games finish. Each poll
+    fetches the events of every live game, and their lineups once the cached ones are older than their cache TTL.
+    Returns None if there aren't enough calls left for another poll.
+    """
+    if calls_remaining is None:
+        return SCORING_MIN_POLL_SECONDS
+
+    seconds_left = max((live_until - current_time).total_seconds(), 0)
+
+    # Set aside the lineup calls first, each game refetches them at most once per cache TTL
+    lineup_calls = num_live_games * max(1, math.ceil(seconds_left / API_CACHE_TTL_SECONDS["fixtures/lineups"]))
+    polls_remaining = (calls_remaining - lineup_calls) // num_live_games
+    if polls_remaining <= 0:
+        return None
+
+    return max(SCORING_MIN_POLL_SECONDS, seconds_left / polls_remaining)
+
+
+def poll(conn, current_time: datetime, feed=None, calls_remaining=None):
+    """Update the points of every live game, returns the number of seconds to sleep before polling again"""
+    games = db.get_games_between(
+        conn,
+        current_time - timedelta(hours=LIVE_GAME_HOURS),
+        current_time + timedelta(seconds=SCORING_MAX_SLEEP_SECONDS)
+    )
+    live_games = [game_id for game_id, start_time in games if start_time <= current_time]
+    upcoming_kick_offs = [start_time for _, start_time in games if start_time > current_time]
+
+    # Nothing is live, so sleep until the next kick off
+    if not live_games:
+        if upcoming_kick_offs:
+            return (upcoming_kick_offs[0] - current_time).total_seconds()
+        return SCORING_MAX_SLEEP_SECONDS
+
+    for fixture_id in live_games:
+        db.update_points_for_fixture(conn, fixture_id, feed)
+    print(f"{current_time}: updated points for fixtures {live_games}")
+
+    live_until = games[-1][1] + timedelta(hours=LIVE_GAME_HOURS)
+    interval = get_poll_interval(len(live_games), live_until, current_time, calls_remaining)
+
+    if interval is None:
+        print(f"Not enough API calls left today to poll {len(live_games)} live games")
+        return SCORING_MAX_SLEEP_SECONDS
+
+    return interval
+
+
+class RecordedFeed:
+    """Reads fixture events and lineups from recorded API responses, in place of `utils.api`"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def load(self, fixture_id, endpoint):
+        path = os.path.join(self.directory, f"{fixture_id}_{endpoint}.json")
+        if not os.path.exists(path):
+            return []
+
+        with open(path) as f:
+            return json.load(f)
+
+    def get_all_events_for_fixture(self, fixture_id):
+        from utils.api import parse_fixture_events
+        return parse_fixture_events(fixture_id, self.load(fixture_id, "events"))
+
+    def get_fixture_lineups(self, fixture_id):
+        from utils.api import parse_fixture_lineups
+        return parse_fixture_lineups(fixture_id, self.load(fixture_id, "lineups"))
+
+
+def run(pool, feed=None, once=False):
+    while True:
+        conn = None
+        try:
+            # Recorded feeds don't use any API calls, the API is shared with the website so count every process's calls
+            if feed is None:
+                calls_remaining = API_REQUESTS_PER_DAY - SCORING_QUOTA_RESERVE - get_calls_today()
+            else:
+                calls_remaining = None
+
+            conn = pool.get()
+            sleep_seconds = poll(conn, get_current_time(), feed, calls_remaining)
+        except Exception as e:
+            # The API erroring after its retries, running out of calls with nothing cached or a database error mustn't
+            # stop scoring for the rest of the match, so try again soon. The connection may be broken, so don't reuse it
+            if conn is not None:
+                pool.discard(conn)
+            if once:
+                raise
+
+            print(f"Polling live games failed: {e}")
+            sleep_seconds = SCORING_MIN_POLL_SECONDS
+        else:
+            pool.put(conn)
+
+        if once:
+            return
+
+        time.sleep(min(sleep_seconds, SCORING_MAX_SLEEP_SECONDS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update points for live games")
+    parser.add_argument("--once", action="store_true", help="Poll once and exit, e.g. when run from cron")
+    parser.add_argument("--replay", help="Directory of recorded fixture events to use instead of the API")
+    args = parser.parse_args()
+
+    run(get_pool(), RecordedFeed(args.replay) if args.replay else None, once=args.once)
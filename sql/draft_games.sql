@@ -27,6 +27,7 @@ CREATE TABLE `games` (
   `home_team_id` INT NOT NULL,
   `away_team_id` INT NOT NULL,
   `start_time` DATETIME NOT NULL,
+  `gameweek_id` int NOT NULL,
   PRIMARY KEY (`game_id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
 /*!40101 SET character_set_client = @saved_cs_client */;
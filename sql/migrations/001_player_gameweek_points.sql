@@ -0,0 +1,17 @@
+-- Materialized points per player per gameweek, maintained by db.update_points_for_fixture
+CREATE TABLE IF NOT EXISTS `player_gameweek_points` (
+  `gameweek_id` int NOT NULL,
+  `player_id` int NOT NULL,
+  `points` int NOT NULL DEFAULT '0',
+  PRIMARY KEY (`gameweek_id`,`player_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- Backfill from the points already stored, standings only read this table (same as db.rebuild_player_gameweek_points)
+DELETE FROM `player_gameweek_points`;
+
+INSERT INTO `player_gameweek_points` (`gameweek_id`, `player_id`, `points`)
+SELECT `g`.`gameweek_id`, `po`.`player_id`, SUM(`e`.`value`)
+FROM `points` `po`
+  INNER JOIN `games` `g` ON `g`.`game_id` = `po`.`fixture_id`
+  INNER JOIN `events` `e` ON `e`.`event_id` = `po`.`event_id`
+GROUP BY `g`.`gameweek_id`, `po`.`player_id`;
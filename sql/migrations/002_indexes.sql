@@ -0,0 +1,25 @@
+-- A player can only be picked once per gameweek, and most pick lookups are by user and gameweek
+ALTER TABLE `picks`
+  ADD UNIQUE KEY `uq_picks_gameweek_player` (`gameweek_id`,`player_id`),
+  ADD KEY `ix_picks_user_gameweek` (`user_id`,`gameweek_id`);
+
+-- Points are filtered by fixture when ingesting events and joined by player for totals
+ALTER TABLE `points`
+  ADD KEY `ix_points_fixture_time` (`fixture_id`,`event_time`),
+  ADD KEY `ix_points_player` (`player_id`);
+
+ALTER TABLE `player_gameweek_points`
+  ADD KEY `ix_player_gameweek_points_player` (`player_id`);
+
+-- Users and players are looked up by name on every pick and transfer.
+-- Player names are not unique across squads, so that index can't be unique.
+ALTER TABLE `users`
+  ADD UNIQUE KEY `uq_users_name` (`name`);
+
+ALTER TABLE `players`
+  ADD KEY `ix_players_name` (`name`);
+
+-- Games are looked up by gameweek when attributing points and by kick off time when finding live games
+ALTER TABLE `games`
+  ADD KEY `ix_games_gameweek` (`gameweek_id`),
+  ADD KEY `ix_games_start_time` (`start_time`);
@@ -0,0 +1,8 @@
+-- Version counters for cached data, each process reloads its caches when a counter changes
+CREATE TABLE IF NOT EXISTS `data_versions` (
+  `name` varchar(50) NOT NULL,
+  `version` int NOT NULL DEFAULT '0',
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+INSERT IGNORE INTO `data_versions` (`name`, `version`) VALUES ('reference', 0);
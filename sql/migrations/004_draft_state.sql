@@ -0,0 +1,10 @@
+-- Persistent draft pick counter, so whose turn it is can be worked out without counting picks
+CREATE TABLE IF NOT EXISTS `draft_state` (
+  `draft_state_id` int NOT NULL DEFAULT '1',
+  `pick_number` int NOT NULL DEFAULT '0',
+  PRIMARY KEY (`draft_state_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- Draft picks are copied into every gameweek, so count the picks in a single gameweek
+INSERT IGNORE INTO `draft_state` (`draft_state_id`, `pick_number`)
+SELECT 1, COUNT(*) FROM `picks` WHERE `gameweek_id` = (SELECT MIN(`gameweek_id`) FROM `picks`);
@@ -0,0 +1,30 @@
+-- Store each pick once with the range of gameweeks the user owns the player for,
+-- instead of a copy of every squad in every gameweek
+CREATE TABLE `picks_ranged` (
+  `pick_id` int NOT NULL AUTO_INCREMENT,
+  `user_id` int NOT NULL,
+  `player_id` int NOT NULL,
+  `from_gameweek_id` int NOT NULL,
+  `to_gameweek_id` int NOT NULL,
+  PRIMARY KEY (`pick_id`),
+  KEY `ix_picks_range` (`from_gameweek_id`,`to_gameweek_id`),
+  KEY `ix_picks_user_range` (`user_id`,`from_gameweek_id`,`to_gameweek_id`),
+  KEY `ix_picks_player_range` (`player_id`,`from_gameweek_id`,`to_gameweek_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- Collapse runs of consecutive gameweeks into a single range (a player can be transferred out and back in again)
+INSERT INTO `picks_ranged` (`user_id`, `player_id`, `from_gameweek_id`, `to_gameweek_id`)
+SELECT `user_id`, `player_id`, MIN(`gameweek_id`), MAX(`gameweek_id`)
+FROM (
+  SELECT
+    `user_id`,
+    `player_id`,
+    `gameweek_id`,
+    `gameweek_id` - ROW_NUMBER() OVER (PARTITION BY `user_id`, `player_id` ORDER BY `gameweek_id`) AS `run`
+  FROM `picks`
+) `runs`
+GROUP BY `user_id`, `player_id`, `run`;
+
+RENAME TABLE `picks` TO `picks_by_gameweek`, `picks_ranged` TO `picks`;
+
+DROP TABLE `picks_by_gameweek`;
@@ -0,0 +1,4 @@
+-- Deterministic key of the API event each points row came from, so re-polling a fixture only inserts new events
+ALTER TABLE `points`
+  ADD COLUMN `event_key` varchar(40) NULL AFTER `event_time`,
+  ADD UNIQUE KEY `uq_points_fixture_event_key` (`fixture_id`,`event_key`);
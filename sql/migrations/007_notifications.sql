@@ -0,0 +1,15 @@
+-- Outbox of Telegram messages, written in the same transaction as the pick or transfer and sent by a background worker
+CREATE TABLE IF NOT EXISTS `notifications` (
+  `notification_id` int NOT NULL AUTO_INCREMENT,
+  `dedup_key` varchar(40) NOT NULL,
+  `text` varchar(4096) NOT NULL,
+  `status` varchar(10) NOT NULL DEFAULT 'pending',
+  `attempts` int NOT NULL DEFAULT '0',
+  `created_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `next_attempt_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `sent_at` datetime NULL,
+  `last_error` varchar(255) NULL,
+  PRIMARY KEY (`notification_id`),
+  KEY `ix_notifications_status_next_attempt` (`status`,`next_attempt_at`),
+  KEY `ix_notifications_dedup_key_status` (`dedup_key`,`status`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -0,0 +1,28 @@
+-- Football API responses and the daily call ledger, shared by every instance and the scoring worker, see utils/api_cache.py
+CREATE TABLE IF NOT EXISTS `api_responses` (
+  `cache_key` char(40) NOT NULL,
+  `endpoint` varchar(50) NOT NULL,
+  `params` varchar(255) NOT NULL,
+  `etag` varchar(255) NULL,
+  `fetched_at` datetime NOT NULL,
+  `body` mediumtext NOT NULL,
+  PRIMARY KEY (`cache_key`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+-- One row per UTC day, incremented to reserve each call
+CREATE TABLE IF NOT EXISTS `api_quota` (
+  `day` date NOT NULL,
+  `calls` int NOT NULL DEFAULT '0',
+  PRIMARY KEY (`day`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
+
+CREATE TABLE IF NOT EXISTS `api_calls` (
+  `call_id` int NOT NULL AUTO_INCREMENT,
+  `called_at` datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `day` date NOT NULL,
+  `endpoint` varchar(50) NOT NULL,
+  `params` varchar(255) NOT NULL,
+  `status` int NULL,
+  PRIMARY KEY (`call_id`),
+  KEY `ix_api_calls_day` (`day`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_0900_ai_ci;
@@ -0,0 +1,84 @@
+// Live draft board, updates the page from the /stream server-sent events instead of reloading it. Where responses
+// can't be streamed (App Engine standard) it polls /live every few seconds instead, see LIVE_STREAMING
+(function () {
+    var script = document.currentScript;
+    var banner = document.getElementById("live-banner");
+
+    function showBanner(text) {
+        if (banner) {
+            banner.textContent = text;
+            banner.style.display = text ? "block" : "none";
+        }
+    }
+
+    var handlers = {
+        turn: function (data) {
+            showBanner(data.next_to_pick ? "Waiting for " + data.next_to_pick + " to pick..." : "");
+        },
+
+        pick: function (data) {
+            // Players who have been picked can't be picked again
+            document.querySelectorAll("datalist#player option").forEach(function (option) {
+                if (option.value === data.player) {
+                    option.remove();
+                }
+            });
+        },
+
+        points: function (data) {
+            data.totals.forEach(function (total) {
+                document.querySelectorAll(".team-total[data-gameweek='" + data.gameweek + "']").forEach(function (element) {
+                    if (element.dataset.name === total.Name) {
+                        element.textContent = total.Points;
+                    }
+                });
+            });
+        }
+    };
+
+    if (script.dataset.streaming === "true" && window.EventSource) {
+        var source = new EventSource("/stream");
+
+        Object.keys(handlers).forEach(function (event) {
+            source.addEventListener(event, function (e) {
+                handlers[event](JSON.parse(e.data));
+            });
+        });
+        return;
+    }
+
+    if (!window.fetch) {
+        return;
+    }
+
+    var pollSeconds = Number(script.dataset.pollSeconds) || 10;
+    var since = null;
+
+    function poll() {
+        // Don't poll from tabs nobody is looking at, they catch up once they're shown again
+        if (document.hidden) {
+            setTimeout(poll, pollSeconds * 1000);
+            return;
+        }
+
+        // Only the events after the last one we saw, or the whole board the first time
+        fetch("/live" + (since ? "?since=" + encodeURIComponent(since) : ""), {credentials: "same-origin"})
+            .then(function (response) {
+                return response.ok ? response.json() : null;
+            })
+            .then(function (board) {
+                if (board) {
+                    since = board.since;
+                    board.events.forEach(function (item) {
+                        handlers[item[0]](item[1]);
+                    });
+                }
+            })
+            .catch(function () {})
+            .then(function () {
+                setTimeout(poll, pollSeconds * 1000);
+            });
+    }
+
+    poll();
+})();
@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+
+class FakeServer:
+    """Local HTTP server standing in for an external API, replies with queued responses and records every request"""
+
+    def __init__(self):
+        self.responses = []
+        self.requests = []  # (method, path, headers, body, time received)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self.make_handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_port}"
+
+    def reply(self, status=200, body=None, headers=None, delay=0):
+        """Queue a response, sent `delay` seconds after the request. With nothing queued the reply is 200 {}"""
+        self.responses.append((status, body if body is not None else {}, headers or {}, delay))
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length)) if length else None
+
+                with server._lock:
+                    server.requests.append((self.command, self.path, dict(self.headers), body, time.monotonic()))
+                    status, response, headers, delay = server.responses.pop(0) if server.responses else (200, {}, {}, 0)
+
+                if delay:
+                    threading.Event().wait(delay)
+
+                data = json.dumps(response).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    for name, value in headers.items():
+                        self.send_header(name, value)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client gave up waiting, e.g. a timeout test
+                    pass
+
+            do_GET = handle_request
+            do_POST = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def fake_server():
+    server = FakeServer()
+    server.start()
+    yield server
+    server.stop()
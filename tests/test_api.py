@@ -0,0 +1,203 @@
+import socket
+import threading
+from types import SimpleNamespace
+import pytest
+import requests
+import utils.api
+from utils.api import RateLimiter, api_get
+from utils.api_cache import QuotaExceeded, get_cache_key
+from utils.config import API_MAX_RETRIES
+
+
+class FakeCache:
+    """In-memory stand-in for the api_responses table, keeps (body, etag, age in seconds) per request"""
+
+    def __init__(self):
+        self.responses = {}
+
+    def add(self, endpoint, params, body, etag=None, age=0):
+        self.responses[get_cache_key(endpoint, params)] = (body, etag, age)
+
+    def get(self, endpoint, params):
+        return self.responses.get(get_cache_key(endpoint, params))
+
+
+@pytest.fixture
+def api(monkeypatch, fake_server):
+    """Point the API at the fake server, with an in-memory ledger and no response cache, returns the ledger"""
+    ledger = []
+
+    def reserve_call(endpoint, params, daily_limit):
+        if len(ledger) >= daily_limit:
+            raise QuotaExceeded(f"Already made {daily_limit} of {daily_limit} API calls today")
+        ledger.append([endpoint, None])
+        return len(ledger) - 1
+
+    def record_call_status(call_id, status):
+        ledger[call_id][1] = status
+
+    monkeypatch.setenv("API_KEY", "test-key")
+    monkeypatch.setattr(utils.api, "API_URL", fake_server.url + "/")
+    monkeypatch.setattr(utils.api, "get_cached_response", lambda endpoint, params: None)
+    monkeypatch.setattr(utils.api, "set_cached_response", lambda endpoint, params, body, etag=None: None)
+    monkeypatch.setattr(utils.api, "reserve_call", reserve_call)
+    monkeypatch.setattr(utils.api, "record_call_status", record_call_status)
+    monkeypatch.setattr(utils.api, "RATE_LIMITER", RateLimiter(1000))
+
+    return ledger
+
+
+@pytest.fixture
+def cache(api, monkeypatch):
+    """An in-memory response cache for the API, on top of the `api` fixture"""
+    cache = FakeCache()
+    monkeypatch.setattr(utils.api, "get_cached_response", cache.get)
+    monkeypatch.setattr(utils.api, "set_cached_response", cache.add)
+    return cache
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the backoff sleeps instead of sleeping"""
+    sleeps = []
+    monkeypatch.setattr(utils.api, "time", SimpleNamespace(monotonic=utils.api.time.monotonic, sleep=sleeps.append))
+    return sleeps
+
+
+def ok(response):
+    return {"errors": [], "response": response}
+
+
+def test_retries_server_errors_with_backoff(api, sleeps, fake_server):
+    fake_server.reply(503)
+    fake_server.reply(502)
+    fake_server.reply(body=ok(["squad"]))
+
+    assert api_get("players/squads", {"team": 1}) == ["squad"]
+    assert sleeps == [5, 10]
+    assert [status for _, status in api] == [503, 502, 200]
+    assert fake_server.requests[0][2]["x-rapidapi-key"] == "test-key"
+
+
+def test_waits_as_long_as_retry_after_says(api, sleeps, fake_server):
+    fake_server.reply(429, headers={"Retry-After": "7"})
+    fake_server.reply(body=ok([]))
+
+    assert api_get("teams", {"league": 1, "season": 2022}) == []
+    assert sleeps == [7]
+
+
+def test_retries_rate_limit_errors_reported_in_the_body(api, sleeps, fake_server):
+    fake_server.reply(body={"errors": {"rateLimit": "Too many requests"}, "response": []})
+    fake_server.reply(body=ok(["fixture"]))
+
+    assert api_get("fixtures", {"league": 1, "season": 2022}) == ["fixture"]
+    assert sleeps == [5]
+
+
+def test_gives_up_after_the_last_retry(api, sleeps, fake_server):
+    for _ in range(API_MAX_RETRIES + 1):
+        fake_server.reply(500)
+
+    with pytest.raises(requests.HTTPError):
+        api_get("fixtures/events", {"fixture": 1})
+
+    assert len(fake_server.requests) == API_MAX_RETRIES + 1
+    assert [status for _, status in api] == [500] * (API_MAX_RETRIES + 1)
+
+
+def test_retries_timeouts(api, sleeps, fake_server, monkeypatch):
+    monkeypatch.setattr(utils.api, "API_TIMEOUT_SECONDS", 0.2)
+    fake_server.reply(body=ok(["late"]), delay=1)
+    fake_server.reply(body=ok(["event"]))
+
+    assert api_get("fixtures/events", {"fixture": 1}) == ["event"]
+    assert sleeps == [5]
+    assert [status for _, status in api] == [0, 200]
+
+
+def test_retries_connection_errors_then_raises(api, sleeps, monkeypatch):
+    # A port nothing is listening on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    monkeypatch.setattr(utils.api, "API_URL", f"http://127.0.0.1:{port}/")
+
+    with pytest.raises(requests.ConnectionError):
+        api_get("fixtures/events", {"fixture": 1})
+
+    assert sleeps == [5 * 2 ** attempt for attempt in range(API_MAX_RETRIES)]
+    assert [status for _, status in api] == [0] * (API_MAX_RETRIES + 1)
+
+
+def test_calls_are_spaced_out_by_the_rate_limiter(api, fake_server, monkeypatch):
+    monkeypatch.setattr(utils.api, "RATE_LIMITER", RateLimiter(2, period=0.5))
+    for _ in range(5):
+        fake_server.reply(body=ok([]))
+
+    # Fetched in parallel, like squads are
+    threads = [threading.Thread(target=api_get, args=("players/squads", {"team": team_id})) for team_id in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    received = sorted(request[4] for request in fake_server.requests)
+    assert len(received) == 5
+
+    # No more than 2 calls in any half second
+    for first, third in zip(received, received[2:]):
+        assert third - first >= 0.45
+
+
+def test_fresh_cached_responses_are_used_without_calling(api, cache, fake_server):
+    cache.add("fixtures/events", {"fixture": 1}, ["cached"], age=59)
+
+    assert api_get("fixtures/events", {"fixture": 1}) == ["cached"]
+    assert fake_server.requests == []
+    assert api == []
+
+
+def test_stale_responses_are_fetched_again_and_cached(api, cache, fake_server):
+    cache.add("fixtures/events", {"fixture": 1}, ["old"], age=61)
+    fake_server.reply(body=ok(["new"]), headers={"ETag": '"v2"'})
+
+    assert api_get("fixtures/events", {"fixture": 1}) == ["new"]
+    assert cache.get("fixtures/events", {"fixture": 1}) == (["new"], '"v2"', 0)
+    assert api == [["fixtures/events", 200]]
+
+
+def test_max_age_overrides_the_endpoints_ttl(api, cache, fake_server):
+    cache.add("players/squads", {"team": 1}, ["old squad"], age=60)
+    fake_server.reply(body=ok(["new squad"]))
+
+    assert api_get("players/squads", {"team": 1}, max_age=30) == ["new squad"]
+
+
+def test_not_modified_reuses_the_cached_response(api, cache, fake_server):
+    cache.add("fixtures/lineups", {"fixture": 1}, ["lineup"], etag='"v1"', age=2 * 60 * 60)
+    fake_server.reply(304)
+
+    assert api_get("fixtures/lineups", {"fixture": 1}) == ["lineup"]
+    assert fake_server.requests[0][2]["If-None-Match"] == '"v1"'
+
+    # Fresh again, so the next call doesn't use up another API call
+    assert cache.get("fixtures/lineups", {"fixture": 1}) == (["lineup"], '"v1"', 0)
+    assert api == [["fixtures/lineups", 304]]
+
+
+def test_stale_response_is_used_once_out_of_calls(api, cache, fake_server, monkeypatch):
+    monkeypatch.setattr(utils.api, "API_REQUESTS_PER_DAY", 0)
+    cache.add("fixtures", {"league": 1, "season": 2022}, ["fixtures"], age=7 * 60 * 60)
+
+    assert api_get("fixtures", {"league": 1, "season": 2022}) == ["fixtures"]
+    assert fake_server.requests == []
+
+
+def test_out_of_calls_with_nothing_cached_raises(api, cache, fake_server, monkeypatch):
+    monkeypatch.setattr(utils.api, "API_REQUESTS_PER_DAY", 0)
+
+    with pytest.raises(QuotaExceeded):
+        api_get("fixtures/lineups", {"fixture": 1})
+
+    assert fake_server.requests == []
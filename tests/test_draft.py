@@ -0,0 +1,233 @@
+"""
+Draft picks under concurrency, against a stand-in for MySQL that behaves like InnoDB where it matters: a transaction's
+plain reads see the snapshot taken at its first plain read (REPEATABLE READ), while SELECT ... FOR UPDATE waits for
+the row lock and reads the latest committed row.
+"""
+
+import copy
+import random
+import re
+import threading
+from datetime import datetime
+import pytest
+import db
+import utils.cache
+from utils.cache import ReferenceData
+from utils.config import NUM_PICKS, MAX_PICKS, MIN_PICKS
+
+USERS = ["Alice", "Bob", "Carol", "Dan", "Erin"]
+POSITIONS = ["Goalkeeper", "Defender", "Midfielder", "Attacker"]
+PLAYERS = [(player_id, f"Player {player_id}", POSITIONS[player_id % 4], None, 1) for player_id in range(1, 121)]
+GAMEWEEKS = [(1, "Group Stage - 1", datetime(2022, 11, 20), datetime(2022, 11, 24)), (2, "Group Stage - 2", datetime(2022, 11, 24), datetime(2022, 11, 28))]
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.committed = {"pick_number": 0, "picks": [], "versions": {}}
+        self.positions = {player[0]: player[2] for player in PLAYERS}
+        self.condition = threading.Condition()
+        self.draft_state_owner = None
+
+    def connect(self):
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+        self.snapshot = None
+        self.writes = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def read(self, locking=False):
+        """The rows this transaction sees, with its own uncommitted writes applied"""
+        with self.database.condition:
+            if locking:
+                # Wait for the draft state row lock, then read the latest committed rows
+                while self.database.draft_state_owner not in (None, self):
+                    self.database.condition.wait()
+                self.database.draft_state_owner = self
+                state = copy.deepcopy(self.database.committed)
+            else:
+                if self.snapshot is None:
+                    self.snapshot = copy.deepcopy(self.database.committed)
+                state = copy.deepcopy(self.snapshot)
+
+        for write in self.writes:
+            write(state)
+
+        return state
+
+    def end(self, apply):
+        with self.database.condition:
+            if apply:
+                for write in self.writes:
+                    write(self.database.committed)
+            if self.database.draft_state_owner is self:
+                self.database.draft_state_owner = None
+            self.database.condition.notify_all()
+
+        self.snapshot = None
+        self.writes = []
+
+    def commit(self):
+        self.end(apply=True)
+
+    def rollback(self):
+        self.end(apply=False)
+
+
+class FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, args=()):
+        query = re.sub(r"\s+", " ", query).strip()
+        writes = self.connection.writes
+
+        if query == "SELECT pick_number FROM draft_state WHERE draft_state_id = 1 FOR UPDATE":
+            self.rows = [(self.connection.read(locking=True)["pick_number"],)]
+
+        elif query.startswith("SELECT version FROM data_versions"):
+            versions = self.connection.read()["versions"]
+            self.rows = [(versions[args[0]],)] if args[0] in versions else []
+
+        elif query.startswith("SELECT pl.position, COUNT(*)"):
+            user_id, gameweek_id = args
+            counts = {}
+            for pick_user_id, player_id, from_gameweek_id, to_gameweek_id in self.connection.read()["picks"]:
+                if pick_user_id == user_id and from_gameweek_id <= gameweek_id <= to_gameweek_id:
+                    position = self.connection.database.positions[player_id]
+                    counts[position] = counts.get(position, 0) + 1
+            self.rows = list(counts.items())
+
+        elif query.startswith("SELECT 1 FROM picks WHERE player_id = %s"):
+            player_id, gameweek_id = args
+            self.rows = [
+                (1,) for pick in self.connection.read()["picks"] if pick[1] == player_id and pick[2] <= gameweek_id <= pick[3]
+            ][:1]
+
+        elif query == "SELECT player_id FROM picks":
+            self.rows = [(pick[1],) for pick in self.connection.read()["picks"]]
+
+        elif query.startswith("INSERT INTO picks"):
+            writes.append(lambda state, pick=tuple(args): state["picks"].append(pick))
+
+        elif query.startswith("UPDATE draft_state SET pick_number = %s"):
+            self.connection.read(locking=True)
+            writes.append(lambda state, pick_number=args[0]: state.update(pick_number=pick_number))
+
+        elif query.startswith("INSERT INTO data_versions"):
+            writes.append(lambda state, name=args[0]: state["versions"].update({name: state["versions"].get(name, 0) + 1}))
+
+        elif query.startswith("INSERT INTO notifications"):
+            pass
+
+        else:
+            raise AssertionError(f"Unexpected query: {query}")
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """A fresh draft, with the reference data re-checked on every read like a request after REFERENCE_CHECK_SECONDS"""
+    draft = [(name, draft_id) for draft_id, name in enumerate(USERS, start=1)]
+    monkeypatch.setattr(utils.cache, "_reference_data", None)
+    monkeypatch.setattr(utils.cache, "REFERENCE_CHECK_SECONDS", 0)
+    monkeypatch.setattr(
+        utils.cache, "load_reference_data", lambda conn, version: ReferenceData(version, PLAYERS, [], GAMEWEEKS, [], draft)
+    )
+
+    return FakeDatabase()
+
+
+def pick(conn, name, player_name):
+    """Pick a player the way the /pick page does"""
+    player_info = db.get_player_info(conn, player_name)
+    return db.claim_draft_pick(conn, USERS.index(name) + 1, name, player_info)
+
+
+def test_pick_sees_picks_committed_while_waiting_for_the_lock(database):
+    alice, bob = database.connect(), database.connect()
+
+    # Bob loads the pick page before Alice's pick is committed, which starts his transaction's snapshot
+    db.get_all_players(bob)
+
+    assert pick(alice, "Alice", "Player 1").valid
+
+    # It's now Bob's turn, but Alice already has the player
+    validation = pick(bob, "Bob", "Player 1")
+
+    assert not validation.valid
+    assert validation.reason == "Player 1 has already been picked!"
+    assert len(database.committed["picks"]) == 1
+
+
+def choose_player(conn, user_id):
+    """Choose the first player that looks free, from this connection's (possibly stale) view of the picks"""
+    picked = {player_id for player_id, in read_all(conn, "SELECT player_id FROM picks")}
+    counts = db.get_position_counts(conn, user_id, 1)
+
+    needed = [position for position in POSITIONS if counts.get(position, 0) < MIN_PICKS[position]]
+    allowed = needed or [position for position in POSITIONS if counts.get(position, 0) < MAX_PICKS[position]]
+
+    return next(player for player in PLAYERS if player[2] in allowed and player[0] not in picked)[1]
+
+
+def read_all(conn, query):
+    with conn.cursor() as cursor:
+        cursor.execute(query)
+        return cursor.fetchall()
+
+
+def test_simultaneous_picks_never_pick_a_player_twice(database):
+    num_picks = len(USERS) * NUM_PICKS
+    errors = []
+
+    def draft(name):
+        conn = database.connect()
+        rng = random.Random(name)
+
+        try:
+            while database.committed["pick_number"] < num_picks:
+                player_name = choose_player(conn, USERS.index(name) + 1)
+
+                # Give the other users a chance to pick while this view goes stale
+                threading.Event().wait(rng.random() / 1000)
+
+                pick(conn, name, player_name)
+                conn.rollback()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=draft, args=(name,)) for name in USERS for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+
+    assert not errors
+    assert not any(thread.is_alive() for thread in threads)
+
+    picks = database.committed["picks"]
+    player_ids = [player_id for _, player_id, _, _ in picks]
+
+    assert database.committed["pick_number"] == num_picks
+    assert len(picks) == num_picks
+    assert len(set(player_ids)) == num_picks, "a player was picked twice"
+    for user_id in range(1, len(USERS) + 1):
+        assert sum(1 for pick_user_id, _, _, _ in picks if pick_user_id == user_id) == NUM_PICKS
@@ -0,0 +1,240 @@
+import threading
+import time
+import pytest
+import db
+import utils.live
+from utils.live import LiveHub, format_event
+from utils.config import LIVE_QUEUE_SIZE
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, args=None):
+        self.conn.queries.append((" ".join(query.split()), args))
+        self.result = self.conn.results.pop(0)
+
+    def fetchone(self):
+        return self.result
+
+    def fetchall(self):
+        return self.result
+
+
+class FakeConnection:
+    """Returns the queued results, one per query"""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.queries = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+class FakePool:
+    def get(self):
+        return object()
+
+    def put(self, conn):
+        pass
+
+    def discard(self, conn):
+        pass
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    monkeypatch.setattr(utils.live, "LIVE_STREAM_MAX_SECONDS", 5)
+    monkeypatch.setattr(utils.live, "LIVE_HEARTBEAT_SECONDS", 0.05)
+
+    return LiveHub(FakePool(), lambda conn, state: (state, []), check_seconds=3600)
+
+
+def test_viewers_get_published_events(hub):
+    subscriber = hub.subscribe()
+    hub.publish("turn", {"pick_number": 1, "next_to_pick": "Bob"})
+
+    stream = hub.stream(subscriber)
+    assert next(stream).startswith("retry:")
+    assert next(stream) == format_event("turn", {"pick_number": 1, "next_to_pick": "Bob"})
+
+
+def test_new_viewers_start_with_the_latest_board(hub):
+    hub.subscribe()
+    hub.publish("turn", {"pick_number": 1, "next_to_pick": "Bob"})
+    hub.publish("turn", {"pick_number": 2, "next_to_pick": "Carol"})
+
+    assert hub.subscribe().get_nowait() == format_event("turn", {"pick_number": 2, "next_to_pick": "Carol"})
+
+
+def test_a_viewer_that_falls_behind_is_disconnected(hub):
+    subscriber = hub.subscribe()
+    for pick_number in range(LIVE_QUEUE_SIZE + 1):
+        hub.publish("turn", {"pick_number": pick_number, "next_to_pick": "Bob"})
+
+    assert hub.num_subscribers() == 0
+
+    # Their stream ends straight away, rather than sending heartbeats until LIVE_STREAM_MAX_SECONDS
+    start = time.monotonic()
+    messages = list(hub.stream(subscriber))
+
+    assert time.monotonic() - start < 1
+    assert ": heartbeat\n\n" not in messages
+
+
+def test_polls_get_the_events_since_their_cursor(hub):
+    hub.publish("turn", {"pick_number": 1, "next_to_pick": "Bob"})
+
+    # The first poll gets the whole board
+    since, events = hub.poll()
+    assert events == [("turn", {"pick_number": 1, "next_to_pick": "Bob"})]
+
+    hub.publish("pick", {"name": "Bob", "player": "Player 1"})
+    hub.publish("turn", {"pick_number": 2, "next_to_pick": "Carol"})
+
+    since, events = hub.poll(since)
+    assert events == [("pick", {"name": "Bob", "player": "Player 1"}), ("turn", {"pick_number": 2, "next_to_pick": "Carol"})]
+    assert hub.poll(since) == (since, [])
+
+
+def test_polls_the_hub_cant_continue_get_the_whole_board(monkeypatch):
+    monkeypatch.setattr(utils.live, "LIVE_LOG_SIZE", 2)
+    hub = LiveHub(FakePool(), lambda conn, state: (state, []), check_seconds=3600)
+    hub.publish("turn", {"pick_number": 1, "next_to_pick": "Bob"})
+    since, _ = hub.poll()
+
+    for pick_number in range(2, 5):
+        hub.publish("pick", {"name": "Bob", "player": f"Player {pick_number}"})
+        hub.publish("turn", {"pick_number": pick_number, "next_to_pick": "Bob"})
+    board = [("turn", {"pick_number": 4, "next_to_pick": "Bob"})]
+
+    # Too far behind, from another instance, or not a cursor at all
+    assert hub.poll(since)[1] == board
+    assert hub.poll("0123abcd:7")[1] == board
+    assert hub.poll("nonsense")[1] == board
+
+
+USERS = ["Alice", "Bob", "Carol"]
+NUM_STREAMING_VIEWERS = 200
+NUM_POLLING_VIEWERS = 300
+NUM_PICKS_MADE = 5
+
+
+class FakeDraft:
+    """The draft as get_events reads it, counting every read"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.picks = []
+        self.reads = 0
+
+    def pick(self, name, player):
+        with self.lock:
+            self.picks.append((name, player))
+
+    def get_events(self, conn, previous_state):
+        with self.lock:
+            self.reads += 1
+            picks = list(self.picks)
+
+        # The state is the number of picks made, new viewers start from the turn
+        events = []
+        if previous_state is not None:
+            events = [("pick", {"name": name, "player": player}) for name, player in picks[previous_state:]]
+        if previous_state != len(picks):
+            events.append(("turn", {"pick_number": len(picks), "next_to_pick": USERS[len(picks) % len(USERS)]}))
+
+        return len(picks), events
+
+
+def wait_for(condition, timeout=5):
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "Timed out"
+        time.sleep(0.001)
+
+
+def test_hundreds_of_viewers_share_one_read_per_change(monkeypatch):
+    monkeypatch.setattr(utils.live, "LIVE_HEARTBEAT_SECONDS", 0.05)
+    draft = FakeDraft()
+    hub = LiveHub(FakePool(), draft.get_events, check_seconds=3600)
+
+    # The first viewer loads the board, everyone after them starts from it
+    subscribers = [hub.subscribe()]
+    wait_for(lambda: draft.reads == 1)
+    subscribers += [hub.subscribe() for _ in range(NUM_STREAMING_VIEWERS - 1)]
+    polls = [hub.poll() for _ in range(NUM_POLLING_VIEWERS)]
+
+    board = [("turn", {"pick_number": 0, "next_to_pick": "Alice"})]
+    assert all(events == board for _, events in polls)
+
+    expected = list(board)
+    for pick_number in range(1, NUM_PICKS_MADE + 1):
+        expected.append(("pick", {"name": USERS[(pick_number - 1) % len(USERS)], "player": f"Player {pick_number}"}))
+        expected.append(("turn", {"pick_number": pick_number, "next_to_pick": USERS[pick_number % len(USERS)]}))
+
+    received = [[] for _ in subscribers]
+
+    def watch(subscriber, messages):
+        stream = hub.stream(subscriber)
+        for message in stream:
+            if message.startswith("event:"):
+                messages.append(message)
+            if len(messages) == len(expected):
+                break
+        stream.close()
+
+    threads = [threading.Thread(target=watch, args=args) for args in zip(subscribers, received)]
+    for thread in threads:
+        thread.start()
+
+    for pick_number in range(1, NUM_PICKS_MADE + 1):
+        draft.pick(USERS[(pick_number - 1) % len(USERS)], f"Player {pick_number}")
+        hub.wake()
+        wait_for(lambda: draft.reads == pick_number + 1)
+
+    for thread in threads:
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+
+    # Every streaming viewer got every event, in order
+    assert all(messages == [format_event(event, data) for event, data in expected] for messages in received)
+    assert hub.num_subscribers() == 0
+
+    # And every polling viewer catches up from their cursor
+    assert all(hub.poll(since)[1] == expected[1:] for since, _ in polls)
+
+    # The database was read once for the board and once per pick, however many were watching
+    assert draft.reads == 1 + NUM_PICKS_MADE
+
+
+def test_every_pick_since_the_last_check_is_sent(monkeypatch):
+    monkeypatch.setattr(db, "get_draft_order", lambda conn: ["Alice", "Bob", "Carol"])
+
+    # Two picks, then a transfer that doesn't move the draft on, all since the last check
+    conn = FakeConnection((3, 7, 12), [("Alice", "Player 10"), ("Bob", "Player 11"), ("Alice", "Player 12")])
+    state, events = db.get_live_events(conn, {"pick_number": 1, "points_version": 7, "pick_id": 9})
+
+    assert state == {"pick_number": 3, "points_version": 7, "pick_id": 12}
+    assert conn.queries[1][1] == (9,)
+    assert events == [
+        ("pick", {"name": "Alice", "player": "Player 10"}),
+        ("pick", {"name": "Bob", "player": "Player 11"}),
+        ("pick", {"name": "Alice", "player": "Player 12"}),
+        ("turn", {"pick_number": 3, "next_to_pick": "Carol"}),
+    ]
+
+
+def test_transfers_are_sent_without_a_new_turn():
+    conn = FakeConnection((3, 7, 13), [("Carol", "Player 13")])
+    state, events = db.get_live_events(conn, {"pick_number": 3, "points_version": 7, "pick_id": 12})
+
+    assert events == [("pick", {"name": "Carol", "player": "Player 13"})]
@@ -0,0 +1,78 @@
+import re
+import pytest
+from utils.migrations import HOT_QUERIES, explain_hot_queries, find_full_scans
+
+EXPLAIN_COLUMNS = ["id", "select_type", "table", "partitions", "type", "possible_keys", "key", "key_len", "ref", "rows", "filtered", "Extra"]
+
+
+def plan(table, access_type, key):
+    return (1, "SIMPLE", table, None, access_type, key, key, None, None, 10, 100.0, None)
+
+
+class FakeCursor:
+    """Replies to each EXPLAIN with the recorded plan for that query"""
+
+    def __init__(self, plans):
+        self.plans = plans
+        self.description = [(column,) for column in EXPLAIN_COLUMNS]
+        self.executed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, args=()):
+        self.executed.append((query, args))
+        self.rows = self.plans.pop(0)
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, plans):
+        self.cursor_ = FakeCursor(plans)
+
+    def cursor(self):
+        return self.cursor_
+
+
+def get_table_names(sql):
+    """Names EXPLAIN reports the tables of a query by, their alias if they have one"""
+    tables = re.findall(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?!ON\b|WHERE\b|INNER\b|LEFT\b|GROUP\b|AND\b)(\w+))?", sql, re.IGNORECASE)
+    return {alias or table for table, alias in tables}
+
+
+@pytest.mark.parametrize("query_name, sql, params, indexed_tables", HOT_QUERIES)
+def test_hot_queries_name_the_tables_they_read(query_name, sql, params, indexed_tables):
+    assert set(indexed_tables) <= get_table_names(sql)
+    assert sql.count("%s") == len(params)
+
+
+def test_reads_through_an_index_pass():
+    plans = [dict(zip(EXPLAIN_COLUMNS, plan("pi", "ref", "ix_picks_user_range"))), dict(zip(EXPLAIN_COLUMNS, plan("pl", "eq_ref", "PRIMARY")))]
+
+    assert find_full_scans(plans, ["pi", "pl"]) == []
+
+
+def test_full_scans_of_indexed_tables_are_reported():
+    plans = [dict(zip(EXPLAIN_COLUMNS, plan("pi", "ALL", None))), dict(zip(EXPLAIN_COLUMNS, plan("pl", "ALL", None)))]
+
+    # A scan of a table that isn't listed, e.g. picks filtered only by gameweek, is left to MySQL
+    assert find_full_scans(plans, ["pl"]) == ["pl"]
+
+
+def test_explain_checks_every_hot_query():
+    # Standings scan picks, which is expected, and players, which isn't. Everything else uses its indexes
+    plans = []
+    for query_name, sql, params, indexed_tables in HOT_QUERIES:
+        if query_name == "get_standings":
+            plans.append([plan("pi", "ALL", None), plan("u", "eq_ref", "PRIMARY"), plan("pl", "ALL", None), plan("pgp", "eq_ref", "PRIMARY")])
+        else:
+            plans.append([plan(table, "ref", "an_index") for table in indexed_tables])
+    conn = FakeConnection(plans)
+
+    assert explain_hot_queries(conn) == [("get_standings", "pl")]
+    assert [query for query, _ in conn.cursor_.executed] == ["EXPLAIN " + sql for _, sql, _, _ in HOT_QUERIES]
@@ -0,0 +1,226 @@
+from datetime import datetime, timedelta
+from functools import partial
+import pytest
+from utils.config import (
+    NOTIFICATION_MAX_ATTEMPTS,
+    NOTIFICATION_RETRY_SECONDS,
+    NOTIFICATION_LEASE_SECONDS,
+    TELEGRAM_CHAT_ID,
+    TELEGRAM_MAX_MESSAGE_LENGTH
+)
+from utils.notifications import queue_notification, claim_notifications, deliver_notifications
+from utils.utils import send_telegram_message
+
+
+class FakeOutbox:
+    """Connection to just the notifications table, for the queries utils.notifications makes"""
+
+    def __init__(self):
+        self.rows = {}
+        self.now = datetime(2022, 12, 18, 15, 0)
+        self.result = []
+        self.in_transaction = False
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def commit(self):
+        self.in_transaction = False
+
+    def execute(self, query, args):
+        query = " ".join(query.split())
+        self.in_transaction = True
+
+        if query.startswith("INSERT INTO notifications"):
+            dedup_key, text, _ = args
+            if not any(row["dedup_key"] == dedup_key and row["status"] == "pending" for row in self.rows.values()):
+                self.rows[len(self.rows) + 1] = {
+                    "dedup_key": dedup_key, "text": text, "status": "pending", "attempts": 0, "next_attempt_at": self.now
+                }
+
+        elif query.startswith("SELECT notification_id, text, attempts FROM notifications"):
+            due = [
+                notification_id for notification_id, row in sorted(self.rows.items())
+                if row["status"] in ("pending", "sending") and row["next_attempt_at"] <= self.now
+            ]
+            self.result = [(notification_id, self.rows[notification_id]["text"], self.rows[notification_id]["attempts"]) for notification_id in due[:args[0]]]
+
+        elif query.startswith("UPDATE notifications SET status = 'sending'"):
+            lease_seconds, *notification_ids = args
+            for notification_id in notification_ids:
+                self.rows[notification_id]["status"] = "sending"
+                self.rows[notification_id]["next_attempt_at"] = self.now + timedelta(seconds=lease_seconds)
+
+        elif query.startswith("UPDATE notifications SET attempts = attempts + 1"):
+            max_attempts, retry_seconds, error, *notification_ids = args
+            for notification_id in notification_ids:
+                row = self.rows[notification_id]
+
+                # MySQL assigns left to right, so the status sees the new number of attempts
+                row["attempts"] += 1
+                row["status"] = "failed" if row["attempts"] >= max_attempts else "pending"
+                row["next_attempt_at"] = self.now + timedelta(seconds=retry_seconds)
+                row["last_error"] = error
+
+        elif query.startswith("UPDATE notifications SET status = 'sent'"):
+            for notification_id in args:
+                self.rows[notification_id]["status"] = "sent"
+
+        else:
+            raise AssertionError(f"Unexpected query: {query}")
+
+    def fetchall(self):
+        return self.result
+
+    def statuses(self):
+        return [row["status"] for _, row in sorted(self.rows.items())]
+
+
+class FakeTelegram:
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.messages = []
+
+    def send(self, text):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("Telegram is down")
+        self.messages.append(text)
+
+
+@pytest.fixture
+def outbox():
+    return FakeOutbox()
+
+
+def test_a_message_is_only_queued_once_while_pending(outbox):
+    queue_notification(outbox, "Waiting for `Bob` to pick...")
+    queue_notification(outbox, "Waiting for `Bob` to pick...")
+    assert len(outbox.rows) == 1
+
+    deliver_notifications(outbox, FakeTelegram().send)
+
+    # Once sent, the same message can be queued again
+    queue_notification(outbox, "Waiting for `Bob` to pick...")
+    assert outbox.statuses() == ["sent", "pending"]
+
+
+def test_dedup_key_overrides_the_text(outbox):
+    queue_notification(outbox, "Bob: A out; B in", dedup_key="transfer-1")
+    queue_notification(outbox, "Bob: A out; C in", dedup_key="transfer-1")
+
+    assert len(outbox.rows) == 1
+
+
+def test_queued_messages_are_sent_in_one_batch(outbox):
+    telegram = FakeTelegram()
+    for text in ["`Alice` has picked `Messi`", "Waiting for `Bob` to pick...", "`Bob` has picked `Mbappe`"]:
+        queue_notification(outbox, text)
+
+    assert deliver_notifications(outbox, telegram.send) == 3
+    assert telegram.messages == ["`Alice` has picked `Messi`\nWaiting for `Bob` to pick...\n`Bob` has picked `Mbappe`"]
+    assert outbox.statuses() == ["sent"] * 3
+
+
+def test_batches_stay_within_the_telegram_message_limit(outbox):
+    telegram = FakeTelegram()
+    queue_notification(outbox, "a" * (TELEGRAM_MAX_MESSAGE_LENGTH - 10))
+    queue_notification(outbox, "b" * 20)
+
+    assert deliver_notifications(outbox, telegram.send) == 2
+    assert [len(message) for message in telegram.messages] == [TELEGRAM_MAX_MESSAGE_LENGTH - 10, 20]
+
+
+def test_only_batch_size_notifications_are_sent_at_once(outbox):
+    telegram = FakeTelegram()
+    for i in range(3):
+        queue_notification(outbox, f"message {i}")
+
+    assert deliver_notifications(outbox, telegram.send, batch_size=2) == 2
+    assert outbox.statuses() == ["sent", "sent", "pending"]
+
+
+def test_failed_sends_back_off_exponentially(outbox):
+    telegram = FakeTelegram(failures=2)
+    queue_notification(outbox, "`Alice` has picked `Messi`")
+
+    assert deliver_notifications(outbox, telegram.send) == 0
+    assert outbox.rows[1]["next_attempt_at"] == outbox.now + timedelta(seconds=NOTIFICATION_RETRY_SECONDS)
+    assert outbox.rows[1]["last_error"] == "Telegram is down"
+
+    # Not due again yet
+    assert deliver_notifications(outbox, telegram.send) == 0
+    assert outbox.rows[1]["attempts"] == 1
+
+    outbox.now += timedelta(seconds=NOTIFICATION_RETRY_SECONDS)
+    assert deliver_notifications(outbox, telegram.send) == 0
+    assert outbox.rows[1]["next_attempt_at"] == outbox.now + timedelta(seconds=2 * NOTIFICATION_RETRY_SECONDS)
+
+    outbox.now += timedelta(seconds=2 * NOTIFICATION_RETRY_SECONDS)
+    assert deliver_notifications(outbox, telegram.send) == 1
+    assert telegram.messages == ["`Alice` has picked `Messi`"]
+
+
+def test_gives_up_after_max_attempts(outbox):
+    telegram = FakeTelegram(failures=NOTIFICATION_MAX_ATTEMPTS)
+    queue_notification(outbox, "`Alice` has picked `Messi`")
+
+    for _ in range(NOTIFICATION_MAX_ATTEMPTS):
+        deliver_notifications(outbox, telegram.send)
+        outbox.now += timedelta(days=1)
+
+    assert outbox.statuses() == ["failed"]
+    assert deliver_notifications(outbox, telegram.send) == 0
+    assert telegram.messages == []
+
+
+def test_nothing_is_locked_while_sending(outbox):
+    queue_notification(outbox, "Waiting for `Bob` to pick...")
+    outbox.commit()
+
+    def send(text):
+        # Committed, so a pick queueing the same text doesn't wait for Telegram
+        assert not outbox.in_transaction
+        queue_notification(outbox, "Waiting for `Bob` to pick...")
+        outbox.commit()
+
+    assert deliver_notifications(outbox, send) == 1
+    assert outbox.statuses() == ["sent", "pending"]
+    assert not outbox.in_transaction
+
+
+def test_claims_of_a_worker_that_died_lapse(outbox):
+    telegram = FakeTelegram()
+    queue_notification(outbox, "`Alice` has picked `Messi`")
+    assert len(claim_notifications(outbox)) == 1
+
+    # Still claimed
+    assert deliver_notifications(outbox, telegram.send) == 0
+
+    outbox.now += timedelta(seconds=NOTIFICATION_LEASE_SECONDS)
+    assert deliver_notifications(outbox, telegram.send) == 1
+    assert telegram.messages == ["`Alice` has picked `Messi`"]
+
+
+def test_delivers_to_a_telegram_endpoint(outbox, fake_server):
+    send = partial(send_telegram_message, url=fake_server.url + "/sendMessage")
+    fake_server.reply(502)
+    fake_server.reply(body={"ok": True})
+    queue_notification(outbox, "The draft is complete. Good luck!")
+
+    # The error response is retried after the backoff
+    assert deliver_notifications(outbox, send) == 0
+    assert "502" in outbox.rows[1]["last_error"]
+
+    outbox.now += timedelta(seconds=NOTIFICATION_RETRY_SECONDS)
+    assert deliver_notifications(outbox, send) == 1
+
+    method, path, _, body, _ = fake_server.requests[-1]
+    assert (method, path) == ("POST", "/sendMessage")
+    assert body == {"chat_id": TELEGRAM_CHAT_ID, "text": "The draft is complete. Good luck!"}
@@ -0,0 +1,155 @@
+"""
+Every page's queries against its budget in ROUTE_QUERY_BUDGETS, like `python -m utils.query_recorder` but against a
+stand-in for the database that answers the queries each page makes, so it runs without MySQL.
+"""
+
+import importlib
+import re
+import time
+from datetime import datetime
+import pytest
+import db
+import utils.cache
+from utils import metrics
+from utils.cache import ReferenceData
+from utils.config import ALL_EVENTS, ROUTE_QUERY_BUDGETS, DEFAULT_ROUTE_QUERY_BUDGET
+from utils.query_recorder import check_route, get_routes, record_queries
+
+PLAYERS = [(1, "Keeper One", "Goalkeeper", None, 1), (2, "Attacker Two", "Attacker", None, 2)]
+REFERENCE = ReferenceData(
+    1,
+    PLAYERS,
+    [(1, "One", None), (2, "Two", None)],
+    [(1, "Group Stage - 1", datetime(2022, 11, 20), datetime(2022, 11, 24))],
+    [(event_id, name, position, value) for event_id, (name, position, value) in enumerate(ALL_EVENTS, start=1)],
+    [("Tom", 1), ("Alice", 2)]
+)
+
+# Replies to the queries the pages make, by how they start once their whitespace is collapsed
+RESULTS = {
+    "SELECT name, version FROM data_versions": [("reference", 1), ("picks", 1), ("points", 1)],
+    "SELECT u.name, pl.name as player_name": [("Tom", "Keeper One", "Goalkeeper", None, 5), ("Alice", "Attacker Two", "Attacker", None, 3)],
+    "SELECT u.name, gw.gameweek_id": [("Tom", 1, 5), ("Alice", 1, 3)],
+    "SELECT pl.name, pl.headshot, pl.position, t.name as team_name": [("Keeper One", None, "Goalkeeper", "One", 5), ("Attacker Two", None, "Attacker", "Two", 3)],
+    "SELECT pl.* FROM picks pi": [PLAYERS[0]],
+}
+
+
+class FakeCursor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, args=None):
+        query = re.sub(r"\s+", " ", query).strip()
+        results = [rows for prefix, rows in RESULTS.items() if query.startswith(prefix)]
+        assert results, f"Unexpected query: {query}"
+        self.rows = results[0]
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def cursor(self):
+        return FakeCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    def get(self):
+        # Instrumented like the real connections, so the recorder sees every query
+        return metrics.InstrumentedConnection(FakeConnection())
+
+    def put(self, conn):
+        pass
+
+    def discard(self, conn):
+        pass
+
+    def stats(self):
+        return {"size": 1, "in_use": 0}
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setenv("FOOTBALL_SECRET_KEY", "test-secret")
+    monkeypatch.setenv("API_KEY", "test-key")
+    monkeypatch.setenv("BACKGROUND_WORKERS", "0")
+    monkeypatch.delenv("GAE_ENV", raising=False)
+    main = importlib.import_module("main")
+
+    monkeypatch.setattr(main, "pool", FakePool())
+    monkeypatch.setattr(db, "get_current_time", lambda: datetime(2022, 11, 19, 12, 0))
+
+    # Reference data loaded, as it is in a warmed up instance
+    monkeypatch.setattr(utils.cache, "_reference_data", REFERENCE)
+    monkeypatch.setattr(utils.cache, "_checked_at", time.monotonic())
+    monkeypatch.setattr(utils.cache, "REFERENCE_CHECK_SECONDS", 3600)
+
+    return main
+
+
+@pytest.fixture
+def client(app):
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session["loggedin"] = True
+        session["user_id"] = 1
+        session["username"] = "Tom"
+
+    return client
+
+
+def test_importing_the_website_doesnt_start_the_notification_worker(app):
+    assert app.notification_worker._thread is None
+
+
+def test_every_page_is_within_its_query_budget(app, client):
+    routes = get_routes(app.app)
+    assert {"/players", "/standings", "/transfer", "/pick"} <= set(routes)
+
+    for route in routes:
+        status, recording = check_route(client, route)
+
+        assert status < 500, f"{route} failed"
+        recording.assert_max_queries(ROUTE_QUERY_BUDGETS.get(route, DEFAULT_ROUTE_QUERY_BUDGET))
+        recording.assert_no_redundant_queries()
+
+
+def test_cached_pages_dont_query_again(client):
+    check_route(client, "/standings")
+
+    with record_queries() as recording:
+        client.get("/standings")
+
+    recording.assert_max_queries(0)
+
+
+def test_duplicate_and_repeated_queries_are_caught(app):
+    conn = app.pool.get()
+
+    with record_queries() as recording:
+        db.get_standings(conn, 1)
+        db.get_standings(conn, 1)
+    with pytest.raises(AssertionError, match="duplicate x2 from db.get_standings"):
+        recording.assert_no_redundant_queries()
+
+    # The same query with different arguments, in a loop
+    with record_queries() as recording:
+        for gameweek_id in range(1, 4):
+            db.get_standings(conn, gameweek_id)
+    with pytest.raises(AssertionError, match="N\\+1 x3 from db.get_standings"):
+        recording.assert_no_redundant_queries()
+    with pytest.raises(AssertionError, match="at most 2 queries"):
+        recording.assert_max_queries(2)
@@ -0,0 +1,238 @@
+import re
+from datetime import datetime
+import pytest
+import db
+from utils.api import parse_fixture_events, parse_fixture_lineups
+from utils.cache import ReferenceData
+from utils.config import ALL_EVENTS
+from utils.scoring import events_to_dataframe, lineups_to_dataframe, derive_scoring_events, normalize_scoring_events
+
+FIXTURE_ID = 1
+
+# Team 1 and team 2 each start a goalkeeper, a defender and an attacker
+PLAYERS = [
+    (11, "Keeper One", "Goalkeeper", None, 1),
+    (12, "Defender One", "Defender", None, 1),
+    (13, "Attacker One", "Attacker", None, 1),
+    (21, "Keeper Two", "Goalkeeper", None, 2),
+    (22, "Defender Two", "Defender", None, 2),
+    (23, "Attacker Two", "Attacker", None, 2),
+]
+# On the bench
+SUBSTITUTES = [
+    (14, "Defender Sub", "Defender", None, 1),
+    (24, "Keeper Sub", "Goalkeeper", None, 2),
+]
+REFERENCE = ReferenceData(
+    1,
+    PLAYERS + SUBSTITUTES,
+    [(1, "One", None), (2, "Two", None)],
+    [(1, "Final", datetime(2022, 12, 18), datetime(2200, 1, 1))],
+    [(event_id, name, position, value) for event_id, (name, position, value) in enumerate(ALL_EVENTS, start=1)],
+    []
+)
+
+
+def api_event(minute, player_id, event_type, detail, comments=None, assist_id=None):
+    player = REFERENCE.players_by_id[player_id]
+    return {
+        "time": {"elapsed": minute, "extra": None},
+        "team": {"id": player["team_id"], "name": ""},
+        "player": {"id": player_id, "name": player["name"]},
+        "assist": {"id": assist_id, "name": REFERENCE.players_by_id[assist_id]["name"] if assist_id else None},
+        "type": event_type,
+        "detail": detail,
+        "comments": comments,
+    }
+
+
+def derive(events, end_minute=90):
+    """Scoring events of a fixture, `end_minute` is the clock estimate"""
+    lineups = [
+        {"team": {"id": team_id}, "startXI": [{"player": {"id": player[0], "name": player[1]}} for player in PLAYERS if player[4] == team_id]}
+        for team_id in [1, 2]
+    ]
+
+    return derive_scoring_events(
+        events_to_dataframe(parse_fixture_events(FIXTURE_ID, events), REFERENCE),
+        lineups_to_dataframe(parse_fixture_lineups(FIXTURE_ID, lineups), REFERENCE),
+        REFERENCE,
+        {FIXTURE_ID: end_minute}
+    )
+
+
+def score(events, end_minute=90):
+    """Scoring events of a fixture as a set of (event name, player id)"""
+    scoring_events = derive(events, end_minute)
+
+    return set(zip(scoring_events["event_name"], scoring_events["player_id"]))
+
+
+def test_assists_go_to_the_player_who_set_up_a_goal():
+    scored = score([
+        api_event(10, 13, "Goal", "Normal Goal", assist_id=12),
+        # Penalties and own goals aren't assisted, even if the API names someone
+        api_event(20, 13, "Goal", "Penalty", assist_id=11),
+        api_event(30, 22, "Goal", "Own Goal", assist_id=21),
+    ])
+
+    assert ("Assist", 12) in scored
+    assert ("Assist", 11) not in scored
+    assert ("Assist", 21) not in scored
+
+
+def test_missed_penalties_are_saved_by_the_goalkeeper_on_the_pitch():
+    scored = score([
+        api_event(30, 13, "Goal", "Missed Penalty"),
+        api_event(60, 21, "subst", "Substitution 1", assist_id=24),
+        api_event(70, 13, "Goal", "Missed Penalty"),
+    ])
+
+    assert ("Missed Penalty", 13) in scored
+    assert ("Penalty Save", 21) in scored
+    assert ("Penalty Save", 24) in scored
+    assert ("Penalty Save", 11) not in scored
+
+
+def test_clean_sheets_need_the_minutes_on_the_pitch():
+    scored = score([
+        # Off before the hour, and his replacement is only on for the last 40 minutes
+        api_event(50, 12, "subst", "Substitution 1", assist_id=14),
+        api_event(55, 22, "Card", "Red Card"),
+    ])
+
+    assert ("Clean Sheet", 11) in scored
+    assert ("Clean Sheet", 12) not in scored
+    assert ("Clean Sheet", 14) not in scored
+    assert ("Clean Sheet", 22) not in scored
+    assert ("Red Card", 22) in scored
+
+
+def test_substitutes_on_early_enough_keep_a_clean_sheet():
+    scored = score([api_event(20, 12, "subst", "Substitution 1", assist_id=14)])
+
+    assert ("Clean Sheet", 14) in scored
+    assert ("Clean Sheet", 12) not in scored
+
+
+def test_goals_are_worth_the_points_for_the_scorers_position():
+    scoring_events = derive([api_event(10, 12, "Goal", "Normal Goal"), api_event(20, 13, "Goal", "Normal Goal")])
+    rows = normalize_scoring_events(scoring_events, REFERENCE, {FIXTURE_ID: datetime(2022, 12, 18, 16, 0)})
+
+    event_ids = {(player_id, event_id) for _, player_id, event_id, _, _ in rows.values()}
+    assert (12, REFERENCE.events_by_name_position[("Goal", "Defender")]["event_id"]) in event_ids
+    assert (13, REFERENCE.events_by_name_position[("Goal", "Attacker")]["event_id"]) in event_ids
+
+
+def test_clean_sheets_at_full_time():
+    assert score([]) == {("Clean Sheet", 11), ("Clean Sheet", 12), ("Clean Sheet", 21), ("Clean Sheet", 22)}
+
+
+def test_goal_in_extra_time_loses_the_clean_sheet():
+    scored = score([api_event(105, 23, "Goal", "Normal Goal")])
+
+    assert ("Goal", 23) in scored
+    assert ("Clean Sheet", 11) not in scored
+    assert ("Clean Sheet", 12) not in scored
+    assert ("Clean Sheet", 21) in scored
+
+
+def test_penalty_shootout_kicks_are_not_scored():
+    scored = score([
+        api_event(120, 13, "Goal", "Penalty", "Penalty Shootout"),
+        api_event(120, 23, "Goal", "Missed Penalty", "Penalty Shootout"),
+    ], end_minute=90)
+
+    # A shootout doesn't concede goals either
+    assert scored == {("Clean Sheet", 11), ("Clean Sheet", 12), ("Clean Sheet", 21), ("Clean Sheet", 22)}
+
+
+def test_penalty_in_extra_time_is_scored():
+    scored = score([api_event(110, 13, "Goal", "Penalty")])
+
+    assert ("Penalty", 13) in scored
+    assert ("Clean Sheet", 21) not in scored
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, args=()):
+        query = re.sub(r"\s+", " ", query).strip()
+        self.conn.queries.append(query)
+        self.rows = [row for prefix, row in self.conn.results.items() if query.startswith(prefix)][:1] or [[]]
+
+    def executemany(self, query, rows):
+        self.conn.inserted.extend(rows)
+        self.execute(query)
+
+    def fetchone(self):
+        return self.rows[0][0] if self.rows[0] else None
+
+    def fetchall(self):
+        return self.rows[0]
+
+
+class FakeConnection:
+    """Replies to queries starting with each prefix in `results` with its rows, and to anything else with no rows"""
+
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+        self.inserted = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeFeed:
+    def __init__(self, events):
+        self.events = events
+        self.calls = 0
+
+    def get_all_events_for_fixture(self, fixture_id):
+        self.calls += 1
+        return parse_fixture_events(fixture_id, self.events)
+
+    def get_fixture_lineups(self, fixture_id):
+        self.calls += 1
+        return []
+
+
+@pytest.fixture
+def scoring_db(monkeypatch):
+    monkeypatch.setattr(db, "get_reference_data", lambda conn: REFERENCE)
+    monkeypatch.setattr(db, "get_current_time", lambda: datetime(2022, 12, 18, 17, 0))
+
+
+def test_unknown_fixtures_are_refused_before_calling_the_api(scoring_db):
+    feed = FakeFeed([])
+
+    with pytest.raises(ValueError, match="Fixture 99"):
+        db.update_points_for_fixture(FakeConnection({}), 99, feed)
+
+    assert feed.calls == 0
+
+
+def test_new_events_are_inserted(scoring_db):
+    conn = FakeConnection({"SELECT start_time FROM games": [(datetime(2022, 12, 18, 16, 0),)]})
+    feed = FakeFeed([api_event(23, 13, "Goal", "Normal Goal")])
+
+    assert db.update_points_for_fixture(conn, FIXTURE_ID, feed) == (1, 0)
+
+    # A plain INSERT, new keys are already filtered against the existing ones so a clash is a real error
+    assert any(query.startswith("INSERT INTO points") for query in conn.queries)
+    assert [row[1] for row in conn.inserted] == [13]
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import pytest
+import requests
+import scoring_worker
+from scoring_worker import get_poll_interval, run
+from utils.api_cache import QuotaExceeded
+from utils.config import API_CACHE_TTL_SECONDS, SCORING_MIN_POLL_SECONDS
+
+NOW = datetime(2022, 12, 18, 16, 0)
+
+
+def test_poll_interval_sets_aside_lineup_calls():
+    live_until = NOW + timedelta(hours=2)
+    lineup_calls = 2 * (2 * 60 * 60 // API_CACHE_TTL_SECONDS["fixtures/lineups"])
+
+    # 2 games, so each poll makes 2 events calls
+    interval = get_poll_interval(2, live_until, NOW, 50)
+
+    assert interval == 2 * 60 * 60 / ((50 - lineup_calls) // 2)
+
+
+def test_poll_interval_never_polls_faster_than_the_minimum():
+    assert get_poll_interval(1, NOW + timedelta(minutes=10), NOW, 90) == SCORING_MIN_POLL_SECONDS
+
+
+def test_no_poll_without_calls_left_for_the_lineups_and_events():
+    assert get_poll_interval(2, NOW + timedelta(minutes=30), NOW, 3) is None
+    assert get_poll_interval(2, NOW + timedelta(minutes=30), NOW, 4) is not None
+
+
+class FakePool:
+    def __init__(self):
+        self.borrowed = 0
+        self.returned = []
+        self.discarded = []
+
+    def get(self):
+        self.borrowed += 1
+        return f"connection {self.borrowed}"
+
+    def put(self, conn):
+        self.returned.append(conn)
+
+    def discard(self, conn):
+        self.discarded.append(conn)
+
+
+class StopWorker(Exception):
+    pass
+
+
+def test_a_failed_poll_doesnt_stop_the_worker(monkeypatch):
+    results = [requests.HTTPError("503 Server Error"), QuotaExceeded("Already made 100 of 100 API calls today"), 120]
+
+    def poll(conn, current_time, feed, calls_remaining):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        if not results:
+            raise StopWorker()
+
+    monkeypatch.setattr(scoring_worker, "poll", poll)
+    monkeypatch.setattr(scoring_worker, "time", SimpleNamespace(sleep=sleep))
+    pool = FakePool()
+
+    with pytest.raises(StopWorker):
+        run(pool, feed=object())
+
+    assert sleeps == [SCORING_MIN_POLL_SECONDS, SCORING_MIN_POLL_SECONDS, 120]
+    assert pool.discarded == ["connection 1", "connection 2"]
+    assert pool.returned == ["connection 3"]
+
+
+def test_a_failed_single_poll_is_raised(monkeypatch):
+    def poll(conn, current_time, feed, calls_remaining):
+        raise requests.HTTPError("503 Server Error")
+
+    monkeypatch.setattr(scoring_worker, "poll", poll)
+    pool = FakePool()
+
+    # So cron sees it failed
+    with pytest.raises(requests.HTTPError):
+        run(pool, feed=object(), once=True)
+
+    assert pool.discarded == ["connection 1"]
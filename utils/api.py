@@ -6,42 +6,201 @@ Notes:
 - The API total requests are limited to 100 per day
 """
 
+import threading
+import time
 import requests
 import pandas as pd
-from utils.config import API_URL, GAMEWEEKS
-from utils.utils import get_cloud_secret
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.config import (
+    API_URL, 
+    GAMEWEEKS, 
+    API_REQUESTS_PER_MINUTE, 
+    API_REQUESTS_PER_DAY, 
+    API_CACHE_TTL_SECONDS, 
+    API_TIMEOUT_SECONDS, 
+    API_MAX_RETRIES, 
+    API_MAX_WORKERS
+)
+from utils.secrets import get_secret
+from utils.metrics import time_external_call
+from utils.api_cache import (
+    QuotaExceeded, 
+    get_cached_response, 
+    set_cached_response, 
+    reserve_call, 
+    record_call_status
+)
 from typing import List
-from time import sleep
 
-API_KEY = get_cloud_secret("API_KEY")
+PLAYER_COLUMNS = ["player_id", "name", "position", "headshot", "team_id"]
 
 HEADERS = {
-    'x-rapidapi-key': API_KEY,
     'x-rapidapi-host': 'v3.football.api-sports.io'
 }
 
+
+class RateLimiter:
+    """Allow at most `max_calls` calls in any `period` seconds, blocking until a call is allowed"""
+
+    def __init__(self, max_calls, period=60.0):
+        self.max_calls = max_calls
+        self.period = period
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+
+                wait = self.period - (now - self._calls[0])
+
+            time.sleep(wait)
+
+
+# Shared by every thread, so the whole process stays within the API rate limit
+RATE_LIMITER = RateLimiter(API_REQUESTS_PER_MINUTE)
+
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+
+
+def get_session():
+    """Get the API session, adding the API key the first time it's needed rather than when this module is imported"""
+    if 'x-rapidapi-key' not in SESSION.headers:
+        SESSION.headers['x-rapidapi-key'] = get_secret("API_KEY")
+
+    return SESSION
+
+
+def api_get(endpoint, params, max_age=None):
+    """
+    Get the response for the given API endpoint, using the cached response in the database while it's fresh.
+    Retries with backoff if rate limited, the API errors or the call times out, and falls back to a stale cached response if we're out 
+    of API calls for today.
+    `max_age` overrides how old (in seconds) a cached response can be, instead of the endpoint's API_CACHE_TTL_SECONDS.
+    """
+    if max_age is None:
+        max_age = API_CACHE_TTL_SECONDS.get(endpoint, 0)
+
+    cached = get_cached_response(endpoint, params)
+    if cached is not None and cached[2] < max_age:
+        return cached[0]
+
+    # Ask the API to only send the response if it has changed
+    headers = {"If-None-Match": cached[1]} if cached is not None and cached[1] else {}
+
+    for attempt in range(API_MAX_RETRIES + 1):
+        RATE_LIMITER.acquire()
+
+        try:
+            call_id = reserve_call(endpoint, params, API_REQUESTS_PER_DAY)
+        except QuotaExceeded as e:
+            if cached is None:
+                raise
+            print(f"{e}, using cached response from {cached[2] / 60:.0f} minutes ago")
+            return cached[0]
+
+        try:
+            with time_external_call("football_api", endpoint):
+                response = get_session().get(API_URL + endpoint, params=params, headers=headers, timeout=API_TIMEOUT_SECONDS)
+        except requests.RequestException as e:
+            # Timed out or couldn't connect, the call may still have reached the API so it stays in the ledger
+            record_call_status(call_id, 0)
+            if attempt == API_MAX_RETRIES:
+                raise
+
+            print(f"API call to {endpoint} failed: {e}, retrying")
+            time.sleep(2 ** attempt * 5)
+            continue
+
+        record_call_status(call_id, response.status_code)
+
+        if response.status_code == 304 and cached is not None:
+            set_cached_response(endpoint, params, cached[0], cached[1])
+            return cached[0]
+
+        if response.status_code != 429 and response.status_code < 500:
+            response.raise_for_status()
+            data = response.json()
+
+            # The API reports most errors in the body with a 200 status
+            errors = data.get('errors')
+            if not errors:
+                set_cached_response(endpoint, params, data['response'], response.headers.get("ETag"))
+                return data['response']
+
+            if 'rateLimit' not in errors or attempt == API_MAX_RETRIES:
+                raise ValueError(f"API error for {endpoint}: {errors}")
+
+        if attempt < API_MAX_RETRIES:
+            retry_after = response.headers.get("Retry-After", "")
+            time.sleep(int(retry_after) if retry_after.isdigit() else 2 ** attempt * 5)
+
+    response.raise_for_status()
+
+
 def get_all_events_for_fixture(fixture_id):
     """Get all events for the given fixture"""
-    response = requests.request("GET", API_URL + f"/fixtures/events?fixture={fixture_id}", headers=HEADERS)
-    events = response.json()['response']
+    events = api_get("fixtures/events", {"fixture": fixture_id})
 
+    return parse_fixture_events(fixture_id, events)
+
+
+def parse_fixture_events(fixture_id, events):
+    """Parse the events of the given fixture from the API response, or a recording of one"""
     all_events = []
     for event in events:
         all_events.append({
             "fixture_id": fixture_id,
+            "player_id": event["player"]["id"],
             "player": event["player"]["name"],
+            "team_id": event["team"]["id"],
             "team": event["team"]["name"],
             "type": event["type"],
-            "time": event["time"]["elapsed"]
+            "detail": event["detail"],
+            "time": event["time"]["elapsed"],
+            "extra_time": event["time"]["extra"],
+            "assist_id": event["assist"]["id"],
+            "assist": event["assist"]["name"],
+            "comments": event.get("comments"),
         })
 
     return all_events
 
 
+def get_fixture_lineups(fixture_id):
+    """Get the starting lineups for the given fixture"""
+    lineups = api_get("fixtures/lineups", {"fixture": fixture_id})
+
+    return parse_fixture_lineups(fixture_id, lineups)
+
+
+def parse_fixture_lineups(fixture_id, lineups):
+    """Parse the starting lineups of the given fixture from the API response, or a recording of one"""
+    all_players = []
+    for lineup in lineups:
+        for player in lineup["startXI"]:
+            all_players.append({
+                "fixture_id": fixture_id,
+                "team_id": lineup["team"]["id"],
+                "player_id": player["player"]["id"],
+                "player": player["player"]["name"],
+            })
+
+    return all_players
+
+
 def get_all_fixtures(league_id, year) -> pd.DataFrame:
     """Get all fixtures for the given league for the given year"""
-    response = requests.request("GET", API_URL + f"fixtures?league={league_id}&season={year}", headers=HEADERS)
-    fixtures = response.json()['response']
+    fixtures = api_get("fixtures", {"league": league_id, "season": year})
 
     all_fixtures = []
     for fixture in fixtures:
@@ -67,8 +226,7 @@ def get_all_fixtures(league_id, year) -> pd.DataFrame:
 
 def get_all_teams(league_id, year):
     """Get all teams for the given league for the given year"""
-    response = requests.request("GET", API_URL + f"teams?league={league_id}&season={year}", headers=HEADERS)
-    teams = response.json()['response']
+    teams = api_get("teams", {"league": league_id, "season": year})
 
     all_teams = []
     for team in teams:
@@ -84,25 +242,30 @@ def get_all_teams(league_id, year):
     return all_teams_df
 
 
-def get_all_players(team_ids: List) -> pd.DataFrame:
-    """Get all players for the given team id's"""
-    all_players = []
-    for team_id in team_ids:
-        sleep(10) # To avoid hitting the API rate limit
-        response = requests.request("GET", API_URL + f"players/squads?team={team_id}", headers=HEADERS)
-        players = response.json()['response'][0]['players']
+def get_team_players(team_id, max_age=None) -> List:
+    """Get all players in the squad of the given team id"""
+    players = api_get("players/squads", {"team": team_id}, max_age)[0]['players']
+
+    print(f"Found {len(players)} players for team id: {team_id}")
+
+    return [
+        {
+            "player_id": player["id"],
+            "name": player["name"],
+            "position": player["position"],
+            "headshot": player["photo"],
+            "team_id": team_id,
+        }
+        for player in players
+    ]
 
-        for player in players:
-            all_players.append({
-                "player_id": player["id"],
-                "name": player["name"],
-                "position": player["position"],
-                "headshot": player["photo"],
-                "team_id": team_id,
-            })
 
-        print(f"Found {len(players)} players for team id: {team_id}")
+def get_all_players(team_ids: List, max_age=None) -> pd.DataFrame:
+    """Get all players for the given team id's, fetching squads in parallel as fast as the rate limit allows"""
+    with ThreadPoolExecutor(max_workers=API_MAX_WORKERS) as executor:
+        squads = list(executor.map(lambda team_id: get_team_players(team_id, max_age), team_ids))
 
-    all_players_df = pd.DataFrame(all_players)
+    all_players = [player for squad in squads for player in squad]
+    all_players_df = pd.DataFrame(all_players, columns=PLAYER_COLUMNS)
     
     return all_players_df
@@ -0,0 +1,101 @@
+"""
+Cache of football API responses, and a ledger of every API call made.
+
+With only 100 API calls a day, responses are cached per endpoint and params for as long as they're likely to stay the
+same (see API_CACHE_TTL_SECONDS), and a call is refused if it would take us over the daily quota. Both are kept in the
+draft database, so they're shared by every App Engine instance and the scoring worker, and survive restarts.
+"""
+
+import hashlib
+import json
+from datetime import datetime, timezone
+from utils.database import borrow_connection
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def get_cache_key(endpoint, params):
+    return hashlib.sha1((endpoint + "?" + json.dumps(params, sort_keys=True, default=str)).encode("utf-8")).hexdigest()
+
+
+def get_cached_response(endpoint, params):
+    """Get the cached (body, etag, age in seconds) for the given request, or None if it's never been cached"""
+    with borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                "SELECT body, etag, TIMESTAMPDIFF(SECOND, fetched_at, NOW()) FROM api_responses WHERE cache_key = %s",
+                (get_cache_key(endpoint, params),)
+            )
+            record = cursor.fetchone()
+
+    if record is None:
+        return None
+
+    return json.loads(record[0]), record[1], record[2]
+
+
+def set_cached_response(endpoint, params, body, etag=None):
+    with borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                    INSERT INTO api_responses (cache_key, endpoint, params, etag, fetched_at, body)
+                    VALUES (%s, %s, %s, %s, NOW(), %s)
+                    ON DUPLICATE KEY UPDATE etag = VALUES(etag), fetched_at = NOW(), body = VALUES(body)
+                """,
+                (get_cache_key(endpoint, params), endpoint, json.dumps(params, default=str), etag, json.dumps(body))
+            )
+
+        conn.commit()
+
+
+def get_quota_day():
+    """The API quota resets at midnight UTC"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def get_calls_today():
+    """Number of API calls made today, by every process"""
+    with borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT calls FROM api_quota WHERE day = %s", (get_quota_day(),))
+            record = cursor.fetchone()
+
+    return record[0] if record else 0
+
+
+def reserve_call(endpoint, params, daily_limit):
+    """Record a call in the ledger, raising QuotaExceeded instead if it would go over the daily limit"""
+    day = get_quota_day()
+
+    with borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            # A single counter row per day, so processes reserving calls at the same time can't both take the last one
+            cursor.execute("INSERT IGNORE INTO api_quota (day, calls) VALUES (%s, 0)", (day,))
+            cursor.execute("UPDATE api_quota SET calls = calls + 1 WHERE day = %s AND calls < %s", (day, daily_limit))
+            reserved = cursor.rowcount > 0
+
+            if reserved:
+                cursor.execute(
+                    "INSERT INTO api_calls (day, endpoint, params) VALUES (%s, %s, %s)",
+                    (day, endpoint, json.dumps(params, default=str))
+                )
+                call_id = cursor.lastrowid
+
+        conn.commit()
+
+    if not reserved:
+        raise QuotaExceeded(f"Already made {daily_limit} of {daily_limit} API calls today, not calling {endpoint}")
+
+    return call_id
+
+
+def record_call_status(call_id, status):
+    """Record the HTTP status of a call in the ledger, 0 if no response was received"""
+    with borrow_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("UPDATE api_calls SET status = %s WHERE call_id = %s", (status, call_id))
+
+        conn.commit()
@@ -0,0 +1,101 @@
+"""
+Bulk loading of the reference data tables.
+
+Rows are loaded into empty shadow copies of the tables with parameterised, bounded size `executemany` batches, so names
+like N'Golo Kanté are escaped properly and no single statement goes over `max_allowed_packet`. Once every shadow table is
+loaded they are all swapped in with a single `RENAME TABLE`, which is atomic, so the site never sees a half loaded table.
+"""
+
+import math
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Sequence
+from utils.config import BULK_LOAD_BATCH_SIZE
+
+SHADOW_SUFFIX = "_shadow"
+OLD_SUFFIX = "_old"
+
+
+def to_python(value):
+    """Convert numpy and pandas values to the plain Python values MySQLdb knows how to escape"""
+    if value is None:
+        return None
+
+    if isinstance(value, float) and math.isnan(value):
+        return None
+
+    if isinstance(value, datetime) and hasattr(value, "to_pydatetime"):
+        return value.to_pydatetime()
+
+    if hasattr(value, "item"):
+        return to_python(value.item())
+
+    return value
+
+
+def get_rows(df) -> List[tuple]:
+    """Get the rows of a DataFrame as tuples of plain Python values"""
+    return [tuple(to_python(value) for value in row) for row in df.itertuples(index=False, name=None)]
+
+
+def create_shadow_tables(cursor, tables: Iterable[str]):
+    """Create an empty copy of each table, with the same columns and indexes"""
+    for table in tables:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}{SHADOW_SUFFIX}")
+        cursor.execute(f"CREATE TABLE {table}{SHADOW_SUFFIX} LIKE {table}")
+
+
+def drop_shadow_tables(cursor, tables: Iterable[str]):
+    for table in tables:
+        cursor.execute(f"DROP TABLE IF EXISTS {table}{SHADOW_SUFFIX}")
+
+
+def load_rows(cursor, table: str, columns: Sequence[str], rows: Sequence[tuple], batch_size=BULK_LOAD_BATCH_SIZE):
+    """Insert rows into the given table in batches of at most `batch_size`, returns the number of rows per second"""
+    start = time.monotonic()
+    placeholders = ", ".join(["%s"] * len(columns))
+    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})"
+
+    for i in range(0, len(rows), batch_size):
+        cursor.executemany(query, rows[i:i + batch_size])
+
+    seconds = time.monotonic() - start
+    return len(rows) / seconds if seconds > 0 else float(len(rows))
+
+
+def swap_shadow_tables(cursor, tables: Iterable[str]):
+    """Swap every shadow table in for its live table in a single atomic rename, then drop the old tables"""
+    tables = list(tables)
+    renames = []
+    for table in tables:
+        renames.append(f"{table} TO {table}{OLD_SUFFIX}")
+        renames.append(f"{table}{SHADOW_SUFFIX} TO {table}")
+
+    cursor.execute(f"DROP TABLE IF EXISTS {', '.join(table + OLD_SUFFIX for table in tables)}")
+    cursor.execute("RENAME TABLE " + ", ".join(renames))
+    cursor.execute(f"DROP TABLE {', '.join(table + OLD_SUFFIX for table in tables)}")
+
+
+def bulk_load(conn, data: Dict[str, tuple], batch_size=BULK_LOAD_BATCH_SIZE):
+    """
+    Replace the contents of several tables at once.
+
+    :param conn: Database connection.
+    :param data: Table name -> (columns, rows) for every table to replace.
+    :param batch_size: Maximum number of rows sent per INSERT.
+    """
+    with conn.cursor() as cursor:
+        # DDL commits implicitly in MySQL, so the shadow tables are created before the load transaction starts
+        create_shadow_tables(cursor, data)
+
+        try:
+            for table, (columns, rows) in data.items():
+                rows_per_second = load_rows(cursor, table + SHADOW_SUFFIX, columns, rows, batch_size)
+                print(f"Loaded {len(rows)} rows into {table} ({rows_per_second:.0f} rows/sec)")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            drop_shadow_tables(cursor, data)
+            raise
+
+        swap_shadow_tables(cursor, data)
@@ -0,0 +1,213 @@
+"""
+In-process cache of the reference data tables (players, teams, gameweeks, events and the draft order).
+
+These tables only change when `/setup` reloads them, which bumps the `reference` counter in the `data_versions`
+table. Each process checks the counter at most every REFERENCE_CHECK_SECONDS and reloads everything when it changes,
+so most page loads don't need to query these tables at all.
+
+Pages that only change when data is ingested (players and standings) are also cached here, rendered, keyed by the
+versions of the data they are built from. The versions are read at most every PAGE_CACHE_CHECK_SECONDS.
+"""
+
+import hashlib
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime
+from utils.config import REFERENCE_CHECK_SECONDS, PAGE_CACHE_CHECK_SECONDS, PAGE_CACHE_MAX_PAGES
+
+_lock = threading.Lock()
+_reference_data = None
+_checked_at = 0.0
+
+_page_lock = threading.Lock()
+_pages = OrderedDict()  # key -> (data versions, body, etag), least recently used first
+_data_versions = {}
+_data_versions_checked_at = 0.0
+
+
+def get_data_version(conn, name):
+    """Get the current version of the given data"""
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT version FROM data_versions WHERE name = %s", (name,))
+        record = cursor.fetchone()
+
+    return record[0] if record else 0
+
+
+def bump_data_version(cursor, name):
+    """Bump the version of the given data, all processes will reload it on their next check"""
+    cursor.execute(
+        "INSERT INTO data_versions (name, version) VALUES (%s, 1) ON DUPLICATE KEY UPDATE version = version + 1",
+        (name,)
+    )
+
+
+class ReferenceData:
+    """Snapshot of the reference data tables at a given version"""
+
+    def __init__(self, version, players, teams, gameweeks, events, draft):
+        self.version = version
+
+        self.players_by_id = {
+            player[0]: {
+                "player_id": player[0],
+                "name": player[1],
+                "position": player[2],
+                "headshot": player[3],
+                "team_id": player[4]
+            }
+            for player in players
+        }
+        self.players_by_name = {player["name"]: player for player in self.players_by_id.values()}
+        self.player_names = sorted(self.players_by_name)
+
+        self.teams_by_id = {team[0]: {"team_id": team[0], "name": team[1], "logo": team[2]} for team in teams}
+
+        # Gameweeks sorted by start time, so we can binary search for the gameweek at a given time
+        gameweeks = sorted(gameweeks, key=lambda gameweek: gameweek[2])
+        self.gameweek_ids = [gameweek[0] for gameweek in gameweeks]
+        self.gameweek_starts = [gameweek[2] for gameweek in gameweeks]
+        self.gameweek_ends = [gameweek[3] for gameweek in gameweeks]
+
+        self.events_by_name_position = {
+            (event[1], event[2]): {"event_id": event[0], "name": event[1], "position": event[2], "value": event[3]}
+            for event in events
+        }
+
+        self.draft_order = [name for name, _ in sorted(draft, key=lambda item: item[1])]
+
+    def get_gameweek_at(self, current_time: datetime):
+        """Get the gameweek that is in progress at the given time, or None"""
+        idx = bisect_right(self.gameweek_starts, current_time) - 1
+        if idx < 0 or current_time > self.gameweek_ends[idx]:
+            return None
+
+        return self.gameweek_ids[idx]
+
+    def get_next_gameweek(self, current_time: datetime):
+        """Get the next gameweek from the given time, or None if we're not in a gameweek"""
+        if not self.gameweek_ids:
+            return None
+
+        # Check to see if we're not in the first gameweek
+        if current_time < self.gameweek_starts[0]:
+            return self.gameweek_ids[0]
+
+        current_gameweek = self.get_gameweek_at(current_time)
+        return current_gameweek + 1 if current_gameweek is not None else None
+
+
+def load_reference_data(conn, version):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT player_id, name, position, headshot, team_id FROM players")
+        players = cursor.fetchall()
+
+        cursor.execute("SELECT team_id, name, logo FROM teams")
+        teams = cursor.fetchall()
+
+        cursor.execute("SELECT gameweek_id, name, start_time, end_time FROM gameweeks")
+        gameweeks = cursor.fetchall()
+
+        cursor.execute("SELECT event_id, name, position, value FROM events")
+        events = cursor.fetchall()
+
+        cursor.execute("SELECT u.name, d.draft_id FROM draft d INNER JOIN users u ON u.user_id = d.user_id")
+        draft = cursor.fetchall()
+
+    return ReferenceData(version, players, teams, gameweeks, events, draft)
+
+
+def get_reference_data(conn) -> ReferenceData:
+    """Get the cached reference data, reloading it if it's been changed by another process"""
+    global _reference_data, _checked_at
+
+    if _reference_data is not None and time.monotonic() - _checked_at < REFERENCE_CHECK_SECONDS:
+        return _reference_data
+
+    with _lock:
+        version = get_data_version(conn, "reference")
+        if _reference_data is None or _reference_data.version != version:
+            _reference_data = load_reference_data(conn, version)
+
+        _checked_at = time.monotonic()
+
+    return _reference_data
+
+
+def invalidate_reference_data():
+    """Drop the reference data cached in this process"""
+    global _reference_data
+
+    with _lock:
+        _reference_data = None
+
+
+def get_data_versions(get_conn):
+    """
+    Get the version of all data, re-reading them at most every PAGE_CACHE_CHECK_SECONDS.
+    `get_conn` is only called for a connection if they need re-reading.
+    """
+    global _data_versions, _data_versions_checked_at
+
+    if time.monotonic() - _data_versions_checked_at < PAGE_CACHE_CHECK_SECONDS:
+        return _data_versions
+
+    with get_conn().cursor() as cursor:
+        cursor.execute("SELECT name, version FROM data_versions")
+        versions = dict(cursor.fetchall())
+
+    with _page_lock:
+        _data_versions = versions
+        _data_versions_checked_at = time.monotonic()
+
+    return versions
+
+
+def expire_data_versions():
+    """Re-read the data versions on the next page load, e.g. after this process has bumped one"""
+    global _data_versions_checked_at
+
+    with _page_lock:
+        _data_versions_checked_at = 0.0
+
+
+def clear_cached_pages():
+    """Drop every rendered page cached in this process, and re-read the data versions on the next page load"""
+    global _data_versions_checked_at
+
+    with _page_lock:
+        _pages.clear()
+        _data_versions_checked_at = 0.0
+
+
+def get_cached_page(get_conn, key, data_names, render):
+    """
+    Get a rendered page from the cache, rendering it again if any of the data it's built from has changed.
+
+    :param get_conn: Function returning a database connection, only called if the data versions need checking.
+    :param key: Key of the page, e.g. ("standings", gameweek).
+    :param data_names: Names of the data versions the page is built from.
+    :param render: Function returning the page's HTML.
+    :return: The page's HTML and its ETag.
+    """
+    versions = get_data_versions(get_conn)
+    versions = tuple(versions.get(name, 0) for name in data_names)
+
+    with _page_lock:
+        cached = _pages.get(key)
+        if cached is not None and cached[0] == versions:
+            _pages.move_to_end(key)
+            return cached[1], cached[2]
+
+    body = render()
+    etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+
+    with _page_lock:
+        _pages[key] = (versions, body, etag)
+        _pages.move_to_end(key)
+        while len(_pages) > PAGE_CACHE_MAX_PAGES:
+            _pages.popitem(last=False)
+
+    return body, etag
@@ -1,8 +1,15 @@
+import os
+
 NUM_PLAYERS = 5
 NUM_PICKS = 11
 
 PROJECT_ID = "168510284961"
 
+# Where secrets are looked up, in order, see utils/secrets.py. Set SECRETS_BACKENDS=env for local runs without Cloud
+SECRETS_BACKENDS = os.environ.get("SECRETS_BACKENDS", "env,file,cloud").split(",")
+SECRETS_DIR = os.environ.get("SECRETS_DIR")
+SECRETS_MAX_WORKERS = 8
+
 TELEGRAM_CHAT_ID = -4673138846
 
 TELEGRAM_URL = "https://api.telegram.org/bot7829344666:AAGLCcj0F4lIvpiRGvyBsIE0gCiv_skFypI/sendMessage"
@@ -49,6 +56,16 @@ ALL_EVENTS = [
     ("Red Card", "Attacker", -2)
 ]
 
+# Map of (type, detail) of football API events to the names of the events we score, other events are ignored
+API_EVENT_NAMES = {
+    ("Goal", "Normal Goal"): "Goal",
+    ("Goal", "Own Goal"): "Own Goal",
+    ("Goal", "Penalty"): "Penalty",
+    ("Goal", "Missed Penalty"): "Missed Penalty",
+    ("Card", "Red Card"): "Red Card",
+    ("Card", "Second Yellow card"): "Red Card",
+}
+
 MAX_PICKS = {
     "Goalkeeper": 1,
     "Defender": 5,
@@ -72,4 +89,96 @@ GAMEWEEKS = {
     'Semi-finals': 6, 
     '3rd Place Final': 7,
     'Final': 8
-}
\ No newline at end of file
+}
+
+# How often each process checks whether its cached reference data (players, teams, gameweeks, events) is stale
+REFERENCE_CHECK_SECONDS = 30
+
+# Rendered players and standings pages are cached until the data they show changes, see utils/cache.py
+PAGE_CACHE_CHECK_SECONDS = 2
+PAGE_CACHE_MAX_PAGES = 32
+
+# Cold start budget for importing the website, and modules it must only import when needed, see utils/import_budget.py
+IMPORT_TIME_BUDGET_MS = 500
+LAZY_IMPORTS = ["pandas", "numpy", "requests", "google.cloud.secretmanager"]
+
+# Metrics shown on /metrics, see utils/metrics.py. Requests slower than SLOW_REQUEST_MS are logged with their queries
+METRICS_LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+METRICS_QUERY_COUNT_BUCKETS = [0, 1, 2, 5, 10, 20, 50, 100]
+SLOW_REQUEST_MS = 500
+
+# Most queries each page may make with empty page caches, see utils/query_recorder.py. Each budget allows one query for
+# the reference data check, the same query made QUERY_LOOP_THRESHOLD times in one request is reported as a likely N+1
+ROUTE_QUERY_BUDGETS = {
+    "/players": 3,
+    "/standings": 4,
+    "/transfer": 2,
+}
+DEFAULT_ROUTE_QUERY_BUDGET = 1
+QUERY_LOOP_THRESHOLD = 3
+
+# Database connection pool, each request borrows one connection
+MYSQL_POOL_MIN_SIZE = 1
+MYSQL_POOL_MAX_SIZE = 5
+MYSQL_POOL_RECYCLE_SECONDS = 1800
+MYSQL_POOL_HEALTH_CHECK_SECONDS = 30
+MYSQL_POOL_TIMEOUT_SECONDS = 10
+
+# Maximum number of rows sent in a single INSERT when loading the reference data tables, see utils/bulk_load.py
+BULK_LOAD_BATCH_SIZE = 500
+
+# Football API limits, see utils/api.py
+API_REQUESTS_PER_MINUTE = 10
+API_REQUESTS_PER_DAY = 100
+API_TIMEOUT_SECONDS = 30
+API_MAX_RETRIES = 3
+API_MAX_WORKERS = 4
+
+# API responses are cached in the database so re-running setup doesn't use up the daily quota, see utils/api_cache.py.
+# How long cached responses are used for before calling the API again, per endpoint
+API_CACHE_TTL_SECONDS = {
+    "fixtures": 6 * 60 * 60,
+    "teams": 7 * 24 * 60 * 60,
+    "players/squads": 7 * 24 * 60 * 60,
+    "fixtures/lineups": 60 * 60,
+    "fixtures/events": 60,
+}
+
+# Squads fetched more recently than this are reused from the API cache by an incremental sync, see db.sync_reference_data
+SQUAD_SYNC_MAX_AGE_SECONDS = 24 * 60 * 60
+
+# Kick off times are stored in this timezone
+LOCAL_TIMEZONE = "Europe/London"
+
+# Games are treated as live for this long after kick off, to allow for extra time and penalties
+LIVE_GAME_HOURS = 3
+
+# Telegram notification outbox, see utils/notifications.py
+TELEGRAM_TIMEOUT_SECONDS = 10
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+NOTIFICATION_BATCH_SIZE = 20
+NOTIFICATION_POLL_SECONDS = 30
+NOTIFICATION_MAX_ATTEMPTS = 8
+NOTIFICATION_RETRY_SECONDS = 30
+# How long a worker has to send the notifications it claims before another worker can claim them, longer than sending
+# a whole batch can take (NOTIFICATION_BATCH_SIZE messages at TELEGRAM_TIMEOUT_SECONDS each)
+NOTIFICATION_LEASE_SECONDS = 5 * 60
+
+# Live draft board, see utils/live.py. Streams end after LIVE_STREAM_MAX_SECONDS and browsers reconnect, to stay well
+# inside App Engine's request deadline
+LIVE_CHECK_SECONDS = 2
+LIVE_HEARTBEAT_SECONDS = 15
+LIVE_STREAM_MAX_SECONDS = 5 * 60
+LIVE_QUEUE_SIZE = 100
+
+# App Engine standard buffers whole responses, so there browsers poll /live every LIVE_POLL_SECONDS instead of holding
+# a thread open on /stream. Set LIVE_STREAMING=1 where responses are streamed (flexible environment, Cloud Run)
+LIVE_STREAMING = os.environ.get("LIVE_STREAMING", "0" if os.environ.get("GAE_ENV") == "standard" else "1") == "1"
+LIVE_POLL_SECONDS = 10
+# Events kept in memory for polling viewers, one further behind than this gets the whole board again
+LIVE_LOG_SIZE = 200
+
+# Live scoring worker, see scoring_worker.py
+SCORING_MIN_POLL_SECONDS = 60
+SCORING_MAX_SLEEP_SECONDS = 60 * 60
+SCORING_QUOTA_RESERVE = 10
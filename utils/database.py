@@ -0,0 +1,83 @@
+"""
+Connections to the draft database.
+
+Every process (the website, the scoring worker and the notification worker) connects the same way: through the Cloud
+SQL socket with credentials from the secrets on App Engine, or to a local MySQL otherwise. Each process shares a
+single pool of connections, see `get_pool`.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+from utils import metrics
+from utils.pool import ConnectionPool
+from utils.secrets import load_secrets
+from utils.config import (
+    MYSQL_POOL_MIN_SIZE,
+    MYSQL_POOL_MAX_SIZE,
+    MYSQL_POOL_RECYCLE_SECONDS,
+    MYSQL_POOL_HEALTH_CHECK_SECONDS,
+    MYSQL_POOL_TIMEOUT_SECONDS
+)
+
+CLOUD_SQL_SECRETS = ["CLOUD_SQL_CONNECTION_NAME", "CLOUD_SQL_USERNAME", "CLOUD_SQL_PASSWORD", "CLOUD_SQL_DATABASE_NAME"]
+
+_lock = threading.Lock()
+_pool = None
+
+
+def get_connection_settings():
+    """Get the arguments to connect to the database with in this environment"""
+    if os.environ.get("GAE_ENV") == "standard":
+        secrets = load_secrets(CLOUD_SQL_SECRETS)
+        return {
+            "unix_socket": f"/cloudsql/{secrets['CLOUD_SQL_CONNECTION_NAME']}",
+            "user": secrets["CLOUD_SQL_USERNAME"],
+            "password": secrets["CLOUD_SQL_PASSWORD"],
+            "database": secrets["CLOUD_SQL_DATABASE_NAME"],
+        }
+
+    return {"host": "localhost", "user": "root", "password": "password", "database": "draft"}
+
+
+def connect_to_db():
+    # Only needed once a connection is opened, so modules that use the pool can be imported without the MySQL client
+    import MySQLdb
+
+    connection = MySQLdb.connect(charset="utf8mb4", **get_connection_settings())
+
+    # Time every query, see /metrics
+    return metrics.InstrumentedConnection(connection)
+
+
+def get_pool() -> ConnectionPool:
+    """Get this process's pool of database connections, created on first use"""
+    global _pool
+
+    with _lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                connect_to_db,
+                min_size=MYSQL_POOL_MIN_SIZE,
+                max_size=MYSQL_POOL_MAX_SIZE,
+                recycle_seconds=MYSQL_POOL_RECYCLE_SECONDS,
+                health_check_seconds=MYSQL_POOL_HEALTH_CHECK_SECONDS,
+                timeout_seconds=MYSQL_POOL_TIMEOUT_SECONDS
+            )
+
+    return _pool
+
+
+@contextmanager
+def borrow_connection():
+    """Borrow a connection from the pool for a `with` block, it's closed instead of returned if the block raises"""
+    pool = get_pool()
+    conn = pool.get()
+
+    try:
+        yield conn
+    except Exception:
+        pool.discard(conn)
+        raise
+    else:
+        pool.put(conn)
@@ -0,0 +1,101 @@
+"""
+Measure how long importing the website takes, as paid by every App Engine cold start, and fail if it's over budget.
+
+Runs `python -X importtime -c "import main"` in a fresh interpreter, with secrets read from dummy environment variables
+so nothing goes over the network, and adds up the time of every top level import. It also fails if any of the
+LAZY_IMPORTS modules, which only setup and scoring need, are imported.
+
+Usage:
+    python -m utils.import_budget [--module main] [--budget-ms 500] [--runs 3] [--top 15]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from utils.config import IMPORT_TIME_BUDGET_MS, LAZY_IMPORTS
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# e.g. "import time:       311 |       1024 |   flask"
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+DUMMY_SECRETS = ["FOOTBALL_SECRET_KEY", "API_KEY"]
+
+
+def measure_imports(module):
+    """Import the module in a fresh interpreter, returns a list of (package, self us, cumulative us, depth)"""
+    env = dict(os.environ, SECRETS_BACKENDS="env")
+    env.pop("GAE_ENV", None)
+    for name in DUMMY_SECRETS:
+        env.setdefault(name, "import-budget")
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT_DIR,
+        env=env,
+        capture_output=True,
+        text=True
+    )
+
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, package = match.groups()
+            imports.append((package, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+
+    return imports
+
+
+def get_total_ms(imports):
+    """Total import time, the sum of the top level imports (each includes everything it imports)"""
+    return sum(cumulative_us for _, _, cumulative_us, depth in imports if depth == 0) / 1000
+
+
+def get_lazy_imports(imports):
+    """Modules that should only be imported when they're needed, but were imported anyway"""
+    return sorted({
+        package for package, _, _, _ in imports
+        if any(package == name or package.startswith(name + ".") for name in LAZY_IMPORTS)
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the website against a budget")
+    parser.add_argument("--module", default="main", help="Module to import")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_TIME_BUDGET_MS, help="Maximum import time")
+    parser.add_argument("--runs", type=int, default=3, help="Number of imports to measure, the fastest is used")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest imports to show")
+    args = parser.parse_args()
+
+    # The first run warms the bytecode cache and the OS file cache, so take the fastest
+    runs = [measure_imports(args.module) for _ in range(args.runs)]
+    imports = min(runs, key=get_total_ms)
+    total_ms = get_total_ms(imports)
+
+    print(f"Slowest imports of {args.module} (cumulative ms):")
+    for package, _, cumulative_us, depth in sorted(imports, key=lambda item: item[2], reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:10.1f}  {'  ' * depth}{package}")
+
+    print(f"\nImporting {args.module} took {total_ms:.1f} ms, the budget is {args.budget_ms:.0f} ms")
+
+    failed = False
+    if total_ms > args.budget_ms:
+        print("FAIL: over the import time budget")
+        failed = True
+
+    lazy_imports = get_lazy_imports(imports)
+    if lazy_imports:
+        print(f"FAIL: imported modules that should be lazy: {', '.join(lazy_imports)}")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Fan-out hub for the live draft board, pushed to browsers with server-sent events or polled from /live.
+
+One background thread per process checks the database for changes every LIVE_CHECK_SECONDS (or straight away when
+woken after a pick), and only while someone is watching. Each change is read from the database once and pushed to every
+connected viewer, so viewers don't need to keep reloading pages.
+
+Where responses can't be streamed (App Engine standard), viewers poll instead. The hub keeps a numbered log of the last
+LIVE_LOG_SIZE events it published, and each poll is answered from memory with the events after the last number that
+viewer saw, so polling viewers don't read the database either.
+"""
+
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from utils.config import (
+    LIVE_CHECK_SECONDS,
+    LIVE_HEARTBEAT_SECONDS,
+    LIVE_STREAM_MAX_SECONDS,
+    LIVE_QUEUE_SIZE,
+    LIVE_LOG_SIZE,
+    LIVE_POLL_SECONDS
+)
+
+
+def format_event(event, data):
+    """Format an event as a server-sent event message"""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class Subscriber(queue.Queue):
+    """A viewer's queue of messages, closed if they're dropped for not keeping up"""
+    closed = False
+
+
+class LiveHub:
+    def __init__(self, pool, get_events, check_seconds=LIVE_CHECK_SECONDS):
+        """
+        :param pool: Database connection pool, one connection is borrowed per check.
+        :param get_events: Function of (conn, previous_state) returning the new state and a list of (event, data).
+        :param check_seconds: How often to check for changes while anyone is watching.
+        """
+        self.pool = pool
+        self.get_events = get_events
+        self.check_seconds = check_seconds
+
+        # Poll cursors start with this, so a cursor from another instance's hub isn't mistaken for one of ours
+        self.hub_id = uuid.uuid4().hex[:8]
+
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._state = None
+        self._latest = {}  # event -> latest data, sent to new viewers so they start with a full board
+        self._log = deque(maxlen=LIVE_LOG_SIZE)  # (number, event, data) of the latest events, for polling viewers
+        self._next_number = 1
+        self._polled_at = float("-inf")
+        self._board_ready = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the background check, if it isn't running already"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="live-hub", daemon=True)
+                self._thread.start()
+
+    def subscribe(self):
+        """Start watching, returns a queue of messages"""
+        subscriber = Subscriber(maxsize=LIVE_QUEUE_SIZE)
+
+        with self._lock:
+            for event, data in self._latest.values():
+                subscriber.put_nowait(format_event(event, data))
+            self._subscribers.add(subscriber)
+            has_board = bool(self._latest)
+
+        self.start()
+
+        # Only the first viewer needs the board loading, everyone else starts from the latest messages
+        if not has_board:
+            self._wake.set()
+
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def num_subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def is_watched(self):
+        """Whether anyone is streaming, or has polled recently enough that they're likely to poll again"""
+        with self._lock:
+            return bool(self._subscribers) or time.monotonic() - self._polled_at < 3 * LIVE_POLL_SECONDS
+
+    def wake(self):
+        """Check for changes now, e.g. straight after a pick, rather than at the next check"""
+        self._wake.set()
+
+    def publish(self, event, data):
+        """Send an event to every viewer"""
+        message = format_event(event, data)
+
+        with self._lock:
+            if event != "pick":
+                self._latest[event] = (event, data)
+
+            self._log.append((self._next_number, event, data))
+            self._next_number += 1
+
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber.put_nowait(message)
+                except queue.Full:
+                    # Viewer isn't keeping up, drop them and end their stream so their browser reconnects
+                    self._subscribers.discard(subscriber)
+                    subscriber.closed = True
+
+    def poll(self, since=None):
+        """
+        Get the events published after the `since` cursor returned by a previous poll, for viewers polling rather than
+        streaming. Returns the cursor to pass next time and a list of (event, data). Viewers without a cursor this hub
+        can continue from (a first poll, another instance's cursor, or one older than the log) get the latest board.
+        """
+        with self._lock:
+            self._polled_at = time.monotonic()
+
+        self.start()
+
+        # The first viewer in a while waits for the board to load, rather than until their next poll
+        if not self._board_ready.is_set():
+            self._wake.set()
+            self._board_ready.wait(LIVE_CHECK_SECONDS)
+
+        hub_id, _, number = (since or "").partition(":")
+        number = int(number) if hub_id == self.hub_id and number.isdigit() else None
+
+        with self._lock:
+            oldest = self._log[0][0] if self._log else self._next_number
+            if number is None or not oldest - 1 <= number < self._next_number:
+                events = list(self._latest.values())
+            else:
+                events = [(event, data) for event_number, event, data in self._log if event_number > number]
+
+            return f"{self.hub_id}:{self._next_number - 1}", events
+
+    def check(self):
+        conn = self.pool.get()
+        try:
+            self._state, events = self.get_events(conn, self._state)
+        except Exception:
+            self.pool.discard(conn)
+            raise
+        else:
+            self.pool.put(conn)
+
+        for event, data in events:
+            self.publish(event, data)
+
+        self._board_ready.set()
+
+    def run(self):
+        while True:
+            self._wake.wait(self.check_seconds)
+            self._wake.clear()
+
+            if not self.is_watched():
+                # Nobody is watching, so whatever we last sent may be out of date by the time they are
+                with self._lock:
+                    self._state = None
+                    self._latest = {}
+                    self._log.clear()
+                    self._board_ready.clear()
+                continue
+
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Live draft board check failed: {e}")
+
+    def stream(self, subscriber):
+        """Generate the messages of a viewer's event stream, ending after LIVE_STREAM_MAX_SECONDS or once they're dropped"""
+        end = time.monotonic() + LIVE_STREAM_MAX_SECONDS
+
+        # Browsers reconnect on their own when a stream ends
+        yield f"retry: {LIVE_CHECK_SECONDS * 1000}\n\n"
+
+        try:
+            while time.monotonic() < end and not subscriber.closed:
+                try:
+                    yield subscriber.get(timeout=LIVE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # Comment line, keeps proxies from closing an idle connection
+                    yield ": heartbeat\n\n"
+        finally:
+            self.unsubscribe(subscriber)
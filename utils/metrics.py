@@ -0,0 +1,253 @@
+"""
+In-process metrics, exposed in the Prometheus text format on the admin /metrics page.
+
+Records:
+- the latency of every route, and how many SQL queries each request made
+- the time of every SQL query, keyed by its fingerprint (the query with its values replaced by ?)
+- the time and number of queries of every `db` function
+- the time of every call to an external service (the football API and Telegram)
+
+Requests slower than SLOW_REQUEST_MS are logged as a JSON line, with their slowest queries.
+
+Every query can also be recorded in full, with its arguments and the `db` function that made it, see
+`utils.query_recorder`.
+"""
+
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from types import FunctionType
+from utils.config import METRICS_LATENCY_BUCKETS, METRICS_QUERY_COUNT_BUCKETS, SLOW_REQUEST_MS
+
+_lock = threading.Lock()
+_local = threading.local()
+
+# Metric name -> (help, {labels: Histogram})
+_histograms = {}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+def observe(name, help_text, labels, value, buckets=METRICS_LATENCY_BUCKETS):
+    """Record a value in the histogram with the given name and labels, e.g. labels=(("route", "/standings"),)"""
+    with _lock:
+        _, histograms = _histograms.setdefault(name, (help_text, {}))
+        if labels not in histograms:
+            histograms[labels] = Histogram(buckets)
+        histograms[labels].observe(value)
+
+
+def get_fingerprint(sql):
+    """Normalise a query so the same query with different values has the same fingerprint"""
+    sql = re.sub(r"'(?:[^'\\]|\\.|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(\.\d+)?\b", "?", sql)
+    sql = re.sub(r"%s", "?", sql)
+    sql = re.sub(r"\s+", " ", sql).strip()
+
+    # Lists of values, e.g. IN (1, 2, 3) or VALUES (1, 2), (3, 4), are the same query however long they are
+    sql = re.sub(r"\(\s*\?(\s*,\s*\?)*\s*\)", "(?)", sql)
+    return re.sub(r"\(\?\)(\s*,\s*\(\?\))+", "(?)", sql)
+
+
+def record_query(sql, seconds, args=None):
+    """Record a SQL query, against the current request if there is one"""
+    fingerprint = get_fingerprint(sql)
+    observe("draft_query_duration_seconds", "Time of SQL queries", (("query", fingerprint),), seconds)
+
+    _local.query_count = getattr(_local, "query_count", 0) + 1
+    if getattr(_local, "request_queries", None) is not None:
+        _local.request_queries.append((fingerprint, seconds))
+
+    recorder = getattr(_local, "recorder", None)
+    if recorder is not None:
+        functions = getattr(_local, "functions", None)
+        recorder.append((fingerprint, args, functions[-1] if functions else None))
+
+
+def start_recording():
+    """Record every query made by this thread until `stop_recording`, returns the list they're recorded in"""
+    _local.recorder = []
+    return _local.recorder
+
+
+def stop_recording():
+    _local.recorder = None
+
+
+class InstrumentedCursor:
+    """Cursor that times every query"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, args=None):
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, args)
+        finally:
+            record_query(query, time.perf_counter() - start, args)
+
+    def executemany(self, query, args):
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(query, args)
+        finally:
+            record_query(query, time.perf_counter() - start, args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class InstrumentedConnection:
+    """Database connection whose cursors time every query"""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._connection.cursor(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def instrument_module(module):
+    """Time every public function of a module (e.g. `db`), and count the queries each one makes"""
+    for name, func in list(vars(module).items()):
+        if isinstance(func, FunctionType) and func.__module__ == module.__name__ and not name.startswith("_"):
+            setattr(module, name, instrument_function(func, f"{module.__name__}.{name}"))
+
+
+def instrument_function(func, name):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        queries_before = getattr(_local, "query_count", 0)
+
+        # So recorded queries know which db function made them
+        if getattr(_local, "functions", None) is None:
+            _local.functions = []
+        _local.functions.append(name)
+
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.functions.pop()
+            labels = (("function", name),)
+            observe("draft_db_call_duration_seconds", "Time of db functions", labels, time.perf_counter() - start)
+            observe(
+                "draft_db_call_queries", "SQL queries made by each db function call", labels,
+                getattr(_local, "query_count", 0) - queries_before, METRICS_QUERY_COUNT_BUCKETS
+            )
+
+    return wrapper
+
+
+@contextmanager
+def time_external_call(service, endpoint):
+    """Time a call to an external service, e.g. `with time_external_call("telegram", "sendMessage"):`"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(
+            "draft_external_call_duration_seconds", "Time of calls to external services",
+            (("service", service), ("endpoint", endpoint)), time.perf_counter() - start
+        )
+
+
+def start_request():
+    _local.request_start = time.perf_counter()
+    _local.request_queries = []
+
+
+def end_request(route, method, status):
+    """Record the current request, logging it if it was slow"""
+    start = getattr(_local, "request_start", None)
+    queries = getattr(_local, "request_queries", None) or []
+    _local.request_start = None
+    _local.request_queries = None
+
+    if start is None:
+        return
+
+    seconds = time.perf_counter() - start
+    observe(
+        "draft_request_duration_seconds", "Time of requests by route",
+        (("route", route), ("method", method), ("status", str(status))), seconds
+    )
+    observe(
+        "draft_request_queries", "SQL queries made by each request", (("route", route),), len(queries),
+        METRICS_QUERY_COUNT_BUCKETS
+    )
+
+    if seconds * 1000 >= SLOW_REQUEST_MS:
+        slowest = sorted(queries, key=lambda query: query[1], reverse=True)[:5]
+        print(json.dumps({
+            "message": f"Slow request {method} {route} took {seconds * 1000:.0f} ms",
+            "severity": "WARNING",
+            "route": route,
+            "method": method,
+            "status": status,
+            "duration_ms": round(seconds * 1000, 1),
+            "queries": len(queries),
+            "query_ms": round(sum(query[1] for query in queries) * 1000, 1),
+            "slowest_queries": [{"query": query, "ms": round(ms * 1000, 1)} for query, ms in slowest],
+        }))
+
+
+def format_labels(labels):
+    escaped = [(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels]
+    return ",".join(f'{key}="{value}"' for key, value in escaped)
+
+
+def render_prometheus(gauges=None):
+    """
+    Get every metric in the Prometheus text format.
+
+    :param gauges: Extra gauges to include, name -> (help, value).
+    """
+    lines = []
+
+    with _lock:
+        for name, (help_text, histograms) in sorted(_histograms.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in sorted(histograms.items()):
+                for bucket, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f"{name}_bucket{{{format_labels(labels + (('le', bucket),))}}} {count}")
+                lines.append(f"{name}_bucket{{{format_labels(labels + (('le', '+Inf'),))}}} {histogram.count}")
+                lines.append(f"{name}_sum{{{format_labels(labels)}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{format_labels(labels)}}} {histogram.count}")
+
+    for name, (help_text, value) in sorted((gauges or {}).items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
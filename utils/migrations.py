@@ -0,0 +1,151 @@
+"""
+Versioned schema migrations for the draft database.
+
+The table dumps in sql/ create a fresh database, the numbered files in sql/migrations/ are then applied
+in order on top of it. Applied versions are recorded in the `schema_migrations` table so this can be run
+against an existing database as many times as needed.
+
+Usage:
+    python -m utils.migrations [--host localhost] [--user root] [--password password] [--db draft] [--explain]
+        [--rebuild-points]
+
+Use --rebuild-points to recalculate the player_gameweek_points table from the points table, e.g. on a database that
+applied migration 001 before it backfilled the table.
+"""
+
+import argparse
+import os
+import re
+import sys
+import db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql", "migrations")
+
+# Hot queries from db.py, with the tables that must be read via an index rather than a full scan. EXPLAIN reports
+# tables by their alias in the query, so those are listed where the query uses one. Only tables an index can narrow
+# down are listed, whichever order MySQL joins them in: every draft pick covers gameweek 1, so a `gameweek BETWEEN
+# from_gameweek_id AND to_gameweek_id` filter on its own matches most of `picks`, and scanning it is the right plan
+HOT_QUERIES = [
+    ("get_user", db.USER_QUERY, ("name",), ["users"]),
+    ("get_user_gameweek_picks", db.USER_GAMEWEEK_PICKS_QUERY, (1, 1), ["pi", "pl"]),
+    ("is_player_picked", db.IS_PLAYER_PICKED_QUERY, (1, 1), ["picks"]),
+    ("get_position_counts", db.POSITION_COUNTS_QUERY, (1, 1), ["pi", "pl"]),
+    ("get_standings", db.STANDINGS_QUERY, (1, 1), ["pl", "pgp"]),
+    ("get_gameweek_totals", db.GAMEWEEK_TOTALS_QUERY.format(where=""), (), ["pgp"]),
+    ("get_gameweek_totals(gameweek_id)", db.GAMEWEEK_TOTALS_QUERY.format(where="WHERE gw.gameweek_id = %s"), (1,), ["pgp"]),
+    ("update_points_for_fixture", db.FIXTURE_EVENT_KEYS_QUERY, (1,), ["points"]),
+]
+
+
+def get_migrations():
+    """Get all migrations as a sorted list of (version, name, path)"""
+    migrations = []
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = re.match(r"^(\d+)_(.+)\.sql$", filename)
+        if match:
+            migrations.append((int(match.group(1)), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+
+    return sorted(migrations)
+
+
+def split_statements(sql):
+    """Split a migration file into statements, dropping comment lines"""
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def get_applied_versions(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version int NOT NULL,
+                name varchar(100) NOT NULL,
+                applied_at datetime NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (version)
+            )
+        """)
+        cursor.execute("SELECT version FROM schema_migrations")
+        versions = cursor.fetchall()
+
+    return {version[0] for version in versions}
+
+
+def apply_migrations(conn):
+    """Apply every migration that hasn't been applied yet, returns the versions applied"""
+    applied_versions = get_applied_versions(conn)
+
+    applied = []
+    for version, name, path in get_migrations():
+        if version in applied_versions:
+            continue
+
+        with open(path) as f:
+            statements = split_statements(f.read())
+
+        # Note that DDL statements commit implicitly in MySQL, so a failed migration must be fixed by hand
+        with conn.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+
+        conn.commit()
+        applied.append(version)
+        print(f"Applied migration {version:03d}_{name}")
+
+    return applied
+
+
+def find_full_scans(plans, indexed_tables):
+    """Get the tables in `indexed_tables` that the given EXPLAIN rows (as dicts) read without an index"""
+    return [
+        plan["table"] for plan in plans
+        if plan["table"] in indexed_tables and (plan["type"] == "ALL" or plan["key"] is None)
+    ]
+
+
+def explain_hot_queries(conn):
+    """
+    EXPLAIN the hot queries in db.py, returns a list of (query, table) that are read with a full table scan.
+    MySQL will happily scan tiny tables, so this is only meaningful against a populated database.
+    """
+    full_scans = []
+    with conn.cursor() as cursor:
+        for query_name, sql, params, indexed_tables in HOT_QUERIES:
+            cursor.execute("EXPLAIN " + sql, params)
+            columns = [column[0] for column in cursor.description]
+            plans = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            full_scans.extend((query_name, table) for table in find_full_scans(plans, indexed_tables))
+
+    return full_scans
+
+
+if __name__ == "__main__":
+    import MySQLdb
+
+    parser = argparse.ArgumentParser(description="Apply schema migrations to the draft database")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--user", default="root")
+    parser.add_argument("--password", default="password")
+    parser.add_argument("--db", default="draft")
+    parser.add_argument("--explain", action="store_true", help="Check the hot queries use indexes after migrating")
+    parser.add_argument("--rebuild-points", action="store_true", help="Recalculate every player's gameweek points")
+    args = parser.parse_args()
+
+    connection = MySQLdb.connect(host=args.host, user=args.user, password=args.password, database=args.db)
+
+    if not apply_migrations(connection):
+        print("Database is up to date")
+
+    if args.rebuild_points:
+        db.rebuild_player_gameweek_points(connection)
+        print("Rebuilt player gameweek points")
+
+    if args.explain:
+        full_scans = explain_hot_queries(connection)
+        for query_name, table in full_scans:
+            print(f"{query_name} does a full scan of `{table}`")
+
+        if full_scans:
+            sys.exit(1)
+
+        print("All hot queries use indexes")
@@ -0,0 +1,179 @@
+"""
+Outbox of Telegram messages.
+
+Messages are queued in the `notifications` table in the same transaction as the pick or transfer they are about, so
+they are only sent if it commits and are never lost if the process restarts. A background worker sends them in batches,
+retrying with backoff if Telegram is slow or down, so picks never wait on Telegram.
+
+The worker claims a batch by marking it `sending` in a short transaction, and only then calls Telegram, so no locks are
+held while it waits on Telegram. A claim lapses after NOTIFICATION_LEASE_SECONDS, so messages claimed by a worker that
+died are sent by the next one (possibly twice, if it died after sending them).
+
+Usage (to run the worker on its own instead of inside the website):
+    python -m utils.notifications
+"""
+
+import hashlib
+import threading
+from utils.utils import send_telegram_message
+from utils.config import (
+    TELEGRAM_MAX_MESSAGE_LENGTH,
+    NOTIFICATION_BATCH_SIZE,
+    NOTIFICATION_POLL_SECONDS,
+    NOTIFICATION_MAX_ATTEMPTS,
+    NOTIFICATION_RETRY_SECONDS,
+    NOTIFICATION_LEASE_SECONDS
+)
+
+
+def queue_notification(cursor, text, dedup_key=None):
+    """
+    Queue a message to be sent, as part of the cursor's transaction. A message isn't queued again while one with the
+    same dedup key (by default the text) is still waiting to be sent.
+    """
+    dedup_key = hashlib.sha1((dedup_key or text).encode("utf-8")).hexdigest()
+
+    cursor.execute(
+        """
+            INSERT INTO notifications (dedup_key, text)
+            SELECT %s, %s FROM DUAL
+            WHERE NOT EXISTS (SELECT 1 FROM notifications WHERE dedup_key = %s AND status = 'pending')
+        """,
+        (dedup_key, text[:TELEGRAM_MAX_MESSAGE_LENGTH], dedup_key)
+    )
+
+
+def get_batches(notifications):
+    """Group (notification_id, text) pairs into as few Telegram messages as possible, in order"""
+    batches = []
+    for notification_id, text in notifications:
+        if batches and len(batches[-1][1]) + len(text) + 1 <= TELEGRAM_MAX_MESSAGE_LENGTH:
+            batches[-1][0].append(notification_id)
+            batches[-1][1] += "\n" + text
+        else:
+            batches.append([[notification_id], text])
+
+    return batches
+
+
+def claim_notifications(conn, batch_size=NOTIFICATION_BATCH_SIZE):
+    """Claim the next due notifications for this worker, returns (notification_id, text, attempts) of each"""
+    with conn.cursor() as cursor:
+        # Skips rows another worker is claiming, and takes claims that have lapsed
+        cursor.execute(
+            """
+                SELECT notification_id, text, attempts FROM notifications
+                WHERE status IN ('pending', 'sending') AND next_attempt_at <= NOW()
+                ORDER BY notification_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """,
+            (batch_size,)
+        )
+        notifications = cursor.fetchall()
+
+        if notifications:
+            placeholders = ", ".join(["%s"] * len(notifications))
+            cursor.execute(
+                f"""
+                    UPDATE notifications
+                    SET status = 'sending', next_attempt_at = NOW() + INTERVAL %s SECOND
+                    WHERE notification_id IN ({placeholders})
+                """,
+                (NOTIFICATION_LEASE_SECONDS, *[notification[0] for notification in notifications])
+            )
+
+    # Release the row locks before calling Telegram, picks queueing the same text would otherwise wait on it
+    conn.commit()
+
+    return notifications
+
+
+def deliver_notifications(conn, send=send_telegram_message, batch_size=NOTIFICATION_BATCH_SIZE):
+    """Send the next batch of due notifications, returns the number sent"""
+    notifications = claim_notifications(conn, batch_size)
+    attempts = {notification_id: attempt for notification_id, _, attempt in notifications}
+
+    sent = 0
+    for notification_ids, text in get_batches([(notification_id, text) for notification_id, text, _ in notifications]):
+        placeholders = ", ".join(["%s"] * len(notification_ids))
+
+        try:
+            send(text)
+        except Exception as e:
+            print(f"Failed to send notifications {notification_ids}: {e}")
+
+            # Back off exponentially, giving up after NOTIFICATION_MAX_ATTEMPTS
+            attempt = max(attempts[notification_id] for notification_id in notification_ids) + 1
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                        UPDATE notifications
+                        SET attempts = attempts + 1,
+                            status = IF(attempts >= %s, 'failed', 'pending'),
+                            next_attempt_at = NOW() + INTERVAL %s SECOND,
+                            last_error = %s
+                        WHERE notification_id IN ({placeholders})
+                    """,
+                    (NOTIFICATION_MAX_ATTEMPTS, NOTIFICATION_RETRY_SECONDS * 2 ** (attempt - 1), str(e)[:255], *notification_ids)
+                )
+            conn.commit()
+            continue
+
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE notifications SET status = 'sent', sent_at = NOW() WHERE notification_id IN ({placeholders})",
+                notification_ids
+            )
+        conn.commit()
+        sent += len(notification_ids)
+
+    return sent
+
+
+class NotificationWorker:
+    """Background thread that sends queued notifications, woken straight away when a new one is queued"""
+
+    def __init__(self, pool, send=send_telegram_message, poll_seconds=NOTIFICATION_POLL_SECONDS):
+        self.pool = pool
+        self.send = send
+        self.poll_seconds = poll_seconds
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="notification-worker", daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Send any queued notifications now, rather than at the next poll"""
+        self._wake.set()
+
+    def run(self):
+        while True:
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+
+            try:
+                conn = self.pool.get()
+            except Exception as e:
+                print(f"Notification worker couldn't get a database connection: {e}")
+                continue
+
+            try:
+                # Keep going while there are full batches waiting
+                while deliver_notifications(conn, self.send) >= NOTIFICATION_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                print(f"Notification worker failed: {e}")
+                self.pool.discard(conn)
+            else:
+                self.pool.put(conn)
+
+
+if __name__ == "__main__":
+    # Not via main, which starts a worker of its own when it's imported
+    from utils.database import get_pool
+
+    NotificationWorker(get_pool()).run()
@@ -0,0 +1,170 @@
+"""
+A small thread-safe pool of database connections.
+
+Each request borrows one connection from the pool and gives it back when the request ends, so requests don't pay for
+a new connection to Cloud SQL every time.
+"""
+
+import threading
+import time
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, connect, min_size=1, max_size=5, recycle_seconds=1800, health_check_seconds=30, timeout_seconds=10):
+        """
+        :param connect: Function that opens a new connection.
+        :param min_size: Number of connections to keep open, opened by `fill`.
+        :param max_size: Maximum number of connections open at once, further checkouts wait for one to be returned.
+        :param recycle_seconds: Connections older than this are closed and replaced on checkout.
+        :param health_check_seconds: Connections idle for longer than this are pinged before being handed out.
+        :param timeout_seconds: How long to wait for a connection before raising PoolTimeout.
+        """
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.recycle_seconds = recycle_seconds
+        self.health_check_seconds = health_check_seconds
+        self.timeout_seconds = timeout_seconds
+
+        self._condition = threading.Condition()
+        self._idle = []  # (connection, created_at, returned_at), most recently returned last
+        self._created_at = {}  # id(connection) -> created_at, for connections that are checked out
+        self._size = 0
+
+        self._stats = {
+            "checkouts": 0,
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "failed_health_checks": 0,
+            "timeouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def fill(self):
+        """Open connections until there are at least `min_size`"""
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+
+            try:
+                connection = self._open()
+            except Exception:
+                with self._condition:
+                    self._size -= 1
+                raise
+
+            self.put(connection)
+
+    def get(self):
+        """Borrow a connection, waiting if all `max_size` connections are in use"""
+        start = time.monotonic()
+
+        with self._condition:
+            while not self._idle and self._size >= self.max_size:
+                remaining = self.timeout_seconds - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection available after {self.timeout_seconds} seconds")
+                self._condition.wait(remaining)
+
+            if self._idle:
+                connection, created_at, returned_at = self._idle.pop()
+            else:
+                connection, created_at, returned_at = None, None, None
+                self._size += 1
+
+            wait_seconds = time.monotonic() - start
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds_total"] += wait_seconds
+            self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], wait_seconds)
+
+        try:
+            if connection is not None and not self._is_usable(connection, created_at, returned_at):
+                self._close(connection)
+                connection = None
+
+            if connection is None:
+                connection = self._open()
+                created_at = time.monotonic()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._created_at[id(connection)] = created_at
+
+        return connection
+
+    def put(self, connection):
+        """Give a borrowed connection back to the pool"""
+        try:
+            # Never hand out a connection in the middle of someone else's transaction
+            connection.rollback()
+        except Exception:
+            self.discard(connection)
+            return
+
+        with self._condition:
+            created_at = self._created_at.pop(id(connection), time.monotonic())
+            self._idle.append((connection, created_at, time.monotonic()))
+            self._condition.notify()
+
+    def discard(self, connection):
+        """Close a borrowed connection instead of giving it back, e.g. after it has errored"""
+        self._close(connection)
+
+        with self._condition:
+            self._created_at.pop(id(connection), None)
+            self._size -= 1
+            self._condition.notify()
+
+    def stats(self):
+        """Get the pool usage statistics"""
+        with self._condition:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+
+        return stats
+
+    def _is_usable(self, connection, created_at, returned_at):
+        now = time.monotonic()
+        if now - created_at > self.recycle_seconds:
+            return False
+
+        if now - returned_at > self.health_check_seconds:
+            try:
+                connection.ping()
+            except Exception:
+                with self._condition:
+                    self._stats["failed_health_checks"] += 1
+                return False
+
+        return True
+
+    def _open(self):
+        connection = self.connect()
+
+        with self._condition:
+            self._stats["connections_opened"] += 1
+
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+        with self._condition:
+            self._stats["connections_closed"] += 1
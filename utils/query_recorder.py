@@ -0,0 +1,155 @@
+"""
+Find pages that make more queries than they need to.
+
+Every query made while recording is kept with its arguments and the `db` function that made it, so a recording can
+report:
+- duplicates, the same query with the same arguments made more than once
+- likely N+1 queries, the same query (with any arguments) made QUERY_LOOP_THRESHOLD or more times, e.g. in a loop
+
+Run against a seeded database, this loads every page that takes no arguments as the given user, with the rendered page
+cache emptied first, and fails if any page goes over its budget in ROUTE_QUERY_BUDGETS or makes duplicate or N+1
+queries. To check a single piece of code instead:
+
+    with record_queries() as recording:
+        db.get_standings(conn, 1)
+    recording.assert_max_queries(1)
+
+tests/test_routes.py runs the same checks on every page against a stand-in for the database.
+
+Usage:
+    python -m utils.query_recorder [--user Tom] [--route /standings ...]
+"""
+
+import argparse
+import os
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from utils import metrics
+from utils.config import ROUTE_QUERY_BUDGETS, DEFAULT_ROUTE_QUERY_BUDGET, QUERY_LOOP_THRESHOLD
+
+# Pages that don't finish (the live board stream), that start the live hub's background check (/live), or that change
+# the session or the process
+SKIPPED_ROUTES = ["/stream", "/live", "/logout", "/_ah/warmup"]
+
+
+class Recording:
+    def __init__(self, queries):
+        self.queries = queries  # List of (fingerprint, args, db function), in the order they were made
+
+    def __len__(self):
+        return len(self.queries)
+
+    def get_duplicates(self):
+        """Queries made more than once with the same arguments, as {(fingerprint, args): count}"""
+        counts = Counter((fingerprint, repr(args)) for fingerprint, args, _ in self.queries)
+        return {key: count for key, count in counts.items() if count > 1}
+
+    def get_loops(self, threshold=QUERY_LOOP_THRESHOLD):
+        """Queries made at least `threshold` times with any arguments, as {fingerprint: count}"""
+        counts = Counter(fingerprint for fingerprint, _, _ in self.queries)
+        return {fingerprint: count for fingerprint, count in counts.items() if count >= threshold}
+
+    def get_functions(self, fingerprint):
+        """Names of the db functions that made the given query"""
+        return sorted({function or "(not in db)" for query, _, function in self.queries if query == fingerprint})
+
+    def report(self):
+        lines = [f"{len(self)} queries"]
+
+        for (fingerprint, args), count in self.get_duplicates().items():
+            functions = ", ".join(self.get_functions(fingerprint))
+            lines.append(f"  duplicate x{count} from {functions}: {fingerprint} {args}")
+
+        for fingerprint, count in self.get_loops().items():
+            functions = ", ".join(self.get_functions(fingerprint))
+            lines.append(f"  N+1 x{count} from {functions}: {fingerprint}")
+
+        return "\n".join(lines)
+
+    def assert_max_queries(self, max_queries):
+        assert len(self) <= max_queries, f"Expected at most {max_queries} queries, made {self.report()}"
+
+    def assert_no_redundant_queries(self):
+        assert not self.get_duplicates() and not self.get_loops(), f"Redundant queries, made {self.report()}"
+
+
+@contextmanager
+def record_queries():
+    """Record every query made by this thread through an instrumented connection"""
+    queries = metrics.start_recording()
+    try:
+        yield Recording(queries)
+    finally:
+        metrics.stop_recording()
+
+
+def get_routes(app):
+    """Routes of every page that can be loaded with a GET and no arguments, sorted"""
+    return sorted({
+        rule.rule for rule in app.url_map.iter_rules()
+        if "GET" in rule.methods and not rule.arguments and rule.endpoint != "static" and rule.rule not in SKIPPED_ROUTES
+    })
+
+
+def check_route(client, route):
+    """Load a page with empty page caches, returns its status code and a recording of its queries"""
+    from utils.cache import clear_cached_pages
+
+    clear_cached_pages()
+    with record_queries() as recording:
+        response = client.get(route)
+
+    return response.status_code, recording
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the queries made by every page against a budget")
+    parser.add_argument("--user", default="Tom", help="User to load the pages as")
+    parser.add_argument("--route", action="append", help="Page to check, all of them by default")
+    args = parser.parse_args()
+
+    # Without the notification worker, which would send the seeded database's outbox to Telegram
+    os.environ["BACKGROUND_WORKERS"] = "0"
+
+    import db
+    from main import app, pool
+
+    conn = pool.get()
+    try:
+        user = db.get_user(conn, args.user)
+        if user is None:
+            sys.exit(f"User {args.user} not found, seed the database first")
+
+        # Load the reference data now, as it would be in a warmed up instance
+        db.get_all_players(conn)
+    finally:
+        pool.put(conn)
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["loggedin"] = True
+        session["user_id"] = user["user_id"]
+        session["username"] = user["name"]
+
+    failed = False
+    for route in args.route or get_routes(app):
+        status, recording = check_route(client, route)
+        budget = ROUTE_QUERY_BUDGETS.get(route, DEFAULT_ROUTE_QUERY_BUDGET)
+        print(f"{route} ({status}), budget {budget}: {recording.report()}")
+
+        if status >= 500:
+            print(f"FAIL: {route} failed")
+            failed = True
+        if len(recording) > budget:
+            print(f"FAIL: {route} is over its query budget")
+            failed = True
+        if recording.get_duplicates() or recording.get_loops():
+            print(f"FAIL: {route} makes redundant queries")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Functions to turn football API fixture events into rows of the points table.
+
+Scoring events come straight from the API (goals, penalties, own goals, cards) or are derived from the events and
+lineups (assists, clean sheets and penalty saves). Everything works on DataFrames holding any number of fixtures, so a
+whole tournament can be rescored in one go.
+"""
+
+import hashlib
+from datetime import datetime
+from typing import Dict, List
+import pandas as pd
+from utils.config import API_EVENT_NAMES
+
+FULL_TIME_MINUTE = 90
+EXTRA_TIME_END_MINUTE = 120
+HALF_TIME_MINUTE = 45
+HALF_TIME_BREAK_MINUTES = 15
+
+# Players in these positions get a clean sheet if they play this many minutes without their team conceding
+CLEAN_SHEET_POSITIONS = ["Goalkeeper", "Defender"]
+CLEAN_SHEET_MINUTES = 60
+
+EVENT_COLUMNS = ["fixture_id", "player_id", "player", "team_id", "type", "detail", "time", "extra_time", "assist_id", "assist", "comments"]
+
+# Kicks in a shootout don't count as goals, penalties or misses, or as goals conceded
+SHOOTOUT_COMMENT = "Penalty Shootout"
+LINEUP_COLUMNS = ["fixture_id", "team_id", "player_id", "player"]
+SCORING_EVENT_COLUMNS = ["fixture_id", "event_name", "player_id", "time", "extra_time"]
+
+
+def get_event_key(event_name, player_id, minute, extra_minute, occurrence):
+    """
+    Deterministic key of a scoring event, the same event gets the same key every time the fixture is polled.
+    `occurrence` tells apart otherwise identical events, e.g. two goals by the same player in the same minute.
+    """
+    raw = f"{event_name}|{player_id}|{minute}|{extra_minute}|{occurrence}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def get_match_minute(kick_off: datetime, current_time: datetime):
+    """
+    Estimate how many minutes of the given fixture have been played, allowing for half time. This stops at full time,
+    `derive_scoring_events` works out from the events whether the fixture went to extra time.
+    """
+    minutes = (current_time - kick_off).total_seconds() / 60
+    if minutes > HALF_TIME_MINUTE:
+        minutes = max(HALF_TIME_MINUTE, minutes - HALF_TIME_BREAK_MINUTES)
+
+    return int(min(max(minutes, 0), FULL_TIME_MINUTE))
+
+
+def resolve_player_ids(ids: pd.Series, names: pd.Series, reference) -> pd.Series:
+    """Match API players to our players, by id and falling back to name. Unknown players are NaN"""
+    name_ids = {name: player["player_id"] for name, player in reference.players_by_name.items()}
+    return ids.where(ids.isin(list(reference.players_by_id)), names.map(name_ids))
+
+
+def get_positions(reference) -> pd.Series:
+    """Get the position of every player, indexed by player id"""
+    return pd.Series({player_id: player["position"] for player_id, player in reference.players_by_id.items()}, dtype=object)
+
+
+def events_to_dataframe(events: List[Dict], reference) -> pd.DataFrame:
+    """Build a DataFrame of API events (as returned by `parse_fixture_events`) for any number of fixtures"""
+    events_df = pd.DataFrame(events, columns=EVENT_COLUMNS)
+    events_df = events_df[events_df["comments"] != SHOOTOUT_COMMENT].copy()
+    events_df["player_id"] = resolve_player_ids(events_df["player_id"], events_df["player"], reference)
+    events_df["assist_id"] = resolve_player_ids(events_df["assist_id"], events_df["assist"], reference)
+    events_df["time"] = events_df["time"].fillna(0).astype(int)
+    events_df["extra_time"] = events_df["extra_time"].fillna(0).astype(int)
+
+    return events_df
+
+
+def lineups_to_dataframe(lineups: List[Dict], reference) -> pd.DataFrame:
+    """Build a DataFrame of starting players (as returned by `parse_fixture_lineups`) for any number of fixtures"""
+    lineups_df = pd.DataFrame(lineups, columns=LINEUP_COLUMNS)
+    lineups_df["player_id"] = resolve_player_ids(lineups_df["player_id"], lineups_df["player"], reference)
+
+    return lineups_df
+
+
+def get_appearances(events_df: pd.DataFrame, lineups_df: pd.DataFrame, end_minutes: pd.Series) -> pd.DataFrame:
+    """Get the minute each player came on and went off, from the starting lineups, substitutions and red cards"""
+    substitutions = events_df[events_df["type"] == "subst"]
+
+    # The API gives the player going off as the player, and the player coming on as the assist
+    appearances = pd.concat([
+        lineups_df.assign(on=0)[["fixture_id", "team_id", "player_id", "on"]],
+        substitutions.assign(player_id=substitutions["assist_id"], on=substitutions["time"])[["fixture_id", "team_id", "player_id", "on"]],
+    ]).dropna(subset=["player_id"])
+
+    sent_off = events_df[events_df["detail"].isin(["Red Card", "Second Yellow card"])]
+    off = (
+        pd.concat([substitutions, sent_off])
+        .dropna(subset=["player_id"])
+        .groupby(["fixture_id", "player_id"])["time"].min()
+        .rename("off")
+        .reset_index()
+    )
+
+    appearances = appearances.merge(off, on=["fixture_id", "player_id"], how="left")
+    end_minute = appearances["fixture_id"].map(end_minutes)
+    appearances["off"] = appearances["off"].fillna(end_minute).clip(upper=end_minute)
+    appearances["minutes"] = (appearances["off"] - appearances["on"]).clip(lower=0)
+
+    return appearances
+
+
+def get_clean_sheets(events_df: pd.DataFrame, appearances: pd.DataFrame) -> pd.DataFrame:
+    """Players who have played long enough without their team conceding, so far"""
+    fixture_teams = appearances[["fixture_id", "team_id"]].drop_duplicates()
+
+    # Own goals are conceded by the scorer's team, other goals by the other team in the fixture
+    goals = events_df[(events_df["type"] == "Goal") & (events_df["detail"] != "Missed Penalty")]
+    own_goals = goals[goals["detail"] == "Own Goal"][["fixture_id", "team_id", "time"]]
+    other_goals = goals[goals["detail"] != "Own Goal"].merge(fixture_teams, on="fixture_id", suffixes=("_scorer", ""))
+    other_goals = other_goals[other_goals["team_id"] != other_goals["team_id_scorer"]][["fixture_id", "team_id", "time"]]
+    conceded = pd.concat([own_goals, other_goals])
+
+    # Count the goals conceded while each player was on the pitch
+    on_pitch = appearances.merge(conceded, on=["fixture_id", "team_id"])
+    on_pitch = on_pitch[(on_pitch["time"] >= on_pitch["on"]) & (on_pitch["time"] <= on_pitch["off"])]
+    goals_conceded = on_pitch.groupby(["fixture_id", "player_id"]).size().rename("goals_conceded").reset_index()
+
+    candidates = appearances[
+        appearances["position"].isin(CLEAN_SHEET_POSITIONS) & (appearances["minutes"] >= CLEAN_SHEET_MINUTES)
+    ].merge(goals_conceded, on=["fixture_id", "player_id"], how="left")
+
+    # Clean sheets are always at full time, so the same clean sheet gets the same event key on every poll
+    return candidates[candidates["goals_conceded"].isna()].assign(
+        event_name="Clean Sheet", time=FULL_TIME_MINUTE, extra_time=0
+    )
+
+
+def get_penalty_saves(events_df: pd.DataFrame, appearances: pd.DataFrame) -> pd.DataFrame:
+    """
+    Goalkeepers on the pitch when the other team missed a penalty.
+    The API doesn't say whether a missed penalty was saved, so every miss counts as a save.
+    """
+    missed = events_df[(events_df["type"] == "Goal") & (events_df["detail"] == "Missed Penalty")]
+    goalkeepers = appearances[appearances["position"] == "Goalkeeper"]
+
+    saves = missed[["fixture_id", "team_id", "time", "extra_time"]].merge(goalkeepers, on="fixture_id", suffixes=("_taker", ""))
+    saves = saves[
+        (saves["team_id"] != saves["team_id_taker"]) & (saves["time"] >= saves["on"]) & (saves["time"] <= saves["off"])
+    ]
+
+    return saves.assign(event_name="Penalty Save")
+
+
+def derive_scoring_events(events_df: pd.DataFrame, lineups_df: pd.DataFrame, reference, end_minutes: Dict[int, int]) -> pd.DataFrame:
+    """
+    Get every scoring event in the given fixtures, from their events and lineups.
+
+    :param events_df: Events of any number of fixtures, from `events_to_dataframe`.
+    :param lineups_df: Starting lineups of the same fixtures, from `lineups_to_dataframe`.
+    :param reference: The cached reference data, for player positions.
+    :param end_minutes: The number of minutes played so far in each fixture, up to full time.
+    :return: DataFrame of the scoring events, with columns SCORING_EVENT_COLUMNS.
+    """
+    # Fixtures with events after full time have gone to extra time, which has been played up to the latest event
+    last_event_minutes = events_df.groupby("fixture_id")["time"].max().astype(float)
+    end_minutes = (
+        pd.Series(end_minutes, dtype=float)
+        .combine(last_event_minutes, max, fill_value=0)
+        .clip(upper=EXTRA_TIME_END_MINUTE)
+    )
+    positions = get_positions(reference)
+
+    # Goals, own goals, penalties and cards are scored as they are
+    event_names = pd.DataFrame(
+        [(event_type, detail, name) for (event_type, detail), name in API_EVENT_NAMES.items()],
+        columns=["type", "detail", "event_name"]
+    )
+    direct = events_df.merge(event_names, on=["type", "detail"])
+
+    assists = events_df[(events_df["type"] == "Goal") & (events_df["detail"] == "Normal Goal")]
+    assists = assists.assign(player_id=assists["assist_id"], event_name="Assist")
+
+    appearances = get_appearances(events_df, lineups_df, end_minutes)
+    appearances["position"] = appearances["player_id"].map(positions)
+
+    scoring_events = pd.concat([
+        direct[SCORING_EVENT_COLUMNS],
+        assists[SCORING_EVENT_COLUMNS],
+        get_clean_sheets(events_df, appearances)[SCORING_EVENT_COLUMNS],
+        get_penalty_saves(events_df, appearances)[SCORING_EVENT_COLUMNS],
+    ]).dropna(subset=["player_id"])
+
+    scoring_events["player_id"] = scoring_events["player_id"].astype(int)
+    scoring_events["time"] = scoring_events["time"].astype(int)
+    scoring_events["extra_time"] = scoring_events["extra_time"].astype(int)
+
+    return scoring_events.reset_index(drop=True)
+
+
+def normalize_scoring_events(scoring_events: pd.DataFrame, reference, kick_offs: Dict[int, datetime]) -> Dict[str, tuple]:
+    """
+    Turn scoring events into points rows of (fixture_id, player_id, event_id, event_time, event_key), keyed by event
+    key. Events that aren't worth any points for the player's position are ignored.
+    """
+    events = pd.DataFrame(
+        [(name, position, event["event_id"]) for (name, position), event in reference.events_by_name_position.items()],
+        columns=["event_name", "position", "event_id"]
+    )
+
+    scoring_events = scoring_events.assign(
+        position=scoring_events["player_id"].map(get_positions(reference))
+    ).merge(events, on=["event_name", "position"])
+
+    identity = ["fixture_id", "event_name", "player_id", "time", "extra_time"]
+    scoring_events["occurrence"] = scoring_events.groupby(identity).cumcount() + 1
+    scoring_events["event_time"] = (
+        scoring_events["fixture_id"].map(kick_offs)
+        + pd.to_timedelta(scoring_events["time"] + scoring_events["extra_time"], unit="min")
+    )
+
+    rows = {}
+    for event in scoring_events.itertuples(index=False):
+        event_key = get_event_key(event.event_name, event.player_id, event.time, event.extra_time, event.occurrence)
+        rows[event_key] = (
+            int(event.fixture_id), int(event.player_id), int(event.event_id), event.event_time.to_pydatetime(), event_key
+        )
+
+    return rows
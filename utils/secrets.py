@@ -0,0 +1,94 @@
+"""
+Secrets, loaded once per process.
+
+Each secret is looked up in the backends listed in SECRETS_BACKENDS, in order:
+- env: an environment variable with the secret's name, e.g. API_KEY
+- file: a file with the secret's name in SECRETS_DIR
+- cloud: Google Cloud Secret Manager, using a single client for the whole process
+
+So local runs can set environment variables (or point SECRETS_DIR at a directory of files) and never touch the network.
+Use `load_secrets` to fetch several secrets in parallel, e.g. at start up.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from utils.config import PROJECT_ID, SECRETS_BACKENDS, SECRETS_DIR, SECRETS_MAX_WORKERS
+
+_lock = threading.Lock()
+_secrets = {}
+_client = None
+
+
+def get_env_secret(name):
+    return os.environ.get(name)
+
+
+def get_file_secret(name):
+    if not SECRETS_DIR:
+        return None
+
+    path = os.path.join(SECRETS_DIR, name)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return f.read().strip()
+
+
+def get_client():
+    """Get the Secret Manager client, created on first use and shared by every thread"""
+    global _client
+
+    with _lock:
+        if _client is None:
+            from google.cloud import secretmanager
+            _client = secretmanager.SecretManagerServiceClient()
+
+    return _client
+
+
+def get_cloud_secret(name):
+    response = get_client().access_secret_version(name=f"projects/{PROJECT_ID}/secrets/{name}/versions/latest")
+    return response.payload.data.decode("UTF-8")
+
+
+BACKENDS = {
+    "env": get_env_secret,
+    "file": get_file_secret,
+    "cloud": get_cloud_secret,
+}
+
+
+def fetch_secret(name):
+    for backend in SECRETS_BACKENDS:
+        value = BACKENDS[backend](name)
+        if value is not None:
+            return value
+
+    raise KeyError(f"Secret {name} not found in any of {SECRETS_BACKENDS}")
+
+
+def get_secret(name):
+    """Get a secret, fetching it the first time it's needed"""
+    if name not in _secrets:
+        value = fetch_secret(name)
+        with _lock:
+            _secrets[name] = value
+
+    return _secrets[name]
+
+
+def load_secrets(names: List[str]) -> Dict[str, str]:
+    """Fetch the given secrets in parallel, so they're cached for `get_secret`"""
+    missing = [name for name in names if name not in _secrets]
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(SECRETS_MAX_WORKERS, len(missing))) as executor:
+            values = list(executor.map(fetch_secret, missing))
+
+        with _lock:
+            _secrets.update(zip(missing, values))
+
+    return {name: _secrets[name] for name in names}
@@ -1,28 +1,32 @@
-import requests
 from collections import defaultdict
-from google.cloud import secretmanager
-from utils.config import PROJECT_ID, TELEGRAM_CHAT_ID, TELEGRAM_URL, MAX_PICKS, MIN_PICKS
+from utils.metrics import time_external_call
+from utils.config import TELEGRAM_CHAT_ID, TELEGRAM_URL, TELEGRAM_TIMEOUT_SECONDS, MAX_PICKS, MIN_PICKS, NUM_PICKS, LOCAL_TIMEZONE
 import os
-import pandas as pd
+from datetime import datetime
+from zoneinfo import ZoneInfo
 import hashlib
-from typing import List, Dict, Tuple
+from typing import Dict, NamedTuple
 
 
 
-def send_telegram_message(text):
-    """Send message to Telegram Group"""
+def send_telegram_message(text, url=TELEGRAM_URL):
+    """Send message to Telegram Group, raises if it isn't delivered. Use `utils.notifications` to send from a request"""
+    # Only the notification worker sends messages, so don't make every process import requests on start up
+    import requests
+
     payload = {
         "chat_id": TELEGRAM_CHAT_ID,
         "text": text
     }
 
-    requests.post(TELEGRAM_URL, json=payload)
+    with time_external_call("telegram", "sendMessage"):
+        response = requests.post(url, json=payload, timeout=TELEGRAM_TIMEOUT_SECONDS)
+    response.raise_for_status()
 
 
-def get_cloud_secret(secret_name):
-    client = secretmanager.SecretManagerServiceClient()
-    response = client.access_secret_version(name=f"projects/{PROJECT_ID}/secrets/{secret_name}/versions/latest")
-    return response.payload.data.decode("UTF-8")
+def get_current_time() -> datetime:
+    """Get the current time in the timezone kick off times are stored in, App Engine runs in UTC"""
+    return datetime.now(ZoneInfo(LOCAL_TIMEZONE)).replace(tzinfo=None)
 
 
 def create_secure_password(password, secret_key, hash_algo="sha256", iterations=100000):
@@ -50,41 +54,38 @@ def create_path_to_image_html(row):
     """
 
 
-def validate_pick(player_pick: Dict, user_existing_picks: List[Dict], all_existing_picks: List[Dict]) -> Tuple[bool, str]:
+class PickValidation(NamedTuple):
+    valid: bool
+    reason: str
+
+
+def validate_pick(player_pick: Dict, position_counts: Dict[str, int], already_picked: bool) -> PickValidation:
     """
-    Validate if the player pick is already in the existing picks.
+    Validate if the player pick is allowed.
 
     :param player_pick: The player pick to validate.
-    :param user_existing_picks: List of existing picks for this player.
-    :param all_existing_picks: List of all existing picks.
-    :return: True if the pick is valid, False otherwise. With an error message if invalid.
+    :param position_counts: How many players the user already has in each position.
+    :param already_picked: Whether the player has already been picked by any user.
+    :return: Whether the pick is valid, with an error message if invalid.
     """
     # Can't pick someone that has been picked already
-    print(player_pick)
-    print(user_existing_picks)
-    print(all_existing_picks)
-
-    all_existing_pick_names = [pick[1] for pick in all_existing_picks]
-
-    if player_pick["name"] in all_existing_pick_names:
-        return False, f"{player_pick['name']} has already been picked!"
+    if already_picked:
+        return PickValidation(False, f"{player_pick['name']} has already been picked!")
     
     # Count how many of each pick we have
-    freq = defaultdict(Goalkeeper=0, Defender=0, Midfielder=0, Attacker=0)
-    for existing_pick in user_existing_picks:
-        freq[existing_pick[2]] += 1
+    freq = defaultdict(int, position_counts)
 
     # Check if the player pick is valid based on the allowed positions
     player_pos = player_pick["position"]
     num_existing_pos_picks = freq[player_pos]
     
     if num_existing_pos_picks >= MAX_PICKS[player_pos]:
-        return False, f"You can only pick a maximum of {MAX_PICKS[player_pos]} {player_pos}(s)"
+        return PickValidation(False, f"You can only pick a maximum of {MAX_PICKS[player_pos]} {player_pos}(s)")
 
     # If this is the last pick, check if we have the minimum picks for all positions
-    if len(user_existing_picks) == 10:
+    if sum(freq.values()) == NUM_PICKS - 1:
         for pos, min_pick in MIN_PICKS.items():
             if freq[pos] < min_pick and player_pos != pos:
-                return False, f"You need to pick a {pos}!"
+                return PickValidation(False, f"You need to pick a {pos}!")
 
-    return True, ""
\ No newline at end of file
+    return PickValidation(True, "")